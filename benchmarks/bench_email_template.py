@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+bench_email_template.py
+Benchmarks the pre-compiled summary email renderer with very large key-level
+and event lists. Runs locally without Anvil:
+
+    python benchmarks/bench_email_template.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server_code'))
+
+from email_template import build_summary_model, render_summary_email  # noqa: E402
+
+
+def make_summary_data(level_count, day_count, events_per_day):
+    """Builds a synthetic structured parse result and event days of the requested size."""
+    structured = {
+        'version': 1,
+        'key_levels_raw': [
+            {'price': str(6000 - i), 'vdline': f"Skyline at {6000 - i + 1}" if i % 3 == 0 else None}
+            for i in range(level_count)
+        ],
+        'key_levels_detail': [[str(6000 - i), f"level note <{i}> & more"] for i in range(level_count)],
+        'market_summary': 'This week was busy. ' * 200,
+        'trading_plan': ' Supports are: 5700, 5650.' * 200,
+        'plan_summary': 'Bull case above 5700.'
+    }
+    event_days = [
+        {
+            'date': f"2025-02-{(d % 28) + 1:02d}",
+            'header': f"Day {d} ({d % 12 + 1}/{d % 28 + 1})",
+            'events': [{'time': f"{8 + e % 8}:30", 'event': f"Release {e} & revision"} for e in range(events_per_day)]
+        }
+        for d in range(day_count)
+    ]
+    return structured, 'This summary was generated at 18:00 CST.', event_days
+
+
+def bench(label, summary_data, repeat):
+    """Times build_summary_model + render_summary_email over repeat runs."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        html_content, text_content = render_summary_email(build_summary_model(*summary_data))
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<32} {elapsed * 1000:9.3f} ms/render  html={len(html_content):>10,}  text={len(text_content):>10,}")
+
+
+if __name__ == "__main__":
+    bench("typical (40 levels, 5 days)", make_summary_data(40, 5, 6), 2000)
+    bench("large (2k levels, 50 days)", make_summary_data(2000, 50, 40), 50)
+    bench("very large (50k levels, 500 days)", make_summary_data(50000, 500, 100), 3)
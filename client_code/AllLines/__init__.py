@@ -24,9 +24,11 @@ class AllLines(AllLinesTemplate):
       notification = Notification("Loading data...", timeout=3)
       notification.show()
       
-      # Fetch data directly from the server
+      # Fetch the levels and the latest issue's changes in one server call
       print("Calling server to get keylevels data...")
-      rows = anvil.server.call("get_keylevels")
+      view = anvil.server.call("get_all_lines_view")
+      rows = view['levels']
+      self.rich_text_changes.content = self.format_changes(view['newsletter_id'], view['level_diff'])
       
       # Debug: Print what we got back from the server
       row_count = len(rows)
@@ -76,6 +78,21 @@ class AllLines(AllLinesTemplate):
       notification = Notification(f"Error loading data: {str(e)}", timeout=5)
       notification.show()
   
+  def format_changes(self, newsletter_id, level_diff):
+    """Formats the stored diff against the previous issue as markdown"""
+    if not level_diff or not level_diff.get('previous_id'):
+      return "No previous issue to compare with."
+    lines = [f"**Changes in {newsletter_id} since {level_diff['previous_id']}**", ""]
+    for key, label in (('added', 'Added'), ('dropped', 'Dropped'), ('upgraded', 'Now major'), ('downgraded', 'No longer major')):
+      if level_diff.get(key):
+        lines.append(f"- {label}: {', '.join(level_diff[key])}")
+    changed_sections = level_diff.get('changed_sections') or {}
+    if changed_sections:
+      lines.append(f"- Changed sections: {', '.join(name.replace('_', ' ').title() for name in changed_sections)}")
+    if len(lines) == 2:
+      lines.append("No level or section changes.")
+    return "\n".join(lines)
+    
   def refresh_button_click(self, **event_args):
     """Called when the Refresh Data button is clicked"""
     # Clear any existing data
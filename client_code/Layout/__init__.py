@@ -10,6 +10,7 @@ from datetime import datetime, timezone
 # Import the forms for the content slot
 from ..MarketSummary import MarketSummary
 from ..AllLines import AllLines
+from ..Metrics import Metrics
 
 
 class Layout(LayoutTemplate):
@@ -65,3 +66,10 @@ class Layout(LayoutTemplate):
     self.content_panel.clear()
     # Add the AllLines form
     self.content_panel.add_component(AllLines(), slot='content_slot')
+
+  def outlined_button_metrics_click(self, **event_args):
+    """This method is called when the Metrics button is clicked"""
+    # Clear the current content by removing all components from the panel
+    self.content_panel.clear()
+    # Add the Metrics form
+    self.content_panel.add_component(Metrics(), slot='content_slot')
@@ -6,7 +6,6 @@ from anvil.tables import app_tables
 import anvil.google.auth, anvil.google.drive
 from anvil.google.drive import app_files
 import anvil.server
-from datetime import datetime, timezone
 
 
 class MarketSummary(MarketSummaryTemplate):
@@ -18,23 +17,47 @@ class MarketSummary(MarketSummaryTemplate):
     data = anvil.server.call("print_data_to_form")
 
     # Update the rich text boxes with the data
-    self.rich_text_summary.content = data["summary"]
+    self.rich_text_summary.content = self.format_structured_summary(
+      data.get("structured_summary"), data["summary"]
+    )
     self.rich_text_timing_detail.content = data["timing_detail"]
-    self.rich_text_upcoming_events.content = data["upcoming_events"]
-
-    # Update label text based on day/time
-    current_time = datetime.now(timezone.utc)
-    current_weekday = current_time.weekday()  # Monday is 0, Sunday is 6
-    current_hour = current_time.hour
-
-    # Check if it's between Friday 23:00 UTC and Monday 23:00 UTC
-    if (
-      (current_weekday == 4 and current_hour >= 23)
-      or current_weekday in [5, 6]
-      or (current_weekday == 0 and current_hour < 23)
-    ):
-      self.label_market_events.text = "Next Week's Events"
-    else:
-      self.label_market_events.text = "This Week's Remaining Events"
+    self.rich_text_upcoming_events.content = self.format_event_days(
+      data.get("upcoming_event_days"), data["upcoming_events"]
+    )
+
+    # The server picks the heading from the trading calendar so it always
+    # matches the window the events were selected for
+    self.label_market_events.text = data["events_label"]
 
     # Any code you write here will run before the form opens.
+
+  def format_structured_summary(self, structured, fallback):
+    """Render the structured parse result as markdown for the RichText"""
+    if not structured:
+      return fallback
+    parts = ["**Key Levels**\n"]
+    for level in structured.get("key_levels_raw", []):
+      vdline = f" [{level['vdline']}]" if level.get("vdline") else ""
+      parts.append(f"{level['price']}{vdline}  ")
+    parts.append("\n**Key Levels Detail**\n")
+    for price, note in structured.get("key_levels_detail", []):
+      parts.append(f"**{price}:** {note}  ")
+    for title, key in (("Market Summary", "market_summary"),
+                       ("Trading Plan", "trading_plan"),
+                       ("Plan Summary", "plan_summary")):
+      if structured.get(key):
+        parts.append(f"\n**{title}**\n")
+        parts.append(structured[key])
+    return "\n".join(parts).strip()
+
+  def format_event_days(self, event_days, fallback):
+    """Render the structured per-day event lists as markdown for the RichText"""
+    if not event_days:
+      return fallback
+    parts = []
+    for day in event_days:
+      parts.append(f"**{day['header']}**\n")
+      for event in day["events"]:
+        parts.append(f"{event['time']} - {event['event']}  ")
+      parts.append("")
+    return "\n".join(parts).strip()
@@ -0,0 +1,43 @@
+from ._anvil_designer import MetricsTemplate
+from anvil import *
+import anvil.server
+
+
+class Metrics(MetricsTemplate):
+  def __init__(self, **properties):
+    # Set Form properties and Data Bindings.
+    self.init_components(**properties)
+
+    self.refresh_data()
+
+  def refresh_data(self):
+    """Fetch the rolling metrics summary and show it as markdown tables"""
+    hours = int(self.drop_down_window.selected_value or 168)
+    summary = anvil.server.call("get_metrics_summary", hours)
+    self.rich_text_metrics.content = self.format_summary(summary)
+
+  def format_summary(self, summary):
+    """Render the metrics summary as markdown for the RichText"""
+    parts = [f"**Runs per day:** {summary['runs_per_day']:.2f} (last {summary['hours']} hours)\n"]
+
+    parts.append("**Latency**\n")
+    parts.append("| Timer | Count | p50 (ms) | p95 (ms) | Max (ms) |")
+    parts.append("|---|---:|---:|---:|---:|")
+    for name, stats in sorted(summary["timers"].items()):
+      parts.append(f"| {name} | {stats['count']} | {stats['p50_ms']:.0f} | "
+                   f"{stats['p95_ms']:.0f} | {stats['max_ms']:.0f} |")
+
+    parts.append("\n**Counters**\n")
+    parts.append("| Counter | Total | Per hour |")
+    parts.append("|---|---:|---:|")
+    for name, stats in sorted(summary["counters"].items()):
+      parts.append(f"| {name} | {stats['total']:.0f} | {stats['per_hour']:.2f} |")
+    return "\n".join(parts)
+
+  def refresh_button_click(self, **event_args):
+    """This method is called when the Refresh button is clicked"""
+    self.refresh_data()
+
+  def drop_down_window_change(self, **event_args):
+    """This method is called when the window size is changed"""
+    self.refresh_data()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+body_store.py
+Keeps newsletter bodies out of the newsletters table, compressed.
+
+A newsletters row holds only metadata (newsletter_id, subject, received_date,
+source), the SHA-256 content_hash of the raw body, and a link to its row in
+newsletterbodies, which holds the raw and cleaned bodies. Listing, ordering and
+existence checks on newsletters therefore never carry multi-KB text, and a
+body is only fetched when get_bodies follows the link for something that
+parses or displays it.
+
+Bodies are stored compressed in the raw_data/cleaned_data media columns, and
+the row's codec column names the framing ('zstd' when the optional zstandard
+package is installed, else 'zlib'). Reads pick the decompressor from the tag
+and decompress in chunks. Body rows written before compression have no codec
+and keep their text in the raw_body/cleaned_body columns;
+compress_newsletter_bodies migrates them.
+
+Rows written before the split still carry their text in the legacy
+raw_body/cleaned_body columns of newsletters; get_bodies falls back to them,
+and migrate_newsletter_bodies moves them into the body store.
+"""
+
+import codecs
+import hashlib
+import time
+import zlib
+
+import anvil
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from metrics import CountingTables, record_timing, increment
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'zlib'
+
+# Compressed bytes handed to the decompressor per step
+READ_CHUNK_BYTES = 64 * 1024
+
+COMPRESSED_CONTENT_TYPE = 'application/octet-stream'
+
+
+def content_hash(raw_body):
+    """Returns the SHA-256 hex digest of a raw body."""
+    return hashlib.sha256((raw_body or '').encode('utf-8')).hexdigest()
+
+
+def compress_text(text, codec=DEFAULT_CODEC):
+    """
+    Compresses text with a codec.
+
+    Returns:
+        bytes: The compressed UTF-8 text, or None for None
+    """
+    if text is None:
+        return None
+    data = text.encode('utf-8')
+    if codec == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError(f"Unknown body codec: {codec}")
+
+
+def _decompressor(codec):
+    """Returns a function that takes one chunk of compressed bytes and returns the bytes it yields."""
+    if codec == 'zlib':
+        return zlib.decompressobj().decompress
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("Bodies stored with zstd need the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    raise ValueError(f"Unknown body codec: {codec}")
+
+
+def decompress_text(data, codec):
+    """
+    Decompresses bytes from compress_text, streaming READ_CHUNK_BYTES at a
+    time through the decompressor and an incremental UTF-8 decoder.
+
+    Returns:
+        str: The text, or None for None
+    """
+    if data is None:
+        return None
+    decompress = _decompressor(codec)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    view = memoryview(data)
+    parts = []
+    for start in range(0, len(view), READ_CHUNK_BYTES):
+        parts.append(decoder.decode(decompress(view[start:start + READ_CHUNK_BYTES])))
+    parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
+
+def _to_media(data, name):
+    return anvil.BlobMedia(COMPRESSED_CONTENT_TYPE, data, name=name) if data is not None else None
+
+
+def _compressed_values(newsletter_id, raw_body, cleaned_body, codec=DEFAULT_CODEC):
+    """newsletterbodies column values for compressed bodies."""
+    return dict(
+        codec=codec,
+        raw_data=_to_media(compress_text(raw_body, codec), f"{newsletter_id}-raw.{codec}"),
+        cleaned_data=_to_media(compress_text(cleaned_body, codec), f"{newsletter_id}-cleaned.{codec}"),
+        raw_body=None,
+        cleaned_body=None
+    )
+
+
+def _read_body(body):
+    """Returns (raw_body, cleaned_body) of a newsletterbodies row."""
+    codec = body['codec']
+    if not codec:
+        return body['raw_body'], body['cleaned_body']
+    raw_data, cleaned_data = body['raw_data'], body['cleaned_data']
+    return (
+        decompress_text(raw_data.get_bytes() if raw_data else None, codec),
+        decompress_text(cleaned_data.get_bytes() if cleaned_data else None, codec)
+    )
+
+
+def add_body(newsletter_id, raw_body, cleaned_body):
+    """
+    Stores a newsletter's bodies, compressed.
+
+    Returns:
+        Row: The newsletterbodies row, to link from the newsletters row
+    """
+    return app_tables.newsletterbodies.add_row(
+        newsletter_id=newsletter_id,
+        **_compressed_values(newsletter_id, raw_body, cleaned_body)
+    )
+
+
+def get_bodies(newsletter):
+    """
+    Fetches the bodies of a newsletter.
+
+    Args:
+        newsletter (Row): A newsletters row
+
+    Returns:
+        tuple: (raw_body, cleaned_body)
+    """
+    started = time.perf_counter()
+    body = newsletter['body']
+    bodies = _read_body(body) if body is not None else (newsletter['raw_body'], newsletter['cleaned_body'])
+    record_timing('body.read', (time.perf_counter() - started) * 1000)
+    return bodies
+
+
+def set_cleaned_body(newsletter, cleaned_body):
+    """Replaces a newsletter's cleaned body (no write if it is unchanged)."""
+    body = newsletter['body']
+    if body is None:
+        body = _move_body(newsletter)
+    raw_body, current = _read_body(body)
+    if current == cleaned_body:
+        return
+    if body['codec']:
+        body['cleaned_data'] = _to_media(
+            compress_text(cleaned_body, body['codec']), f"{newsletter['newsletter_id']}-cleaned.{body['codec']}"
+        )
+    else:
+        body.update(**_compressed_values(newsletter['newsletter_id'], raw_body, cleaned_body))
+
+
+def set_bodies(newsletter, raw_body, cleaned_body):
+    """Replaces both bodies of a newsletter (e.g., with a corrected resend)."""
+    values = _compressed_values(newsletter['newsletter_id'], raw_body, cleaned_body)
+    body = newsletter['body']
+    if body is None:
+        body = app_tables.newsletterbodies.add_row(newsletter_id=newsletter['newsletter_id'], **values)
+    else:
+        body.update(**values)
+    newsletter.update(body=body, content_hash=content_hash(raw_body), raw_body=None, cleaned_body=None)
+
+
+def delete_body(newsletter):
+    """Deletes the body row of a newsletter that is about to be deleted."""
+    body = newsletter['body']
+    if body is not None:
+        body.delete()
+
+
+def _move_body(newsletter):
+    """Moves a legacy row's text into the body store and links it."""
+    body = add_body(newsletter['newsletter_id'], newsletter['raw_body'], newsletter['cleaned_body'])
+    newsletter.update(
+        body=body,
+        content_hash=content_hash(newsletter['raw_body']),
+        raw_body=None,
+        cleaned_body=None
+    )
+    return body
+
+
+@anvil.server.background_task
+def migrate_newsletter_bodies():
+    """
+    Moves the text of every newsletter written before the split into the
+    body store, one transaction per newsletter.
+
+    Returns:
+        int: Number of newsletters migrated
+    """
+    migrated = 0
+    pending = app_tables.newsletters.search(q.fetch_only("newsletter_id"), body=None)
+    for newsletter_id in [row['newsletter_id'] for row in pending]:
+        with tables.Transaction():
+            newsletter = app_tables.newsletters.get(newsletter_id=newsletter_id)
+            if newsletter is not None and newsletter['body'] is None:
+                _move_body(newsletter)
+                migrated += 1
+        anvil.server.task_state['migrated'] = migrated
+    print(f"Moved {migrated} newsletter bodies to the body store")
+    return migrated
+
+
+@anvil.server.callable
+def launch_body_migration():
+    """Starts migrate_newsletter_bodies as a background task and returns the task."""
+    return anvil.server.launch_background_task('migrate_newsletter_bodies')
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+@anvil.server.background_task
+def compress_newsletter_bodies(batch_size=25, codec=DEFAULT_CODEC):
+    """
+    Compresses the body rows stored as plain text, one transaction per batch.
+
+    Each row is fetched and read before and after compression, so the report
+    shows the read-latency impact measured on the same rows.
+
+    Args:
+        batch_size (int): Body rows per transaction
+        codec (str): 'zlib' or 'zstd'
+
+    Returns:
+        dict: 'compressed' (rows), 'original_bytes', 'stored_bytes', 'ratio'
+              (original/stored), 'read_ms_before' and 'read_ms_after' (medians)
+    """
+    pending = [
+        row['newsletter_id']
+        for row in app_tables.newsletterbodies.search(q.fetch_only("newsletter_id"), codec=None)
+    ]
+    compressed = original_bytes = stored_bytes = 0
+    reads_before = []
+    reads_after = []
+    for start in range(0, len(pending), batch_size):
+        with tables.Transaction():
+            for newsletter_id in pending[start:start + batch_size]:
+                started = time.perf_counter()
+                body = app_tables.newsletterbodies.get(newsletter_id=newsletter_id, codec=None)
+                if body is None:
+                    continue
+                raw_body, cleaned_body = _read_body(body)
+                reads_before.append((time.perf_counter() - started) * 1000)
+
+                values = _compressed_values(newsletter_id, raw_body, cleaned_body, codec)
+                body.update(**values)
+                original_bytes += sum(len(text.encode('utf-8')) for text in (raw_body, cleaned_body) if text)
+                stored_bytes += sum(values[column].length for column in ('raw_data', 'cleaned_data') if values[column])
+                compressed += 1
+
+                started = time.perf_counter()
+                _read_body(app_tables.newsletterbodies.get(newsletter_id=newsletter_id))
+                reads_after.append((time.perf_counter() - started) * 1000)
+        anvil.server.task_state['compressed'] = compressed
+
+    report = {
+        'compressed': compressed,
+        'original_bytes': original_bytes,
+        'stored_bytes': stored_bytes,
+        'ratio': original_bytes / stored_bytes if stored_bytes else None,
+        'read_ms_before': _median(reads_before),
+        'read_ms_after': _median(reads_after)
+    }
+    increment('body.compressed', compressed)
+    print(f"Compressed newsletter bodies: {report}")
+    return report
+
+
+@anvil.server.callable
+def launch_body_compression(codec=DEFAULT_CODEC):
+    """Starts compress_newsletter_bodies as a background task and returns the task."""
+    return anvil.server.launch_background_task('compress_newsletter_bodies', 25, codec)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+calendar_importer.py
+Streams economic-calendar exports (CSV or ICS) into the marketcalendar Data Table.
+Files are read line by line from a temp file, dates and times are normalized to the
+formats the rest of the app expects (YYYY-MM-DD and zero-padded HH:MM, so
+ordering by the time string is chronological), rows are deduplicated
+on (date, time, event) and written in batched transactions. Re-importing the same
+file adds nothing. Rows written by earlier imports may hold unpadded times
+(e.g., "8:30") or unnormalized whitespace in event names; the dedupe compares
+normalized keys, so they still match, and normalize_calendar_rows rewrites
+them once, in a single transaction.
+"""
+
+import csv
+import io
+from datetime import datetime
+
+import pytz
+
+import anvil.media
+import anvil.server
+import anvil.tables as tables
+from anvil.tables import app_tables
+from market_calendar import build_event_digests
+
+
+# Column names accepted for each field in CSV exports (compared lower-cased)
+CSV_COLUMN_ALIASES = {
+    'date': ('date', 'release date', 'day'),
+    'time': ('time', 'release time', 'time (et)', 'time (ct)'),
+    'event': ('event', 'title', 'name', 'release', 'description', 'indicator')
+}
+
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y%m%d', '%d %b %Y', '%b %d, %Y')
+TIME_FORMATS = ('%H:%M', '%H:%M:%S', '%I:%M %p', '%I:%M%p', '%I %p', '%I%p', '%H%M')
+
+# Times in the calendar are shown in the same zone as the summary timing detail
+DEFAULT_TIMEZONE = 'America/Chicago'
+
+
+def normalize_date(value):
+    """
+    Normalizes a date string to YYYY-MM-DD.
+
+    Args:
+        value (str): Date in any of DATE_FORMATS
+
+    Returns:
+        str: Normalized date, or None if it cannot be parsed
+    """
+    value = (value or '').strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def normalize_time(value):
+    """
+    Normalizes a time string to zero-padded 24-hour HH:MM (e.g., "08:30"), which
+    sorts chronologically as a string.
+    Empty values and all-day markers become an empty string.
+
+    Args:
+        value (str): Time in any of TIME_FORMATS
+
+    Returns:
+        str: Normalized time, "" for all-day events, or None if it cannot be parsed
+    """
+    value = (value or '').strip().upper().replace('.', '')
+    if not value or value in ('ALL DAY', 'TENTATIVE', 'N/A'):
+        return ''
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime('%H:%M')
+        except ValueError:
+            continue
+    return None
+
+
+def _resolve_csv_columns(header):
+    """Maps our field names to column indexes in a CSV header row."""
+    lowered = [column.strip().lower() for column in header]
+    columns = {}
+    for field, aliases in CSV_COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in lowered:
+                columns[field] = lowered.index(alias)
+                break
+    if 'date' not in columns or 'event' not in columns:
+        raise ValueError(f"CSV header must contain date and event columns, got: {header}")
+    return columns
+
+
+def iter_csv_events(lines):
+    """
+    Yields (date, time, event) tuples from CSV lines without loading the whole file.
+
+    Args:
+        lines (iterable): Iterable of text lines (e.g., an open file)
+
+    Yields:
+        tuple: Raw (date, time, event) strings, not yet normalized
+    """
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = _resolve_csv_columns(header)
+    for record in reader:
+        if not record:
+            continue
+        get = lambda field: record[columns[field]] if field in columns and columns[field] < len(record) else ''
+        yield get('date'), get('time'), get('event')
+
+
+def _unfold_ics_lines(lines):
+    """Joins RFC 5545 folded lines (continuations start with a space or tab)."""
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def _parse_ics_datetime(params, value, local_zone):
+    """Converts an ICS DTSTART property to a (date, time) pair in local_zone."""
+    value = value.strip()
+    if 'VALUE=DATE' in params or len(value) == 8:
+        return datetime.strptime(value[:8], '%Y%m%d').strftime('%Y-%m-%d'), ''
+
+    moment = datetime.strptime(value.rstrip('Z')[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        moment = pytz.utc.localize(moment).astimezone(local_zone)
+    else:
+        tzid = next((p[5:] for p in params if p.startswith('TZID=')), None)
+        if tzid:
+            moment = pytz.timezone(tzid).localize(moment).astimezone(local_zone)
+    return moment.strftime('%Y-%m-%d'), moment.strftime('%H:%M')
+
+
+def iter_ics_events(lines, local_zone_name=DEFAULT_TIMEZONE):
+    """
+    Yields (date, time, event) tuples from ICS lines, one VEVENT at a time.
+    Dates and times are already normalized and converted into local_zone_name.
+
+    Args:
+        lines (iterable): Iterable of text lines (e.g., an open file)
+        local_zone_name (str): IANA zone the calendar times are shown in
+
+    Yields:
+        tuple: (date, time, event) strings
+    """
+    local_zone = pytz.timezone(local_zone_name)
+    in_event = False
+    start = None
+    summary = None
+    for line in _unfold_ics_lines(lines):
+        if line == 'BEGIN:VEVENT':
+            in_event, start, summary = True, None, None
+        elif line == 'END:VEVENT':
+            if in_event and start and summary:
+                yield start[0], start[1], summary
+            in_event = False
+        elif in_event and ':' in line:
+            name_part, value = line.split(':', 1)
+            name, *params = name_part.split(';')
+            if name == 'DTSTART':
+                try:
+                    start = _parse_ics_datetime(params, value, local_zone)
+                except ValueError:
+                    start = None
+            elif name == 'SUMMARY':
+                summary = value.replace('\\,', ',').replace('\\;', ';').replace('\\n', ' ').strip()
+
+
+def normalize_event_name(value):
+    """Collapses runs of whitespace in an event name to single spaces."""
+    return ' '.join((value or '').split())
+
+
+def _normalized_key(row):
+    """The (date, time, event) dedupe key of a stored row, normalized like an incoming one."""
+    event_time = row['time'] or ''
+    return row['date'], normalize_time(event_time) or event_time, normalize_event_name(row['event'])
+
+
+def _load_existing_keys():
+    """
+    Loads the normalized (date, time, event) keys already in marketcalendar into a set.
+
+    Returns:
+        set: (date, time, event) tuples
+    """
+    return {_normalized_key(row) for row in app_tables.marketcalendar.search()}
+
+
+@anvil.server.background_task
+def normalize_calendar_rows():
+    """
+    One-off migration: zero-pads the times and normalizes the event names of
+    rows written by earlier imports, deleting rows that turn out to duplicate
+    another. Runs in one transaction, so a failure leaves the table unchanged.
+
+    Returns:
+        dict: Counts of rows updated and duplicates deleted
+    """
+    updated = 0
+    deleted = 0
+    with tables.Transaction():
+        seen = set()
+        for row in app_tables.marketcalendar.search():
+            key = _normalized_key(row)
+            if key in seen:
+                row.delete()
+                deleted += 1
+                continue
+            seen.add(key)
+            if (row['time'] or '', row['event']) != key[1:]:
+                row.update(time=key[1], event=key[2])
+                updated += 1
+    if updated or deleted:
+        build_event_digests()
+    print(f"Normalized {updated} calendar rows, deleted {deleted} duplicates")
+    return {'rows_updated': updated, 'duplicates_deleted': deleted}
+
+
+@anvil.server.callable
+def launch_calendar_normalization():
+    """Starts normalize_calendar_rows as a background task and returns the task."""
+    return anvil.server.launch_background_task('normalize_calendar_rows')
+
+
+def _write_batch(batch):
+    """Writes one batch of calendar rows in a single transaction."""
+    with tables.Transaction():
+        app_tables.marketcalendar.add_rows(batch)
+
+
+def import_calendar_lines(lines, file_format, batch_size=500, local_zone_name=DEFAULT_TIMEZONE):
+    """
+    Imports calendar events from an iterable of text lines.
+
+    Args:
+        lines (iterable): Iterable of text lines
+        file_format (str): Either 'csv' or 'ics'
+        batch_size (int): Number of rows written per transaction
+        local_zone_name (str): IANA zone the calendar times are shown in (ICS only)
+
+    Returns:
+        dict: Counts of rows added, duplicates skipped and invalid rows
+    """
+    if file_format == 'csv':
+        events = iter_csv_events(lines)
+    elif file_format == 'ics':
+        events = iter_ics_events(lines, local_zone_name)
+    else:
+        raise ValueError(f"Unsupported calendar format: {file_format}")
+
+    seen = _load_existing_keys()
+    batch = []
+    rows_added = 0
+    duplicates_skipped = 0
+    rows_invalid = 0
+
+    for raw_date, raw_time, raw_event in events:
+        event_date = normalize_date(raw_date)
+        event_time = normalize_time(raw_time)
+        event_name = normalize_event_name(raw_event)
+        if event_date is None or event_time is None or not event_name:
+            rows_invalid += 1
+            continue
+
+        key = (event_date, event_time, event_name)
+        if key in seen:
+            duplicates_skipped += 1
+            continue
+        seen.add(key)
+
+        batch.append({'date': event_date, 'time': event_time, 'event': event_name})
+        if len(batch) >= batch_size:
+            _write_batch(batch)
+            rows_added += len(batch)
+            batch = []
+
+    if batch:
+        _write_batch(batch)
+        rows_added += len(batch)
+
+    # Only rebuild the weekly digests if the calendar actually changed
+    if rows_added:
+        build_event_digests()
+
+    return {
+        'rows_added': rows_added,
+        'duplicates_skipped': duplicates_skipped,
+        'rows_invalid': rows_invalid
+    }
+
+
+def _detect_format(name, first_line):
+    """Guesses the file format from the file name or its first line."""
+    if (name or '').lower().endswith('.ics') or first_line.startswith('BEGIN:VCALENDAR'):
+        return 'ics'
+    return 'csv'
+
+
+@anvil.server.callable
+def import_calendar_file(media, file_format=None, batch_size=500, local_zone_name=DEFAULT_TIMEZONE):
+    """
+    Imports a CSV or ICS economic-calendar export into the marketcalendar table.
+    The upload is streamed from a temp file so memory use stays bounded.
+
+    Args:
+        media (anvil.Media): The uploaded calendar file
+        file_format (str, optional): 'csv' or 'ics'; detected from the file if omitted
+        batch_size (int): Number of rows written per transaction
+        local_zone_name (str): IANA zone the calendar times are shown in (ICS only)
+
+    Returns:
+        dict: Counts of rows added, duplicates skipped and invalid rows
+    """
+    try:
+        with anvil.media.TempFile(media) as file_name:
+            with open(file_name, 'r', encoding='utf-8-sig', newline='') as calendar_file:
+                if file_format is None:
+                    first_line = calendar_file.readline()
+                    calendar_file.seek(0)
+                    file_format = _detect_format(getattr(media, 'name', None), first_line)
+                result = import_calendar_lines(calendar_file, file_format, batch_size, local_zone_name)
+        print(f"Calendar import finished: {result}")
+        return result
+    except Exception as e:
+        print(f"Error in import_calendar_file: {str(e)}")
+        return {
+            'error': str(e),
+            'rows_added': 0,
+            'duplicates_skipped': 0,
+            'rows_invalid': 0
+        }
+
+
+@anvil.server.background_task
+def import_calendar_file_bg(media, file_format=None, batch_size=500, local_zone_name=DEFAULT_TIMEZONE):
+    """
+    Background task version of import_calendar_file for very large exports.
+    """
+    return import_calendar_file(media, file_format, batch_size, local_zone_name)
+
+
+@anvil.server.callable
+def import_calendar_text(text, file_format='csv', batch_size=500, local_zone_name=DEFAULT_TIMEZONE):
+    """
+    Imports calendar events from a CSV or ICS string (e.g., from an Uplink script).
+
+    Args:
+        text (str): The calendar file contents
+        file_format (str): 'csv' or 'ics'
+        batch_size (int): Number of rows written per transaction
+        local_zone_name (str): IANA zone the calendar times are shown in (ICS only)
+
+    Returns:
+        dict: Counts of rows added, duplicates skipped and invalid rows
+    """
+    return import_calendar_lines(io.StringIO(text), file_format, batch_size, local_zone_name)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+clean_cache.py
+Memoizes clean_newsletter by the content of the raw body.
+
+clean_newsletter is deterministic in (raw_body, cleaning profile), so its
+output is cached under a SHA-256 key of the profile's name and config and the
+raw body. There are two tiers: a small in-process LRU of the most recent
+bodies, and the cleancache table, which survives across server processes and
+runs (Anvil server processes are short-lived, so the LRU is usually cold on a
+re-run or a replay). Table entries are stored compressed with body_store's
+codecs, so a cached body costs no more than the compressed copy kept in
+newsletterbodies. Each entry records the CLEANER_VERSION that produced it; an
+entry from another version is a miss and is overwritten in place, so bumping
+the version invalidates only the stale entries. purge_stale_clean_cache
+deletes stale rows that were never looked up again.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import anvil
+import anvil.server
+from anvil.tables import app_tables
+
+from body_store import COMPRESSED_CONTENT_TYPE, DEFAULT_CODEC, compress_text, decompress_text
+from cleaning_profiles import PROFILE_CONFIGS, get_profile, detect_profile
+from email_parser import CLEANER_VERSION, clean_newsletter
+from metrics import CountingTables, increment
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+# Bodies are tens of KB, so only the most recent few are kept in memory
+MEMORY_ENTRIES = 32
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+
+
+def cache_key(raw_body, profile=None):
+    """
+    Returns the cache key for cleaning a body with a profile.
+
+    Args:
+        raw_body (str): The raw email body
+        profile (str, optional): Cleaning profile name; detected from the body when omitted
+
+    Returns:
+        str: SHA-256 hex digest of the resolved profile's name and config and the body
+    """
+    name = get_profile(profile).name if profile else detect_profile(raw_body).name
+    digest = hashlib.sha256()
+    digest.update(name.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(PROFILE_CONFIGS[name], sort_keys=True).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(raw_body.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _remember(key, cleaned_body):
+    with _lock:
+        _memory[key] = cleaned_body
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _compressed(key, cleaned_body):
+    """cleancache column values for a cleaned body."""
+    return dict(
+        cleaner_version=CLEANER_VERSION,
+        codec=DEFAULT_CODEC,
+        cleaned_data=anvil.BlobMedia(
+            COMPRESSED_CONTENT_TYPE, compress_text(cleaned_body, DEFAULT_CODEC), name=f"{key}.{DEFAULT_CODEC}"
+        ),
+        created=datetime.now()
+    )
+
+
+def lookup(key):
+    """
+    Returns the cached cleaned body for a key, or None on a miss
+    (including entries written by another CLEANER_VERSION).
+    """
+    with _lock:
+        cleaned_body = _memory.get(key)
+        if cleaned_body is not None:
+            _memory.move_to_end(key)
+    if cleaned_body is not None:
+        increment('cache.clean.memory_hit')
+        return cleaned_body
+
+    row = app_tables.cleancache.get(cache_key=key)
+    if row is not None and row['cleaner_version'] == CLEANER_VERSION:
+        increment('cache.clean.table_hit')
+        cleaned_body = decompress_text(row['cleaned_data'].get_bytes(), row['codec'])
+        _remember(key, cleaned_body)
+        return cleaned_body
+    increment('cache.clean.miss')
+    return None
+
+
+def store(key, cleaned_body):
+    """Caches a cleaned body in both tiers, replacing a stale entry for the key."""
+    _remember(key, cleaned_body)
+    row = app_tables.cleancache.get(cache_key=key)
+    if row is None:
+        app_tables.cleancache.add_row(cache_key=key, **_compressed(key, cleaned_body))
+    elif row['cleaner_version'] != CLEANER_VERSION:
+        row.update(**_compressed(key, cleaned_body))
+
+
+def cached_clean(raw_body, profile=None, clean=clean_newsletter):
+    """
+    clean_newsletter, answered from the cache when this body was cleaned before.
+
+    Args:
+        raw_body (str): The raw email body
+        profile (str, optional): Cleaning profile name; detected from the body when omitted
+        clean (callable, optional): Cleaner to run on a miss, called as clean(raw_body, profile)
+                                    (e.g., one that runs on the Uplink worker)
+
+    Returns:
+        str: The cleaned newsletter text
+    """
+    if not raw_body:
+        return clean_newsletter(raw_body, profile)
+    key = cache_key(raw_body, profile)
+    cleaned_body = lookup(key)
+    if cleaned_body is None:
+        cleaned_body = clean(raw_body, profile)
+        store(key, cleaned_body)
+    return cleaned_body
+
+
+def clear_memory():
+    """Empties the in-process tier."""
+    with _lock:
+        _memory.clear()
+
+
+@anvil.server.callable
+def purge_stale_clean_cache():
+    """
+    Deletes cache rows written by a CLEANER_VERSION other than the current one.
+
+    Returns:
+        int: Number of rows deleted
+    """
+    deleted = 0
+    for row in app_tables.cleancache.search():
+        if row['cleaner_version'] != CLEANER_VERSION:
+            row.delete()
+            deleted += 1
+    return deleted
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+cleaning_profiles.py
+Per-vendor configuration for clean_newsletter.
+
+A profile declares, as plain data, what a vendor's emails look like: the
+header lines to drop, the footer markers to cut at, the section headers to
+wrap in <SECTION> tags, the "{prefix} {Weekday}" headers, and fingerprint
+strings that identify the vendor near the top of an email.
+
+Each profile's regexes are compiled once, the first time it is used, and
+cached. Footer markers are merged into one case-insensitive alternation, so
+finding the earliest footer is a single scan. detect_profile looks only at
+the first FINGERPRINT_CHARS characters of a body.
+
+New formats are added by registering a profile config (or adding a row to the
+cleaningprofiles table) rather than by editing the cleaner.
+"""
+
+import re
+
+from anvil.tables import app_tables
+
+
+FINGERPRINT_CHARS = 4096
+DEFAULT_PROFILE = 'default'
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday')
+
+# The original vendor format the cleaner was written for
+PROFILE_CONFIGS = {
+    DEFAULT_PROFILE: {
+        'fingerprints': ['Core Structures/Levels To Engage', 'In summary for tomorrow:'],
+        'header_patterns': [r'^.*?View (this|the) (email|post) (in|on).*?\n'],
+        'footer_markers': ['Unsubscribe', 'Manage your subscription', 'You received this email'],
+        'leading_section': 'Market Summary',
+        'trailing_section': 'Closing',
+        'section_headers': [
+            'Market Commentary:',
+            'Key Signals:',
+            'Trading Plan:',
+            'Core Structures/Levels To Engage',
+            'In summary for tomorrow:',
+            'Trade Recap/Education',
+            'Important Housekeeping Notices'
+        ],
+        'weekday_sections': ['Trade Plan']
+    }
+}
+
+_compiled_profiles = {}
+_table_profiles_loaded = False
+
+
+class CompiledProfile:
+    """The compiled regexes and replacement templates for one profile."""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.leading_section = config.get('leading_section')
+        self.trailing_section = config.get('trailing_section')
+
+        fingerprints = config.get('fingerprints') or []
+        self.fingerprint = (
+            re.compile('|'.join(re.escape(f) for f in fingerprints)) if fingerprints else None
+        )
+
+        self.header_patterns = [
+            re.compile(pattern, re.IGNORECASE | re.MULTILINE)
+            for pattern in config.get('header_patterns', [])
+        ]
+
+        footer_markers = config.get('footer_markers') or []
+        self.footer = (
+            re.compile('|'.join(re.escape(m) for m in footer_markers), re.IGNORECASE)
+            if footer_markers else None
+        )
+
+        # (pattern, replacement) pairs applied in order for each section header
+        self.section_rules = []
+        for header in config.get('section_headers', []):
+            escaped = re.escape(header)
+            literal = header.replace('\\', r'\\')
+            self.section_rules.extend([
+                (re.compile(f'\n{{2,}}{escaped}\n{{2,}}'), f'\n\n{literal}\n\n'),
+                (re.compile(f'([^\n])\n{{0,2}}{escaped}'), r'\1\n\n<SECTION>' + literal),
+                (re.compile(f'{escaped}\n{{0,2}}([^\n])'), literal + r'</SECTION>\n\n\1'),
+                (re.compile(f'{escaped}$'), literal + r'</SECTION>\n\n'),
+            ])
+
+        # "{prefix} {Weekday}" headers (e.g., "Trade Plan Monday")
+        weekdays = '(?:' + '|'.join(WEEKDAYS) + ')'
+        self.weekday_rules = []
+        for prefix in config.get('weekday_sections', []):
+            words = r'\s+'.join(re.escape(word) for word in prefix.split())
+            self.weekday_rules.append((
+                prefix,
+                re.compile(r'^\s*' + words + r'\s+(' + weekdays + r')\s*$', re.MULTILINE),
+                r'\n\n<SECTION>' + prefix.replace('\\', r'\\') + r' \1</SECTION>\n\n'
+            ))
+
+
+def register_profile(name, config):
+    """
+    Adds or replaces a profile and drops its compiled cache entry.
+
+    Args:
+        name (str): Profile name
+        config (dict): Profile configuration (see PROFILE_CONFIGS)
+    """
+    PROFILE_CONFIGS[name] = config
+    _compiled_profiles.pop(name, None)
+
+
+def load_profiles(profiles):
+    """
+    Registers a set of profiles and marks the table profiles as loaded, for
+    processes that cannot read tables (e.g., the Uplink worker's pool processes).
+
+    Args:
+        profiles (dict): Mapping of profile name to configuration, typically a copy
+                         of PROFILE_CONFIGS taken after load_table_profiles()
+    """
+    global _table_profiles_loaded
+    for name, config in profiles.items():
+        register_profile(name, config)
+    _table_profiles_loaded = True
+
+
+def load_table_profiles():
+    """Registers profiles stored in the cleaningprofiles table, once per process."""
+    global _table_profiles_loaded
+    if _table_profiles_loaded:
+        return
+    _table_profiles_loaded = True
+    try:
+        for row in app_tables.cleaningprofiles.search():
+            if row['name'] and row['config']:
+                register_profile(row['name'], dict(row['config']))
+    except Exception as e:
+        print(f"Could not load cleaning profiles from table: {e}")
+
+
+def get_profile(name=None):
+    """
+    Returns the compiled profile with the given name, compiling it on first use.
+
+    Args:
+        name (str, optional): Profile name; defaults to the default profile
+
+    Raises:
+        ValueError: If no profile has that name
+    """
+    name = name or DEFAULT_PROFILE
+    compiled = _compiled_profiles.get(name)
+    if compiled is None:
+        if name not in PROFILE_CONFIGS:
+            load_table_profiles()
+        if name not in PROFILE_CONFIGS:
+            raise ValueError(f"Unknown cleaning profile: {name}")
+        compiled = _compiled_profiles[name] = CompiledProfile(name, PROFILE_CONFIGS[name])
+    return compiled
+
+
+def detect_profile(raw_body):
+    """
+    Picks the profile whose fingerprint appears in the first few KB of a body.
+
+    Args:
+        raw_body (str): The raw email body
+
+    Returns:
+        CompiledProfile: The matching profile, or the default profile
+    """
+    load_table_profiles()
+    head = (raw_body or '')[:FINGERPRINT_CHARS]
+    for name in PROFILE_CONFIGS:
+        if name == DEFAULT_PROFILE:
+            continue
+        profile = get_profile(name)
+        if profile.fingerprint is not None and profile.fingerprint.search(head):
+            return profile
+    return get_profile(DEFAULT_PROFILE)
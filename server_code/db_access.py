@@ -7,9 +7,20 @@ both raw email data and parsed sections into the relevant Data Tables.
 """
 
 import anvil.tables as tables
+import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
 import json
+import traceback
+from metrics import CountingTables, timed
+from body_store import add_body, set_bodies, set_cleaned_body, delete_body, content_hash
+from sources import DEFAULT_SOURCE_NAME
+from structured_log import get_logger, DEBUG
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+log = get_logger('db_access')
 
 
 def newsletter_exists(newsletter_id: str) -> bool:
@@ -18,6 +29,13 @@ def newsletter_exists(newsletter_id: str) -> bool:
     return result is not None
 
 
+def newsletter_content_hash(newsletter_id: str) -> str | None:
+    # Returns the stored raw-body hash of a newsletter (None if it does not
+    # exist or predates content hashes).
+    result = app_tables.newsletters.get(newsletter_id=newsletter_id)
+    return result['content_hash'] if result is not None else None
+
+
 def update_newsletter_cleaned_body(newsletter_id: str, cleaned_body: str, raw_body: str = None) -> None:
     """
     Updates the cleaned_body field of an existing newsletter or creates a new one if it doesn't exist.
@@ -29,40 +47,125 @@ def update_newsletter_cleaned_body(newsletter_id: str, cleaned_body: str, raw_bo
     """
     newsletter = app_tables.newsletters.get(newsletter_id=newsletter_id)
     if newsletter:
-        # Update only the cleaned_body field
-        newsletter['cleaned_body'] = cleaned_body
+        # Update only the cleaned body
+        set_cleaned_body(newsletter, cleaned_body)
     else:
         # If record doesn't exist, create new with minimal data
         app_tables.newsletters.add_row(
             newsletter_id=newsletter_id,
-            raw_body=raw_body,
-            cleaned_body=cleaned_body
+            content_hash=content_hash(raw_body),
+            body=add_body(newsletter_id, raw_body, cleaned_body)
         )
 
 
 def insert_newsletter(newsletter_id: str, newsletter: dict) -> None:
-    # Inserts the raw newsletter data into the 'newsletters' Data Table.
+    # Inserts the newsletter metadata into the 'newsletters' Data Table and
+    # its raw and cleaned bodies into the body store (see body_store.py).
+    raw_body = newsletter.get("raw_body")
     app_tables.newsletters.add_row(
         newsletter_id=newsletter_id,
         subject=newsletter.get("subject"),
-        raw_body=newsletter.get("raw_body"),
         received_date=newsletter.get("received_date"),
-        cleaned_body=newsletter.get("cleaned_body")
+        source=newsletter.get("source"),
+        content_hash=content_hash(raw_body),
+        body=add_body(newsletter_id, raw_body, newsletter.get("cleaned_body"))
     )
 
 
-def insert_parsed_sections(newsletter_id: str, parsed_data: dict) -> None:
-    # Inserts parsed sections into the 'parsed_sections' Data Table.
-    app_tables.parsed_sections.add_row(
-        newsletter_id=newsletter_id,
+def _parsed_section_values(parsed_data: dict) -> dict:
+    # Maps a parse_email result to parsed_sections columns (without timing_detail).
+    return dict(
         market_summary=parsed_data.get("MarketSummary"),
         key_levels=parsed_data.get("KeyLevels"),
         key_levels_raw=parsed_data.get("KeyLevelsRaw"),
         trading_plan=parsed_data.get("TradingPlan"),
         plan_summary=parsed_data.get("PlanSummary"),
         summary=parsed_data.get("summary"),
-        timing_detail=parsed_data.get("timing_detail")
+        structured_summary=parsed_data.get("Structured"),
+        parser_version=parsed_data.get("ParserVersion")
+    )
+
+
+def insert_parsed_sections(newsletter_id: str, parsed_data: dict) -> None:
+    # Inserts parsed sections into the 'parsed_sections' Data Table,
+    # updating the existing row if a resumed run already inserted it.
+    values = dict(_parsed_section_values(parsed_data), timing_detail=parsed_data.get("timing_detail"))
+    row = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
+    if row:
+        row.update(**values)
+    else:
+        app_tables.parsed_sections.add_row(newsletter_id=newsletter_id, **values)
+
+
+@tables.in_transaction
+def update_reparsed_sections(results: list) -> None:
+    """
+    Writes a batch of reparse results in one transaction.
+    
+    The original timing_detail is kept, since it describes when the summary
+    was first generated; it is only set for rows that did not exist yet.
+    
+    Args:
+        results (list): (newsletter_id, cleaned_body or None, parsed_data) tuples;
+                        cleaned_body is stored when the body was re-cleaned
+    """
+    for newsletter_id, cleaned_body, parsed_data in results:
+        values = _parsed_section_values(parsed_data)
+        row = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
+        if row:
+            row.update(**values)
+        else:
+            app_tables.parsed_sections.add_row(
+                newsletter_id=newsletter_id, timing_detail=parsed_data.get("timing_detail"), **values
+            )
+        if cleaned_body is not None:
+            newsletter = app_tables.newsletters.get(newsletter_id=newsletter_id)
+            if newsletter is not None:
+                set_cleaned_body(newsletter, cleaned_body)
+
+
+def update_revised_sections(newsletter_id: str, parsed_data: dict) -> list:
+    """
+    Applies the parse of a revised newsletter, writing only the parsed_sections
+    columns whose values changed (timing_detail and upcoming events are kept).
+    
+    Args:
+        newsletter_id (str): The revised newsletter
+        parsed_data (dict): parse_email result for the revised body
+        
+    Returns:
+        list: Names of the changed columns
+    """
+    values = _parsed_section_values(parsed_data)
+    row = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
+    if row is None:
+        app_tables.parsed_sections.add_row(
+            newsletter_id=newsletter_id, timing_detail=parsed_data.get("timing_detail"), **values
+        )
+        return sorted(values)
+    changed = {column: value for column, value in values.items() if row[column] != value}
+    if changed:
+        row.update(**changed)
+    return sorted(changed)
+
+
+def replace_newsletter_bodies(newsletter_id: str, raw_body: str, cleaned_body: str) -> None:
+    # Stores the bodies of a revised newsletter over the existing ones.
+    newsletter = app_tables.newsletters.get(newsletter_id=newsletter_id)
+    if newsletter is not None:
+        set_bodies(newsletter, raw_body, cleaned_body)
+
+
+def latest_newsletter_id(source_name: str) -> str | None:
+    # Returns the newest newsletter_id stored for a source.
+    rows = app_tables.newsletters.search(
+        q.fetch_only("newsletter_id"),
+        tables.order_by("newsletter_id", ascending=False),
+        source=source_name
     )
+    for row in rows:
+        return row['newsletter_id']
+    return None
 
 
 def delete_most_recent_records() -> tuple[str | None, str | None]:
@@ -75,6 +178,7 @@ def delete_most_recent_records() -> tuple[str | None, str | None]:
     try:
         # Get the most recent newsletter by received_date
         all_newsletters = app_tables.newsletters.search(
+            q.fetch_only("newsletter_id", "received_date"),
             tables.order_by("received_date", ascending=False)
         )
         
@@ -90,7 +194,24 @@ def delete_most_recent_records() -> tuple[str | None, str | None]:
         if parsed_section:
             parsed_section.delete()
             
-        # Delete the newsletter
+        # Drop the cached rendering so a reprocessed newsletter is re-rendered
+        from summary_artifacts import invalidate_artifact
+        invalidate_artifact(newsletter_id)
+        
+        # Forget its Gmail message so the pre-check lets it be processed again
+        from message_ledger import forget_newsletter
+        forget_newsletter(newsletter_id)
+            
+        # Drop its search postings and near-duplicate fingerprint
+        from search_index import remove_newsletter
+        remove_newsletter(newsletter_id)
+        from near_duplicates import forget_fingerprint
+        forget_fingerprint(newsletter_id)
+        from issue_diff import forget_snapshot
+        forget_snapshot(newsletter_id)
+            
+        # Delete the newsletter and its bodies
+        delete_body(newsletter)
         newsletter.delete()
         
         return newsletter_id, None
@@ -127,6 +248,11 @@ def bulk_upsert_data(table_name, data_json):
             table.add_row(**record)
             rows_added += 1
         
+        # Calendar changes invalidate the precomputed weekly event digests
+        if table_name == 'marketcalendar':
+            from market_calendar import build_event_digests
+            build_event_digests()
+        
         return {
             'rows_added': rows_added,
             'rows_updated': rows_updated
@@ -165,19 +291,25 @@ def add_vd_lines(records_list):
             app_tables.vdlines.add_row(**record)
             rows_added += 1
             
+        # Cached level analytics measured distances to the old vdlines
+        from level_analytics import invalidate_level_analytics
+        invalidate_level_analytics()
         return rows_added
     except Exception as e:
         print(f"Error adding VD lines: {str(e)}")
         return 0
 
 
-def clear_keylevelsraw_table():
+def clear_keylevelsraw_table(source=None):
     """
-    Clear all rows from the keylevelsraw table.
+    Clear one source's rows from the keylevelsraw table.
+    
+    Args:
+        source (str, optional): Source name; None clears the default source's rows
     """
     try:
-        # Get all rows from the keylevelsraw table
-        all_rows = app_tables.keylevelsraw.search()
+        # Get the source's rows from the keylevelsraw table
+        all_rows = app_tables.keylevelsraw.search(source=source)
         
         # Delete each row
         for row in all_rows:
@@ -189,7 +321,7 @@ def clear_keylevelsraw_table():
         return False
 
 
-def extract_and_store_key_levels(newsletter_id, trading_plan_key_levels, key_levels_detail):
+def extract_and_store_key_levels(newsletter_id, trading_plan_key_levels, key_levels_detail, source=None):
     """
     Extract levels from both Core Structures/Levels section and Trading Plan section,
     combine them, remove duplicates, and store them in the keylevelsraw table.
@@ -201,13 +333,15 @@ def extract_and_store_key_levels(newsletter_id, trading_plan_key_levels, key_lev
                                       extracted from the Trading Plan section
         key_levels_detail (list): List of dictionaries with detailed key levels 
                                  from the Core Structures/Levels section
+        source (str, optional): Newsletter source name; only this source's
+                                previous levels are replaced (None for the default source)
     
     Returns:
         int: Total number of key levels stored
     """
     try:
-        # Clear the existing keylevelsraw table
-        clear_keylevelsraw_table()
+        # Clear this source's existing levels from the keylevelsraw table
+        clear_keylevelsraw_table(source)
         
         # Get all vdlines from the app table for faster lookup
         all_vdlines = app_tables.vdlines.search()
@@ -290,7 +424,7 @@ def extract_and_store_key_levels(newsletter_id, trading_plan_key_levels, key_lev
         all_levels.sort(key=lambda x: x.get('price', 0), reverse=True)
         
         # Insert all levels into the keylevelsraw table
-        return insert_key_levels_to_keylevelsraw(all_levels)
+        return insert_key_levels_to_keylevelsraw(all_levels, source)
         
     except Exception as e:
         print(f"Error extracting and storing key levels: {str(e)}")
@@ -339,12 +473,13 @@ def find_nearest_vdline(level_price, vdlines_data, max_distance=3):
         return None
 
 
-def insert_key_levels_to_keylevelsraw(levels_data):
+def insert_key_levels_to_keylevelsraw(levels_data, source=None):
     """
     Insert key levels into the keylevelsraw table.
     
     Args:
         levels_data (dict): Dictionary containing lists of levels with their details
+        source (str, optional): Newsletter source name (None for the default source)
             
     Returns:
         int: Number of rows inserted
@@ -361,7 +496,8 @@ def insert_key_levels_to_keylevelsraw(levels_data):
                 type=level.get('type', ''),
                 note=level.get('note', ''),  # Changed from 'notes' to 'note' to match extraction field name
                 vdline=level.get('vdline'),  # Add vdline column
-                vdline_type=level.get('vdline_type')  # Add vdline_type column
+                vdline_type=level.get('vdline_type'),  # Add vdline_type column
+                source=source
             )
             rows_added += 1
                 
@@ -371,7 +507,19 @@ def insert_key_levels_to_keylevelsraw(levels_data):
         return 0
 
 
+def _all_lines_item(row):
+    """Maps a keylevelsraw row to the fields the AllLines data grid expects."""
+    return {
+        "price": row.get("price_with_range") or row.get("price", ""),
+        "major": row.get("severity", ""),
+        "notes": row.get("note", ""),
+        "vdline": row.get("vdline", ""),
+        "vdline_type": row.get("vdline_type", "")
+    }
+
+
 @anvil.server.callable
+@timed('endpoint.get_all_lines_data', flush_after=True)
 def get_all_lines_data():
     """
     Retrieves all rows from the keylevelsraw table for display in the AllLines form.
@@ -380,44 +528,18 @@ def get_all_lines_data():
         list: A list of dictionaries representing each row in the keylevelsraw table
     """
     try:
-        print("\n=== BEGIN get_all_lines_data ===")
         # Get all rows from the keylevelsraw table
         key_levels = app_tables.keylevelsraw.search()
         
-        # Print debugging information about what was retrieved
-        print(f"Retrieved {len(key_levels)} rows from keylevelsraw table")
-        if len(key_levels) > 0:
-            print(f"First row column names: {list(key_levels[0].keys())}")
-            print(f"First row values: {list(key_levels[0].values())}")
-        
         # Convert rows to a list of dictionaries for the data grid
-        result = []
-        for row in key_levels:
-            item = {
-                "price": row.get("price_with_range") or row.get("price", ""),
-                "major": row.get("severity", ""),
-                "notes": row.get("note", ""),
-                "vdline": row.get("vdline", ""),
-                "vdline_type": row.get("vdline_type", "")
-            }
-            result.append(item)
-            
-            # Print the first item for debugging
-            if len(result) == 1:
-                print(f"First transformed row: {item}")
-        
-        # Print debug info about the result
-        print(f"Returning {len(result)} formatted rows")
-        if len(result) > 0:
-            print(f"First result item keys: {list(result[0].keys())}")
-            print(f"First result item values: {list(result[0].values())}")
-            
-        print("=== END get_all_lines_data ===\n")
+        result = [_all_lines_item(row) for row in key_levels]
+        
+        if log.enabled(DEBUG):
+            log.debug("get_all_lines_data", rows=len(result), first_item=result[0] if result else None)
         # Return the list of dictionaries
         return result
     except Exception as e:
-        print(f"Error retrieving data from keylevelsraw: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+        log.error("get_all_lines_data failed", error=str(e), traceback=traceback.format_exc())
         # Return an empty list in case of error
         return []
 
@@ -426,51 +548,25 @@ def get_all_lines_data():
 @anvil.server.callable
 def refresh_all_lines_data_bg():
     """
-    Background task version of get_all_lines_data with enhanced logging.
+    Background task version of get_all_lines_data.
     
     Returns:
         list: A list of dictionaries representing each row in the keylevelsraw table
     """
     try:
-        print("=== Starting refresh_all_lines_data_bg background task ===")
-        
         # Get all rows from the keylevelsraw table
-        print("Querying keylevelsraw table...")
         key_levels = app_tables.keylevelsraw.search()
         
-        # Print detailed debugging information
-        row_count = len(key_levels)
-        print(f"Retrieved {row_count} rows from keylevelsraw table")
+        # Convert rows to a list of dictionaries for the DataGrid
+        result = [_all_lines_item(row) for row in key_levels]
         
-        # Convert rows to a list of dictionaries for the data grid
-        print("Converting database rows to dictionary format for DataGrid...")
-        result = []
-        for row in key_levels:
-            row_dict = {
-                "price": row.get("price_with_range") or row.get("price", ""),
-                "major": row.get("severity", ""),
-                "notes": row.get("note", ""),
-                "vdline": row.get("vdline", ""),
-                "vdline_type": row.get("vdline_type", "")
-            }
-            result.append(row_dict)
-            # Print for the first few rows to debug data transformation
-            if len(result) <= 3:
-                print(f"Transformed row {len(result)}: {row_dict}")
-        
-        # Print debug info about the result
-        print(f"Returning {len(result)} formatted rows")
-        if len(result) > 0:
-            print(f"First result item keys: {result[0].keys()}")
-            print(f"Sample data: {result[:3]}")
-            
-        print("=== refresh_all_lines_data_bg completed successfully ===")
+        if log.enabled(DEBUG):
+            log.debug("refresh_all_lines_data_bg", rows=len(result), sample=result[:3])
         # Return the list of dictionaries
         return result
     except Exception as e:
-        print(f"=== ERROR in refresh_all_lines_data_bg: {str(e)} ===")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Traceback: {traceback.format_exc()}")
+        log.error("refresh_all_lines_data_bg failed", error=str(e),
+                  error_type=type(e).__name__, traceback=traceback.format_exc())
         # Return an empty list in case of error to avoid crashing the client
         return {"error": str(e)}
 
@@ -484,9 +580,9 @@ def force_refresh_all_lines():
     Returns:
         list: A list of dictionaries representing each row in the keylevelsraw table
     """
-    print("\n=== FORCE REFRESH requested for keylevelsraw table ===")
+    log.info("force refresh requested", table="keylevelsraw")
     
-    # Call the regular function to get the data with all its debugging
+    # Call the regular function to get the data
     return get_all_lines_data()
 
 
@@ -534,6 +630,29 @@ def debug_keylevelsraw_table():
         return {"error": str(e)}
 
 
+@anvil.server.callable
+def get_all_lines_view(source=None):
+    """
+    Returns everything the AllLines form shows in one call: the current key
+    levels of a source and the stored diff of its latest issue.
+    
+    Args:
+        source (str, optional): keylevelsraw source (None for the default source)
+        
+    Returns:
+        dict: 'levels' (keylevelsraw rows as dicts), 'newsletter_id' and
+              'level_diff' of the latest issue (None if there is none)
+    """
+    levels = [dict(row) for row in app_tables.keylevelsraw.search(source=source)]
+    newsletter_id = latest_newsletter_id(source or DEFAULT_SOURCE_NAME)
+    sections = app_tables.parsed_sections.get(newsletter_id=newsletter_id) if newsletter_id else None
+    return {
+        'levels': levels,
+        'newsletter_id': newsletter_id,
+        'level_diff': sections['level_diff'] if sections else None
+    }
+
+
 @anvil.server.callable
 def get_keylevels():
     """
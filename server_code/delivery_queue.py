@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+delivery_queue.py
+Fans a rendered summary email out to every active row of the subscribers table.
+
+Sends run on a bounded thread pool behind a shared rate limiter, failed sends are
+retried with exponential backoff, and every recipient gets a status row in the
+deliveries table keyed by newsletter_id. Recipients already marked 'sent' for a
+newsletter are skipped, so re-running a delivery only retries what is left;
+a forced delivery sends to everyone again.
+
+Transports are pluggable: Anvil's Gmail integration (the default) or plain SMTP.
+LocalSmtpSink is a tiny in-process SMTP server that records messages, for tests
+and dry runs of the SMTP transport.
+"""
+
+import random
+import smtplib
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from email.message import EmailMessage
+
+import anvil.google.mail
+import anvil.server
+import anvil.tables as tables
+from anvil.tables import app_tables
+
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RATE_PER_SECOND = 20
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+
+class DeliveryFailed(Exception):
+    """Some recipients could not be sent to; re-running the delivery retries them."""
+
+
+class AnvilMailTransport:
+    """Sends through Anvil's Gmail integration (anvil.google.mail)."""
+
+    def send(self, to_address, subject, html_content, text_content):
+        anvil.google.mail.send(
+            to=to_address,
+            subject=subject,
+            html=html_content,
+            text=text_content
+        )
+
+
+class SmtpTransport:
+    """
+    Sends through a plain SMTP server, one connection per message so it is safe
+    to share across worker threads.
+    """
+
+    def __init__(self, host, port=587, sender=None, username=None, password=None, use_tls=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender or username
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+
+    def send(self, to_address, subject, html_content, text_content):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = to_address
+        message['Subject'] = subject
+        message.set_content(text_content)
+        message.add_alternative(html_content, subtype='html')
+
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as connection:
+            if self.use_tls:
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+            connection.send_message(message)
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP to accept and record messages."""
+
+    def _reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        self._reply('220 localhost sink ready')
+        sender, recipients, in_data, data_lines = None, [], False, []
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    self.server.sink.record(sender, recipients, '\n'.join(data_lines))
+                    sender, recipients, in_data, data_lines = None, [], False, []
+                    self._reply('250 OK')
+                else:
+                    data_lines.append(line[1:] if line.startswith('..') else line)
+                continue
+            command = line[:4].upper()
+            if command in ('HELO', 'EHLO'):
+                self._reply('250 localhost')
+            elif command == 'MAIL':
+                sender = line.split(':', 1)[1].strip()
+                self._reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.split(':', 1)[1].strip().strip('<>'))
+                self._reply('250 OK')
+            elif command == 'DATA':
+                in_data = True
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('250 OK')
+
+
+class LocalSmtpSink:
+    """
+    In-process SMTP server on localhost that records every message it receives.
+
+    Usage:
+        with LocalSmtpSink() as sink:
+            transport = SmtpTransport('localhost', sink.port, sender='me@example.com', use_tls=False)
+            deliver_summary('20250211', html, text, transport=transport)
+            print(len(sink.messages))
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = []
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port), _SinkHandler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def record(self, sender, recipients, data):
+        with self._lock:
+            self.messages.append({'from': sender, 'to': recipients, 'data': data})
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls at most rate_per_second apart."""
+
+    def __init__(self, rate_per_second):
+        self.interval = 1.0 / rate_per_second if rate_per_second else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _send_with_retry(transport, limiter, to_address, subject, html_content, text_content,
+                     max_attempts, backoff_seconds):
+    """
+    Sends one message, retrying with exponential backoff and jitter.
+
+    Returns:
+        tuple: (to_address, attempts, error message or None)
+    """
+    error = None
+    for attempt in range(1, max_attempts + 1):
+        limiter.wait()
+        try:
+            transport.send(to_address, subject, html_content, text_content)
+            return to_address, attempt, None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if attempt < max_attempts:
+                time.sleep(backoff_seconds * (2 ** (attempt - 1)) * (1 + random.random()))
+    return to_address, max_attempts, error
+
+
+def get_active_subscribers():
+    """Returns the email addresses of all active subscribers."""
+    return [row['email'] for row in app_tables.subscribers.search(active=True) if row['email']]
+
+
+def _pending_recipients(newsletter_id, recipients, force=False):
+    """
+    Ensures a deliveries row exists for every recipient and returns the rows
+    that still need sending (anything not already 'sent', or every row when
+    force is set).
+    """
+    existing = {row['email']: row for row in app_tables.deliveries.search(newsletter_id=newsletter_id)}
+    pending = []
+    now = datetime.now()
+    with tables.Transaction():
+        for email in recipients:
+            row = existing.get(email)
+            if row is None:
+                row = app_tables.deliveries.add_row(
+                    newsletter_id=newsletter_id,
+                    email=email,
+                    status='pending',
+                    attempts=0,
+                    last_error=None,
+                    sent_at=None,
+                    updated=now
+                )
+            if force or row['status'] != 'sent':
+                pending.append(row)
+    return pending
+
+
+def deliver_summary(newsletter_id, html_content, text_content, subject="Market Newsletter Summary",
+                    recipients=None, transport=None, max_workers=DEFAULT_MAX_WORKERS,
+                    rate_per_second=DEFAULT_RATE_PER_SECOND, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                    backoff_seconds=DEFAULT_BACKOFF_SECONDS, force=False):
+    """
+    Delivers a rendered summary to each recipient that has not received it yet.
+
+    Args:
+        newsletter_id (str): Newsletter the summary belongs to (deliveries key)
+        html_content (str): Rendered HTML body
+        text_content (str): Rendered plain-text body
+        subject (str): Email subject
+        recipients (list, optional): Addresses to send to; defaults to active subscribers
+        transport (optional): Object with send(to, subject, html, text); defaults to Anvil mail
+        max_workers (int): Size of the sending thread pool
+        rate_per_second (float): Maximum sends started per second across all workers
+        max_attempts (int): Attempts per recipient before marking it failed
+        backoff_seconds (float): Base delay for exponential backoff between attempts
+        force (bool): Send again to recipients already marked 'sent'
+
+    Returns:
+        dict: Counts of sent, failed and skipped recipients
+    """
+    if recipients is None:
+        recipients = get_active_subscribers()
+    recipients = list(dict.fromkeys(recipients))
+    transport = transport or AnvilMailTransport()
+
+    pending = _pending_recipients(newsletter_id, recipients, force)
+    skipped = len(recipients) - len(pending)
+    if not pending:
+        print(f"All {skipped} recipients already received newsletter {newsletter_id}")
+        return {'sent': 0, 'failed': 0, 'skipped': skipped}
+
+    rows_by_email = {row['email']: row for row in pending}
+    limiter = RateLimiter(rate_per_second)
+    sent = 0
+    failed = 0
+    started = time.monotonic()
+
+    # Workers only talk to the transport; status rows are written from this thread
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_send_with_retry, transport, limiter, email, subject,
+                            html_content, text_content, max_attempts, backoff_seconds)
+            for email in rows_by_email
+        ]
+        for future in as_completed(futures):
+            email, attempts, error = future.result()
+            row = rows_by_email[email]
+            now = datetime.now()
+            if error is None:
+                row.update(status='sent', attempts=(row['attempts'] or 0) + attempts,
+                           last_error=None, sent_at=now, updated=now)
+                sent += 1
+            else:
+                row.update(status='failed', attempts=(row['attempts'] or 0) + attempts,
+                           last_error=error, updated=now)
+                failed += 1
+                print(f"Delivery to {email} failed after {attempts} attempts: {error}")
+
+    print(f"Delivered newsletter {newsletter_id}: {sent} sent, {failed} failed, "
+          f"{skipped} skipped in {time.monotonic() - started:.1f}s")
+    return {'sent': sent, 'failed': failed, 'skipped': skipped}
+
+
+@anvil.server.callable
+def get_delivery_status(newsletter_id):
+    """
+    Returns per-status recipient counts for a newsletter's deliveries.
+    """
+    counts = {}
+    for row in app_tables.deliveries.search(newsletter_id=newsletter_id):
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    return counts
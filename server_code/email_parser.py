@@ -1,11 +1,18 @@
-import anvil.tables as tables
-import anvil.tables.query as q
 from anvil.tables import app_tables
-from . import db_access
 import re
+from bisect import bisect_left, bisect_right
 import spacy
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
+from trading_calendar import CENTRAL, next_session_after
+from cleaning_profiles import get_profile, detect_profile
+from metrics import CountingTables
+from structured_log import get_logger, DEBUG
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+log = get_logger('email_parser')
 
 """
 email_parser.py
@@ -13,6 +20,10 @@ email_parser.py
 This module handles the cleaning and parsing of newsletter emails. The cleaning process
 follows these specific steps:
 
+The vendor-specific parts (header patterns, footer markers, section headers and
+fingerprints) come from a cleaning profile, see cleaning_profiles.py; the steps
+below describe the default profile.
+
 1. Initial Setup:
    - Adds "Market Summary" section at the beginning of the document
    - Removes email client headers (e.g., "View this email in browser")
@@ -61,12 +72,23 @@ try:
 except Exception:
     nlp = None
 
-def clean_newsletter(raw_body: str) -> str:
+# Profile-independent cleanup patterns, compiled once
+EXCESS_NEWLINES = re.compile(r'\n{3,}')
+INLINE_WHITESPACE = re.compile(r'[ \t]+')
+DECORATIVE_MARKERS = re.compile(r'[=\-*]{3,}[\n\s]*')
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+# Bump whenever clean_newsletter's output changes, so cached cleanings are redone
+CLEANER_VERSION = 1
+
+def clean_newsletter(raw_body: str, profile=None) -> str:
     """
     Cleans the raw newsletter text.
     
     Args:
         raw_body (str): The raw text content of the newsletter
+        profile (str, optional): Name of the cleaning profile to apply;
+                                 detected from the body when omitted
         
     Returns:
         str: The cleaned newsletter text
@@ -81,119 +103,128 @@ def clean_newsletter(raw_body: str) -> str:
     if not raw_body:
         return ""
     
-    print(f"Original text length: {len(raw_body)}")
-    print(f"First 100 chars of original: {raw_body[:100]}")
+    profile = get_profile(profile) if profile else detect_profile(raw_body)
+    # Length/preview records and the diagnostic scans below only run when
+    # debug logging is enabled
+    debug = log.enabled(DEBUG)
+    if debug:
+        log.debug("clean start", length=len(raw_body), profile=profile.name, preview=raw_body[:100])
         
     # Remove header lines (common email client additions)
-    cleaned = re.sub(r'^.*?View (this|the) (email|post) (in|on).*?\n', '', raw_body, 
-                    flags=re.IGNORECASE | re.MULTILINE)
-    print(f"After header removal length: {len(cleaned)}")
-    
-    # Add Market Summary at the beginning with SECTION tags
-    cleaned = "\n\n<SECTION>Market Summary</SECTION>\n\n" + cleaned.lstrip()
-    print("Added Market Summary header with section tags")
-    
-    # Add Closing section at the beginning too
-    cleaned = cleaned + "\n\n<SECTION>Closing</SECTION>\n\n"
-    print("Added Closing section with section tags")
-    
-    # Find the position of the first footer marker
-    footer_markers = ['Unsubscribe', 'Manage your subscription', 'You received this email']
-    footer_pos = len(cleaned)
-    for marker in footer_markers:
-        pos = cleaned.lower().find(marker.lower())
-        if pos != -1 and pos < footer_pos:
-            footer_pos = pos
-    
-    # Only keep content before the footer
-    if footer_pos < len(cleaned):
-        cleaned = cleaned[:footer_pos].strip()
-    print(f"After footer removal length: {len(cleaned)}")
-    print(f"Content after footer removal (first 100 chars): {cleaned[:100]}")
+    cleaned = raw_body
+    for pattern in profile.header_patterns:
+        cleaned = pattern.sub('', cleaned)
+    if debug:
+        log.debug("headers removed", length=len(cleaned))
+    
+    # Add the leading section (e.g., Market Summary) at the beginning with SECTION tags
+    if profile.leading_section:
+        cleaned = f"\n\n<SECTION>{profile.leading_section}</SECTION>\n\n" + cleaned.lstrip()
+    
+    # Add the trailing section (e.g., Closing) at the end
+    if profile.trailing_section:
+        cleaned = cleaned + f"\n\n<SECTION>{profile.trailing_section}</SECTION>\n\n"
+    
+    # Only keep content before the first footer marker
+    footer = profile.footer.search(cleaned) if profile.footer else None
+    if footer:
+        cleaned = cleaned[:footer.start()].strip()
+    if debug:
+        log.debug("footer removed", length=len(cleaned), preview=cleaned[:100])
     
     # Remove excessive line breaks and whitespace, but preserve paragraph structure
-    cleaned = re.sub(r'\n{3,}', '\n\n', cleaned)
-    cleaned = re.sub(r'[ \t]+', ' ', cleaned)
-    print(f"After whitespace cleanup length: {len(cleaned)}")
+    cleaned = EXCESS_NEWLINES.sub('\n\n', cleaned)
+    cleaned = INLINE_WHITESPACE.sub(' ', cleaned)
     
     # Remove decorative markers, but be more specific
-    cleaned = re.sub(r'[=\-*]{3,}[\n\s]*', '\n\n', cleaned)
-    print(f"After marker removal length: {len(cleaned)}")
+    cleaned = DECORATIVE_MARKERS.sub('\n\n', cleaned)
     
     # Split into paragraphs and rejoin with standardized spacing
-    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', cleaned) if p.strip()]
+    paragraphs = [p.strip() for p in PARAGRAPH_BREAK.split(cleaned) if p.strip()]
     cleaned = '\n\n'.join(paragraphs)
-    print(f"After paragraph standardization length: {len(cleaned)}")
-    
-    # Mark section headers for better parsing
-    section_headers = [
-        'Market Commentary:',
-        'Key Signals:',
-        'Trading Plan:',
-        'Core Structures/Levels To Engage',
-        'In summary for tomorrow:',
-        'Trade Recap/Education',
-        'Important Housekeeping Notices'
-    ]
-    
-    for header in section_headers:
-        # First remove any excess newlines around the header
-        cleaned = re.sub(
-            f'\n{{2,}}{re.escape(header)}\n{{2,}}',
-            f'\n\n{header}\n\n',
-            cleaned
-        )
-        # Then wrap in section tags with exactly two newlines before and after
-        cleaned = re.sub(
-            f'([^\n])\n{{0,2}}{re.escape(header)}',
-            r'\1\n\n<SECTION>' + header,
-            cleaned
-        )
-        cleaned = re.sub(
-            f'{re.escape(header)}\n{{0,2}}([^\n])',
-            header + r'</SECTION>\n\n\1',
-            cleaned
-        )
-        cleaned = re.sub(
-            f'{re.escape(header)}$',
-            header + r'</SECTION>\n\n',
-            cleaned
-        )
-    
-    # Handle Trade Plan sections with the same spacing
-    weekdays = r'(?:Monday|Tuesday|Wednesday|Thursday|Friday)'
-    trade_plan_pattern = r'^\s*Trade\s+Plan\s+(' + weekdays + r')\s*$'
-    
-    # Debug print to see what we're looking for
-    print("Looking for Trade Plan pattern:", trade_plan_pattern)
-    
-    # Find all matches first to debug
-    matches = re.finditer(trade_plan_pattern, cleaned, flags=re.MULTILINE)
-    for match in matches:
-        print(f"Found Trade Plan match: '{match.group(0)}' at position {match.start()}")
-    
-    # Apply the substitution with exactly two newlines
-    cleaned = re.sub(
-        trade_plan_pattern,
-        r'\n\n<SECTION>Trade Plan \1</SECTION>\n\n',
-        cleaned,
-        flags=re.MULTILINE
-    )
+    if debug:
+        log.debug("whitespace normalized", length=len(cleaned), paragraphs=len(paragraphs))
+    
+    # Mark section headers for better parsing: for each header, first remove
+    # any excess newlines around it, then wrap it in section tags with exactly
+    # two newlines before and after
+    for pattern, replacement in profile.section_rules:
+        cleaned = pattern.sub(replacement, cleaned)
+    
+    # Handle "{prefix} {Weekday}" sections (e.g., Trade Plan Monday) with the same spacing
+    for prefix, pattern, replacement in profile.weekday_rules:
+        if debug:
+            for match in pattern.finditer(cleaned):
+                log.debug("weekday section found", prefix=prefix, match=match.group(0), position=match.start())
+        cleaned = pattern.sub(replacement, cleaned)
     
     # Final cleanup of any remaining multiple newlines
-    cleaned = re.sub(r'\n{3,}', '\n\n', cleaned)
+    cleaned = EXCESS_NEWLINES.sub('\n\n', cleaned)
     
-    # Debug print to check if any Trade Plan lines remain unwrapped
-    for line in cleaned.split('\n'):
-        if 'Trade Plan' in line and '<SECTION>' not in line:
-            print(f"WARNING: Unwrapped Trade Plan line found: '{line}'")
+    # Check whether any weekday section lines remain unwrapped
+    if debug:
+        for prefix, _, _ in profile.weekday_rules:
+            for line in cleaned.split('\n'):
+                if prefix in line and '<SECTION>' not in line:
+                    log.debug("unwrapped weekday section line", prefix=prefix, line=line)
     
     final_text = cleaned.strip()
-    print(f"Final cleaned text length: {len(final_text)}")
-    print(f"Final text preview: {final_text[:200]}")
+    if debug:
+        log.debug("clean done", length=len(final_text), preview=final_text[:200])
     
     return final_text
 
+def load_vdlines():
+    """
+    Loads the vdlines table once, in table order, for match_levels_to_vdlines.
+    
+    Returns:
+        list: Dicts with 'price' (float), 'type' and 'label' ("Type at Price")
+    """
+    return [
+        {'price': float(vdline['Price']), 'type': vdline['Type'], 'label': f"{vdline['Type']} at {vdline['Price']}"}
+        for vdline in app_tables.vdlines.search()
+    ]
+
+
+def match_levels_to_vdlines(levels, vdlines, max_distance=3):
+    """
+    Batched level matcher: finds the vdline near each level in one pass over
+    a price-sorted index instead of scanning every vdline for every level.
+    
+    Args:
+        levels (list): Price levels (numbers)
+        vdlines (list): Dicts from load_vdlines, in table order
+        max_distance (int): Maximum distance to consider a match (default: 3)
+        
+    Returns:
+        list: For each level, the matching vdline's label or None
+           - When multiple vdlines are found within max_distance:
+             - Non-Skyline types are prioritized over Skyline types
+             - The first (in table order) non-Skyline type is returned
+             - If only Skyline types are found, the first one is returned
+    """
+    order = sorted(range(len(vdlines)), key=lambda index: vdlines[index]['price'])
+    prices = [vdlines[index]['price'] for index in order]
+    # Widen the bisect window slightly; the exact distance is checked below
+    slack = max_distance + 1e-6
+    matches = []
+    for level in levels:
+        level = float(level)
+        first_any = first_non_skyline = None
+        for position in range(bisect_left(prices, level - slack), bisect_right(prices, level + slack)):
+            index = order[position]
+            if abs(vdlines[index]['price'] - level) > max_distance:
+                continue
+            if first_any is None or index < first_any:
+                first_any = index
+            if vdlines[index]['type'] != 'Skyline' and (first_non_skyline is None or index < first_non_skyline):
+                first_non_skyline = index
+        best = first_non_skyline if first_non_skyline is not None else first_any
+        matches.append(vdlines[best]['label'] if best is not None else None)
+    return matches
+
+
 def find_nearby_vdlines(level, max_distance=3):
     """
     Find any vdlines that are within the specified distance of the given level
@@ -204,50 +235,26 @@ def find_nearby_vdlines(level, max_distance=3):
         
     Returns:
         str: Formatted string "Type at Price" of the matching vdline or None if no match found
-           - When multiple vdlines are found within max_distance:
-             - Non-Skyline types are prioritized over Skyline types
-             - The first non-Skyline type is returned if multiple are found
-             - If only Skyline types are found, the first one is returned
+             (see match_levels_to_vdlines for how ties are resolved)
     """
     try:
-        # Convert level to float for numeric comparison
-        level_float = float(level)
-        
-        # Query all vdlines from the app table
-        all_vdlines = app_tables.vdlines.search()
-        
-        # Collect all matching vdlines within the specified distance
-        matching_vdlines = []
-        for vdline in all_vdlines:
-            vdline_price = float(vdline['Price'])
-            if abs(vdline_price - level_float) <= max_distance:
-                matching_vdlines.append(vdline)
-        
-        # If no matches found, return None
-        if not matching_vdlines:
-            return None
-            
-        # If only one match found, return its formatted string
-        if len(matching_vdlines) == 1:
-            vdline = matching_vdlines[0]
-            return f"{vdline['Type']} at {vdline['Price']}"
-            
-        # If multiple matches found, prioritize non-Skyline types
-        non_skyline_vdlines = [vdline for vdline in matching_vdlines if vdline['Type'] != 'Skyline']
-        
-        # Return the first non-Skyline type if any exist, otherwise return the first Skyline type
-        if non_skyline_vdlines:
-            vdline = non_skyline_vdlines[0]
-            return f"{vdline['Type']} at {vdline['Price']}"
-        else:
-            vdline = matching_vdlines[0]
-            return f"{vdline['Type']} at {vdline['Price']}"
-        
+        return match_levels_to_vdlines([level], load_vdlines(), max_distance)[0]
     except Exception as e:
         print(f"Error finding nearby vdlines: {e}")
         return None
 
-def parse_email(raw_body: str) -> dict:
+def parse_email(raw_body: str, vdlines=None) -> dict:
+    """
+    Parses a cleaned newsletter into its sections, key levels and summary.
+    
+    Args:
+        raw_body (str): The cleaned newsletter text
+        vdlines (list, optional): Preloaded vdlines (see load_vdlines); loaded
+                                  from the table when needed and not given
+        
+    Returns:
+        dict: The parsed sections
+    """
     parsed = {}
 
     # Extract Market Summary section
@@ -282,23 +289,33 @@ def parse_email(raw_body: str) -> dict:
         parsed["KeyLevelsDetail"] = key_levels_detail
         
         # Format KeyLevelsRaw with nearby vdline information
+        if key_levels_raw and vdlines is None:
+            try:
+                vdlines = load_vdlines()
+            except Exception as e:
+                print(f"Error loading vdlines: {e}")
+                vdlines = []
+        vdline_matches = match_levels_to_vdlines(key_levels_raw, vdlines or [])
         formatted_key_levels_raw = []
-        for num in key_levels_raw:
+        key_levels_raw_matches = []
+        for num, vdline_type in zip(key_levels_raw, vdline_matches):
             # Convert to int if the float has no decimal places, otherwise keep the float
             level_str = str(int(num)) if num.is_integer() else str(num)
             
-            # Check if this level is near any vdline
-            vdline_type = find_nearby_vdlines(num)
+            # Note if this level is near any vdline
+            key_levels_raw_matches.append({'price': level_str, 'vdline': vdline_type})
             if vdline_type:
                 level_str = f"{level_str} [{vdline_type}]"
                 
             formatted_key_levels_raw.append(level_str)
             
         parsed["KeyLevelsRaw"] = '\n'.join(formatted_key_levels_raw)
+        parsed["KeyLevelsRawMatches"] = key_levels_raw_matches
     else:
         parsed["KeyLevels"] = ""
         parsed["KeyLevelsRaw"] = ""
         parsed["KeyLevelsDetail"] = []
+        parsed["KeyLevelsRawMatches"] = []
 
     # Extract Trading Plan section
     trading_plan_match = re.search(r'<SECTION>Trading Plan:</SECTION>\s*(.*?)(?=<SECTION>|$)', raw_body, re.DOTALL)
@@ -346,19 +363,18 @@ def parse_email(raw_body: str) -> dict:
     # Join all parts with a newline
     parsed["summary"] = '\n\n'.join(part for part in summary_parts if part)
 
+    # Keep the structured result so readers never have to re-parse the text above
+    parsed["Structured"] = build_structured_summary(parsed)
+    parsed["ParserVersion"] = PARSER_VERSION
+
     # Generate timing detail
-    utc_now = datetime.now(pytz.UTC)
-    central = pytz.timezone('America/Chicago')
-    now = utc_now.astimezone(central)
+    now = datetime.now(pytz.UTC).astimezone(CENTRAL)
     
     current_date = now.strftime("%A, %B %d, %Y")
     current_time = now.strftime("%H:%M")
     
-    # Calculate next business day (keeping timezone awareness)
-    next_day = now + timedelta(days=1)
-    if next_day.weekday() >= 5:  # Saturday or Sunday
-        days_to_add = 7 - next_day.weekday() + 1  # Days until Monday
-        next_day = now + timedelta(days=days_to_add)
+    # Next exchange session (skips weekends and NYSE holidays)
+    next_day = next_session_after(now)
     
     next_date = next_day.strftime("%A, %B %d, %Y")
     
@@ -370,6 +386,36 @@ def parse_email(raw_body: str) -> dict:
     return parsed 
 
 
+STRUCTURED_SUMMARY_VERSION = 1
+
+# Bump whenever parse_email's output changes, so reparse_all refreshes stored rows
+PARSER_VERSION = 1
+
+
+def build_structured_summary(parsed):
+    """
+    Builds the compact structured form of a parse result that is persisted in
+    parsed_sections.structured_summary and consumed directly by the renderers.
+    
+    Args:
+        parsed (dict): The dictionary being built by parse_email
+        
+    Returns:
+        dict: Levels, vdline matches and section texts
+    """
+    return {
+        'version': STRUCTURED_SUMMARY_VERSION,
+        'key_levels_raw': parsed.get("KeyLevelsRawMatches", []),
+        'key_levels_detail': [
+            [detail['price_with_range'], detail['note']]
+            for detail in parsed.get("KeyLevelsDetail", [])
+        ],
+        'market_summary': parsed.get("MarketSummary", ""),
+        'trading_plan': parsed.get("TradingPlan", ""),
+        'plan_summary': parsed.get("PlanSummary", "")
+    }
+
+
 def extract_additional_key_levels(trading_plan_text):
     """
     Extract key levels from the 'Supports are:' and 'Resistances are:' sections
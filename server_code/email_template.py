@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+email_template.py
+Pre-compiled renderer for the summary email.
+
+EMAIL_TEMPLATE is split once at import into static chunks and named slots, so a
+render is a single join instead of a chain of whole-document .replace calls.
+Every fragment is built from structured summary data with list joins and HTML
+escaping, and the plain-text variant is produced from the same data.
+This module has no Anvil dependencies so it can be benchmarked locally.
+"""
+
+import html
+import re
+
+
+# HTML template as a string constant
+EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        /* Reset styles */
+        body {
+            margin: 0;
+            padding: 0;
+            font-family: Arial, sans-serif;
+            line-height: 1.6;
+            color: #333333;
+            background-color: #f5f5f5;
+        }
+        
+        /* Container */
+        .email-container {
+            max-width: 600px;
+            margin: 0 auto;
+            padding: 20px;
+            background-color: #ffffff;
+        }
+        
+        /* Header */
+        .header {
+            background-color: #2c3e50;
+            color: #ffffff;
+            padding: 20px;
+            text-align: center;
+            border-radius: 5px 5px 0 0;
+        }
+        
+        .header h1 {
+            margin: 0;
+            font-size: 24px;
+        }
+        
+        /* Content sections */
+        .content-section {
+            padding: 20px;
+            margin: 15px 0;
+            background-color: #ffffff;
+            border: 1px solid #e0e0e0;
+            border-radius: 5px;
+        }
+        
+        .section-title {
+            color: #2c3e50;
+            font-size: 18px;
+            margin-top: 0;
+            padding-bottom: 10px;
+            border-bottom: 2px solid #f0f0f0;
+        }
+        
+        /* Events section */
+        .events-section {
+            background-color: #f8f9fa;
+            text-align: center;
+        }
+        
+        /* Footer */
+        .footer {
+            margin-top: 20px;
+            padding: 15px;
+            text-align: center;
+            font-size: 12px;
+            color: #666666;
+            border-top: 1px solid #e0e0e0;
+        }
+        
+        /* Key Levels styling */
+        .key-levels {
+            font-family: monospace;
+            white-space: pre-wrap;
+            background-color: #f8f9fa;
+            padding: 10px;
+            border-radius: 4px;
+            margin-top: 10px;
+        }
+        
+        .key-levels-raw {
+            font-size: 1.1em;
+            font-weight: bold;
+            display: block;
+            padding: 12px;
+            background-color: #f1f1f1;
+            border-left: 4px solid #2c3e50;
+            line-height: 1.8;
+        }
+        
+        .key-levels-detail {
+            margin-top: 15px;
+            padding: 12px;
+            border-left: 4px solid #4e6d8c;
+            background-color: #f9f9f9;
+            font-family: Arial, sans-serif;
+            font-size: 14px;
+        }
+        
+        .events-list {
+            margin: 0;
+            padding-left: 0;
+            list-style-type: none;
+        }
+        
+        .event-day {
+            font-size: 1.2em;
+            font-weight: bold;
+            margin-top: 15px;
+            margin-bottom: 10px;
+            color: #2c3e50;
+        }
+        
+        .event-item {
+            margin-bottom: 5px;
+        }
+        
+        .section-subtitle {
+            font-weight: bold;
+            color: #4e6d8c;
+            margin-top: 15px;
+            margin-bottom: 5px;
+            border-bottom: 1px solid #e0e0e0;
+            padding-bottom: 3px;
+        }
+        
+        .trading-plan {
+            font-family: Arial, sans-serif;
+            font-size: 14px;
+        }
+        
+        .section-diff {
+            font-family: monospace;
+            font-size: 12px;
+            white-space: pre-wrap;
+            background-color: #f8f9fa;
+            padding: 8px;
+        }
+    </style>
+</head>
+<body>
+    <div class="email-container">
+        <div class="header">
+            <h1>Market Newsletter Summary</h1>
+        </div>
+        
+        <div class="content-section">
+            <h2 class="section-title">Market Timing</h2>
+            <p>{{ timing_detail }}</p>
+        </div>
+        
+        <div class="content-section events-section">
+            <h2 class="section-title">Upcoming Market Events</h2>
+            <div>{{ upcoming_events }}</div>
+        </div>
+        
+        <div class="content-section">
+            <h2 class="section-title">Key Levels</h2>
+            <div class="section-subtitle">Key Prices</div>
+            <div class="key-levels-raw">{{ key_levels_raw }}</div>
+            <div class="section-subtitle">Key Levels Detail</div>
+            <div class="key-levels-detail">{{ key_levels }}</div>
+        </div>
+        
+        <div class="content-section">
+            <h2 class="section-title">Changes Since Previous Issue</h2>
+            <div>{{ changes }}</div>
+        </div>
+        
+        <div class="content-section">
+            <h2 class="section-title">Market Summary</h2>
+            <div>{{ summary }}</div>
+        </div>
+        
+        <div class="footer">
+            <p>This is an automated summary from your Market Newsletter Aggregator</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+
+SLOT_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+NO_TIMING = 'No timing information available'
+NO_EVENTS = 'No upcoming events available'
+NO_KEY_LEVELS = 'No key levels available'
+NO_KEY_LEVELS_DETAIL = 'No key levels details available'
+NO_SUMMARY = 'No summary available'
+NO_CHANGES = 'No previous issue to compare with'
+UNCHANGED = 'No level or section changes since the previous issue'
+FOOTER_TEXT = 'This is an automated summary from your Market Newsletter Aggregator'
+
+
+class CompiledTemplate:
+    """
+    A template parsed into alternating static chunks and slot positions.
+
+    Slots are written as {{ name }} in the source. Slot values are inserted
+    as-is, so callers must pass already-escaped HTML fragments.
+    """
+
+    def __init__(self, source):
+        self.chunks = []
+        self.slots = {}
+        position = 0
+        for match in SLOT_PATTERN.finditer(source):
+            self.chunks.append(source[position:match.start()])
+            self.slots.setdefault(match.group(1), []).append(len(self.chunks))
+            self.chunks.append('')
+            position = match.end()
+        self.chunks.append(source[position:])
+
+    def render(self, values):
+        """
+        Renders the template with a single join.
+
+        Args:
+            values (dict): Mapping of slot name to HTML fragment
+
+        Returns:
+            str: The rendered document
+        """
+        parts = list(self.chunks)
+        for name, indexes in self.slots.items():
+            value = values.get(name, '')
+            for index in indexes:
+                parts[index] = value
+        return ''.join(parts)
+
+
+COMPILED_EMAIL_TEMPLATE = CompiledTemplate(EMAIL_TEMPLATE)
+
+
+# Display names of the sections a level_diff can list as changed
+SECTION_TITLES = {
+    'market_summary': 'Market Summary',
+    'trading_plan': 'Trading Plan',
+    'plan_summary': 'Plan Summary',
+    'key_levels': 'Key Levels Detail',
+}
+
+# (level_diff key, label) in display order
+LEVEL_CHANGES = (('added', 'Added'), ('dropped', 'Dropped'), ('upgraded', 'Now major'), ('downgraded', 'No longer major'))
+
+
+def build_summary_model(structured, timing_detail=None, event_days=None, level_diff=None):
+    """
+    Converts a persisted structured parse result (see email_parser.build_structured_summary)
+    into the data both renderers work from. No text is re-parsed here.
+
+    Args:
+        structured (dict): The parsed_sections.structured_summary value
+        timing_detail (str, optional): The timing detail sentence
+        event_days (list, optional): Structured upcoming event days
+        level_diff (dict, optional): The parsed_sections.level_diff value (see issue_diff.py)
+
+    Returns:
+        dict: Structured summary data
+    """
+    structured = structured or {}
+    key_levels_raw = []
+    for level in structured.get('key_levels_raw', []):
+        if level.get('vdline'):
+            key_levels_raw.append(f"{level['price']} [{level['vdline']}]")
+        else:
+            key_levels_raw.append(level['price'])
+
+    return {
+        'timing_detail': timing_detail or NO_TIMING,
+        'event_days': event_days or [],
+        'key_levels_raw': key_levels_raw,
+        'key_levels_detail': [(price, note) for price, note in structured.get('key_levels_detail', [])],
+        'market_summary': structured.get('market_summary', ''),
+        'trading_plan': structured.get('trading_plan', ''),
+        'plan_summary': structured.get('plan_summary', ''),
+        'level_diff': level_diff
+    }
+
+
+def _render_events_html(event_days):
+    """Renders the upcoming events as a list with day headers highlighted."""
+    if not event_days:
+        return f'<p>{NO_EVENTS}</p>'
+    escape = html.escape
+    parts = ['<ul class="events-list">']
+    for index, day in enumerate(event_days):
+        if index:  # Add spacing between days
+            parts.append('<li style="height: 10px;"></li>')
+        parts.append(f'<li class="event-day">{escape(day["header"])}</li>')
+        for event in day['events']:
+            parts.append(f'<li class="event-item">{escape(event["time"])} - {escape(event["event"])}</li>')
+    parts.append('</ul>')
+    return ''.join(parts)
+
+
+def _render_key_levels_raw_html(levels):
+    """Renders the key prices one per line."""
+    if not levels:
+        return NO_KEY_LEVELS
+    return ''.join([f'{html.escape(level)}<br>' for level in levels])
+
+
+def _render_key_levels_detail_html(details):
+    """Renders (price, note) pairs with the price in bold."""
+    if not details:
+        return f'<p>{NO_KEY_LEVELS_DETAIL}</p>'
+    escape = html.escape
+    return ''.join([f'<p><strong>{escape(price)}:</strong> {escape(note)}</p>' for price, note in details])
+
+
+def _render_summary_html(market_summary, trading_plan, plan_summary):
+    """Renders the market summary followed by the trading plan and plan summary, if any."""
+    if not market_summary and not trading_plan and not plan_summary:
+        return f'<p>{NO_SUMMARY}</p>'
+    parts = [f'<div>{html.escape(market_summary)}</div>']
+    if trading_plan:
+        parts.append('<div class="section-subtitle">Trading Plan</div>')
+        parts.append(f'<div class="trading-plan">{html.escape(trading_plan)}</div>')
+    if plan_summary:
+        parts.append('<div class="section-subtitle">Plan Summary</div>')
+        parts.append(f'<div class="trading-plan">{html.escape(plan_summary)}</div>')
+    return ''.join(parts)
+
+
+def _render_changes_html(level_diff):
+    """Renders the level changes and the changed-section diffs."""
+    if not level_diff or not level_diff.get('previous_id'):
+        return f'<p>{NO_CHANGES}</p>'
+    escape = html.escape
+    parts = []
+    for key, label in LEVEL_CHANGES:
+        if level_diff.get(key):
+            parts.append(f'<p><strong>{label}:</strong> {escape(", ".join(level_diff[key]))}</p>')
+    for column, lines in (level_diff.get('changed_sections') or {}).items():
+        parts.append(f'<div class="section-subtitle">{escape(SECTION_TITLES.get(column, column))} changed</div>')
+        if lines:
+            parts.append(f'<div class="section-diff">{escape(chr(10).join(lines))}</div>')
+    return ''.join(parts) or f'<p>{UNCHANGED}</p>'
+
+
+def render_html(model):
+    """
+    Renders the HTML email body from structured summary data.
+
+    Args:
+        model (dict): Output of build_summary_model
+
+    Returns:
+        str: The HTML document
+    """
+    return COMPILED_EMAIL_TEMPLATE.render({
+        'timing_detail': html.escape(model['timing_detail']),
+        'upcoming_events': _render_events_html(model['event_days']),
+        'key_levels_raw': _render_key_levels_raw_html(model['key_levels_raw']),
+        'key_levels': _render_key_levels_detail_html(model['key_levels_detail']),
+        'changes': _render_changes_html(model.get('level_diff')),
+        'summary': _render_summary_html(model['market_summary'], model['trading_plan'], model['plan_summary'])
+    })
+
+
+def render_text(model):
+    """
+    Renders the plain-text email body from the same structured summary data.
+
+    Args:
+        model (dict): Output of build_summary_model
+
+    Returns:
+        str: The plain-text body
+    """
+    parts = ['Market Newsletter Summary', '', 'Market Timing:', model['timing_detail'], '']
+
+    parts.append('Upcoming Market Events:')
+    if model['event_days']:
+        for day in model['event_days']:
+            parts.append(day['header'])
+            parts.extend(f"{event['time']} - {event['event']}" for event in day['events'])
+            parts.append('')
+    else:
+        parts.extend([NO_EVENTS, ''])
+
+    parts.append('Key Levels:')
+    parts.extend(model['key_levels_raw'] or [NO_KEY_LEVELS])
+    parts.append('')
+
+    parts.append('Key Levels Detail:')
+    if model['key_levels_detail']:
+        parts.extend(f'{price}: {note}' for price, note in model['key_levels_detail'])
+    else:
+        parts.append(NO_KEY_LEVELS_DETAIL)
+    parts.append('')
+
+    parts.append('Changes Since Previous Issue:')
+    level_diff = model.get('level_diff')
+    if not level_diff or not level_diff.get('previous_id'):
+        parts.append(NO_CHANGES)
+    else:
+        changes = [f"{label}: {', '.join(level_diff[key])}" for key, label in LEVEL_CHANGES if level_diff.get(key)]
+        for column, lines in (level_diff.get('changed_sections') or {}).items():
+            changes.append(f"{SECTION_TITLES.get(column, column)} changed")
+            changes.extend(lines)
+        parts.extend(changes or [UNCHANGED])
+    parts.append('')
+
+    parts.append('Market Summary:')
+    parts.append(model['market_summary'] or NO_SUMMARY)
+    if model['trading_plan']:
+        parts.extend(['', 'Trading Plan:', model['trading_plan']])
+    if model['plan_summary']:
+        parts.extend(['', 'Plan Summary:', model['plan_summary']])
+
+    parts.extend(['', '--', FOOTER_TEXT])
+    return '\n'.join(parts)
+
+
+def render_summary_email(model):
+    """
+    Renders both email bodies from structured summary data.
+
+    Returns:
+        tuple: (html_content, text_content)
+    """
+    return render_html(model), render_text(model)
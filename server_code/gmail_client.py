@@ -7,13 +7,33 @@ It uses Anvil secrets for credentials/configuration to authenticate and fetch th
 
 import base64
 import datetime
+import threading
 from email.utils import parsedate_to_datetime
 
 import anvil.secrets
+import anvil.server
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 
+from metrics import increment
+
+
+_calls_lock = threading.Lock()
+_calls_made = 0
+
+
+def _count_call():
+    global _calls_made
+    with _calls_lock:
+        _calls_made += 1
+    increment('gmail.calls')
+
+
+def calls_made():
+    """Returns the number of Gmail API requests made by this server process."""
+    return _calls_made
+
 
 def find_body(payload):
     """Recursively search the payload for a body with data."""
@@ -53,63 +73,127 @@ def get_gmail_service():
         raise
 
 
-def _get_latest_newsletter():
+def _default_query():
+    """Recent mail from the newsletter_sender_email secret."""
+    sender_email = anvil.secrets.get_secret('newsletter_sender_email')
+    print(f"Looking for emails from: {sender_email}")
+
+    # Search for the most recent email from the sender within last 24 hours
+    return f"from:{sender_email} newer_than:2d"
+
+
+def get_latest_message_id(query=None, service=None):
+    """
+    Returns the ID of the newest message matching the query without fetching it.
+
+    Asks the list endpoint for message IDs only, so the response is a few bytes
+    regardless of the size of the email.
+
+    Args:
+        query (str, optional): Gmail search query; defaults to recent mail from the sender
+        service (optional): An existing Gmail service to reuse
+
+    Returns:
+        str: The Gmail message ID, or None if no message matches
+    """
+    if query is None:
+        query = _default_query()
+    service = service or get_gmail_service()
+    print(f"Executing minimal Gmail API query: {query}")
+    results = service.users().messages().list(
+        userId='me', q=query, maxResults=1, fields='messages/id'
+    ).execute()
+    _count_call()
+    messages = results.get('messages', [])
+    return messages[0]['id'] if messages else None
+
+
+def get_message_date(message_id, service=None):
+    """
+    Returns a message's Gmail internalDate without fetching its content.
+
+    The list endpoint only returns message IDs, so this asks the get endpoint
+    for the internalDate field alone (format='minimal').
+
+    Args:
+        message_id (str): Gmail message ID
+        service (optional): An existing Gmail service to reuse
+
+    Returns:
+        int: internalDate in epoch milliseconds, or None if Gmail has none
+    """
+    service = service or get_gmail_service()
+    msg = service.users().messages().get(
+        userId='me', id=message_id, format='minimal', fields='internalDate'
+    ).execute()
+    _count_call()
+    return int(msg['internalDate']) if msg.get('internalDate') else None
+
+
+def _fetch_newsletter(service, message_id):
+    """Downloads one message and returns it in the newsletter dictionary format."""
+    msg = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+    _count_call()
+    increment('gmail.bytes', msg.get('sizeEstimate', 0))
+    headers = msg['payload'].get('headers', [])
+    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
+    date_str = next((h['value'] for h in headers if h['name'].lower() == 'date'), None)
+
+    if not date_str:
+        print("No date found in email.")
+        return None
+
+    try:
+        news_timestamp = parsedate_to_datetime(date_str)
+    except Exception as e:
+        print("Error parsing date, using raw date:", e)
+        news_timestamp = date_str
+
+    body = find_body(msg['payload'])
+    if body is None:
+        print("Could not extract email body")
+        return None
+
+    # Return a dictionary consistent with our earlier design
+    return {
+        'received_date': news_timestamp.isoformat() if hasattr(news_timestamp, 'isoformat') else news_timestamp,
+        'subject': subject,
+        'raw_body': body,
+        'message_id': msg.get('id', message_id),
+        'internal_date': int(msg['internalDate']) if msg.get('internalDate') else None
+    }
+
+
+def _get_latest_newsletter(query=None, message_id=None):
     """Synchronous helper function to retrieve the latest newsletter from Gmail."""
     try:
         print("Starting newsletter retrieval process")
-        sender_email = anvil.secrets.get_secret('newsletter_sender_email')
-        print(f"Looking for emails from: {sender_email}")
-
         print("Getting Gmail service...")
         service = get_gmail_service()
-        print("Gmail service obtained, executing search query...")
-
-        # Search for the most recent email from the sender within last 24 hours
-        query = f"from:{sender_email} newer_than:2d"
-        print(f"Executing Gmail API query: {query}")
-        results = service.users().messages().list(userId='me', q=query, maxResults=1).execute()
-        print("Search query completed")
 
-        messages = results.get('messages', [])
-        if not messages:
-            print("No emails found from the specified sender")
-            return None
+        if message_id is None:
+            print("Gmail service obtained, executing search query...")
+            message_id = get_latest_message_id(query, service)
+            print("Search query completed")
+            if message_id is None:
+                print("No emails found from the specified sender")
+                return None
 
         # Get the full email content
-        msg = service.users().messages().get(userId='me', id=messages[0]['id'], format='full').execute()
-        headers = msg['payload'].get('headers', [])
-        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-        date_str = next((h['value'] for h in headers if h['name'].lower() == 'date'), None)
-
-        if not date_str:
-            print("No date found in email.")
-            return None
-
-        try:
-            news_timestamp = parsedate_to_datetime(date_str)
-        except Exception as e:
-            print("Error parsing date, using raw date:", e)
-            news_timestamp = date_str
-
-        body = find_body(msg['payload'])
-        if body is None:
-            print("Could not extract email body")
-            return None
-
-        # Return a dictionary consistent with our earlier design
-        return {
-            'received_date': news_timestamp.isoformat() if hasattr(news_timestamp, 'isoformat') else news_timestamp,
-            'subject': subject,
-            'raw_body': body
-        }
+        return _fetch_newsletter(service, message_id)
     except Exception as e:
         print("Error retrieving newsletter: " + str(e))
         raise
 
 @anvil.server.callable
-def get_latest_newsletter():
+def get_latest_newsletter(query=None, message_id=None):
     """
     Retrieves the latest newsletter email from Gmail.
-    Returns a dictionary with keys: received_date, subject, and raw_body.
+    Uses the given Gmail search query, or recent mail from the
+    newsletter_sender_email secret if none is given. When message_id is
+    given (e.g., from get_latest_message_id), that message is fetched directly.
+    Returns a dictionary with keys: received_date, subject, raw_body,
+    message_id and internal_date (epoch milliseconds).
     """
-    return _get_latest_newsletter() 
\ No newline at end of file
+    return _get_latest_newsletter(query, message_id)
+ 
\ No newline at end of file
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+ingestion_scheduler.py
+Adaptive polling schedule for newsletter sources.
+
+Instead of running at fixed times, a short scheduled tick (ingestion_tick)
+decides per source whether Gmail is worth asking. Each source's arrival window
+is learned from the received_date of its stored newsletters: the 10th to 95th
+percentile of arrival time of day (US Central), widened by a margin, on the
+weekdays newsletters have actually arrived. Until the day's newsletter has been
+processed, a source is polled densely inside its window (IN_WINDOW_POLLS polls
+spread over it, at least MIN_POLL_MINUTES apart) and with exponential backoff
+outside it (BACKOFF_START_MINUTES, doubling up to BACKOFF_MAX_MINUTES), so a
+late newsletter is still picked up the same day. Once it has been processed,
+the source is not polled again until its next window opens.
+
+A poll that finds nothing costs one Gmail request (the pre-check in
+message_ledger lists a single message ID); a new message costs FETCH_CALLS
+more (its internalDate, then the email). Requests are counted as they are made (gmail_client.calls_made), and a
+source makes at most MAX_CALLS_PER_DAY a day: a poll is only started while the
+day's count leaves room for it and for fetching what it may find.
+
+Schedule state lives in the ingestionschedule table, one row per source.
+"""
+
+import math
+from datetime import datetime, time, timedelta
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from trading_calendar import CENTRAL
+from sources import get_sources
+from gmail_client import calls_made
+from main import process_source
+from metrics import flush as flush_metrics
+
+
+# Arrival-window learning
+MIN_SAMPLES = 5
+MAX_SAMPLES = 60
+WINDOW_PERCENTILES = (10, 95)
+WINDOW_MARGIN_MINUTES = 20
+RELEARN_HOURS = 24
+
+# Used until a source has MIN_SAMPLES newsletters (around the old 23:00 UTC runs)
+DEFAULT_WINDOW = {'start_minute': 15 * 60, 'end_minute': 19 * 60, 'weekdays': [0, 1, 2, 3, 4], 'samples': 0}
+
+# Gmail requests per source per day, and what a poll and a fetch cost
+MAX_CALLS_PER_DAY = 10
+POLL_CALLS = 1
+FETCH_CALLS = 2
+
+# Dense polling inside the window (ingestion_tick runs every 5 minutes)
+IN_WINDOW_POLLS = 6
+MIN_POLL_MINUTES = 5
+
+# Exponential backoff outside the window
+BACKOFF_START_MINUTES = 30
+BACKOFF_MAX_MINUTES = 8 * 60
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def learn_arrival_window(arrivals):
+    """
+    Learns the daily arrival window from past arrival times.
+
+    Args:
+        arrivals (list): Timezone-aware datetimes when newsletters were received
+
+    Returns:
+        dict: {'start_minute', 'end_minute' (minutes past midnight Central),
+               'weekdays' (0=Monday), 'samples'}; DEFAULT_WINDOW if there are
+               fewer than MIN_SAMPLES arrivals
+    """
+    local = [moment.astimezone(CENTRAL) for moment in arrivals]
+    if len(local) < MIN_SAMPLES:
+        return dict(DEFAULT_WINDOW)
+    minutes = sorted(moment.hour * 60 + moment.minute for moment in local)
+    low, high = WINDOW_PERCENTILES
+    return {
+        'start_minute': max(0, _percentile(minutes, low) - WINDOW_MARGIN_MINUTES),
+        'end_minute': min(24 * 60 - 1, _percentile(minutes, high) + WINDOW_MARGIN_MINUTES),
+        'weekdays': sorted({moment.weekday() for moment in local}),
+        'samples': len(local)
+    }
+
+
+def _at_minute(day, minute):
+    return CENTRAL.localize(datetime.combine(day, time(minute // 60, minute % 60)))
+
+
+def _next_midnight(now):
+    local = now.astimezone(CENTRAL)
+    return CENTRAL.localize(datetime.combine(local.date() + timedelta(days=1), time(0, 0)))
+
+
+def in_window(window, moment):
+    """Returns True if moment falls inside the window on one of its weekdays."""
+    local = moment.astimezone(CENTRAL)
+    minute = local.hour * 60 + local.minute
+    return local.weekday() in window['weekdays'] and window['start_minute'] <= minute <= window['end_minute']
+
+
+def next_window_start(window, moment):
+    """Returns the first window opening strictly after moment."""
+    local_day = moment.astimezone(CENTRAL).date()
+    for offset in range(8):
+        day = local_day + timedelta(days=offset)
+        if day.weekday() in window['weekdays']:
+            start = _at_minute(day, window['start_minute'])
+            if start > moment:
+                return start
+    return _at_minute(local_day + timedelta(days=7), window['start_minute'])
+
+
+def in_window_interval(window):
+    """Minutes between polls inside the window, so IN_WINDOW_POLLS polls span it."""
+    length = window['end_minute'] - window['start_minute']
+    return max(MIN_POLL_MINUTES, math.ceil(length / (IN_WINDOW_POLLS - 1)))
+
+
+def backoff_minutes(empty_polls):
+    """Minutes until the next poll outside the window after empty_polls empty polls in a row."""
+    return min(BACKOFF_MAX_MINUTES, BACKOFF_START_MINUTES * 2 ** max(0, empty_polls - 1))
+
+
+def can_poll(calls_today):
+    """Returns True if a poll, and the fetch it may lead to, fit in today's call ceiling."""
+    return calls_today + POLL_CALLS + FETCH_CALLS <= MAX_CALLS_PER_DAY
+
+
+def plan_next_poll(window, now, found_today, calls_today, empty_polls):
+    """
+    Decides when a source should next be polled, after a poll at now.
+
+    Args:
+        window (dict): The learned arrival window
+        now (datetime): Timezone-aware current time
+        found_today (bool): Today's newsletter has already been processed
+        calls_today (int): Gmail requests made for the source today
+        empty_polls (int): Empty polls in a row outside the window (0 after
+                           a poll inside it)
+
+    Returns:
+        datetime: When to poll next
+    """
+    if found_today or not can_poll(calls_today):
+        return next_window_start(window, _next_midnight(now) - timedelta(seconds=1))
+    if in_window(window, now):
+        return now + timedelta(minutes=in_window_interval(window))
+    return min(now + timedelta(minutes=backoff_minutes(empty_polls)), next_window_start(window, now))
+
+
+def _source_arrivals(source):
+    """Returns the most recent arrival times of a source's stored newsletters."""
+    source_names = [source.name, None] if source.is_default else [source.name]
+    arrivals = []
+    for name in source_names:
+        for row in app_tables.newsletters.search(q.fetch_only("received_date"), source=name):
+            try:
+                arrivals.append(datetime.fromisoformat(row['received_date']))
+            except (TypeError, ValueError):
+                continue
+    arrivals = [moment for moment in arrivals if moment.tzinfo is not None]
+    return sorted(arrivals)[-MAX_SAMPLES:]
+
+
+def _latest_arrival_date(source):
+    """Returns the Central date on which the source's newest stored newsletter arrived."""
+    rows = app_tables.newsletters.search(
+        tables.order_by("newsletter_id", ascending=False),
+        q.fetch_only("received_date"),
+        source=source.name
+    )
+    for row in rows:
+        try:
+            return datetime.fromisoformat(row['received_date']).astimezone(CENTRAL).date()
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def _get_state(source, now):
+    """Returns the source's schedule row, relearning its window when stale."""
+    row = app_tables.ingestionschedule.get(source=source.name)
+    if row is None:
+        row = app_tables.ingestionschedule.add_row(
+            source=source.name, next_poll=None, calls_today=0, calls_date=None, empty_polls=0,
+            last_found=None, window=None, learned_at=None
+        )
+    if row['learned_at'] is None or now - row['learned_at'] > timedelta(hours=RELEARN_HOURS):
+        row.update(window=learn_arrival_window(_source_arrivals(source)), learned_at=now)
+    return row
+
+
+def poll_source_if_due(source, now=None):
+    """
+    Polls one source if its schedule says it is due.
+
+    Returns:
+        str: The process_source status, or None if the source was not polled
+    """
+    now = now or datetime.now(CENTRAL)
+    state = _get_state(source, now)
+    window = state['window'] or DEFAULT_WINDOW
+    if state['next_poll'] is None and not in_window(window, now):
+        # First tick for this source: wait for its window to open
+        state.update(next_poll=next_window_start(window, now))
+        return None
+    if state['next_poll'] is not None and now < state['next_poll']:
+        return None
+
+    today = now.astimezone(CENTRAL).date()
+    calls_today = state['calls_today'] if state['calls_date'] == today else 0
+    if not can_poll(calls_today):
+        print(f"[{source.name}] Daily Gmail call ceiling reached ({calls_today}/{MAX_CALLS_PER_DAY})")
+        state.update(next_poll=plan_next_poll(window, now, False, calls_today, 0))
+        return None
+
+    calls_before = calls_made()
+    try:
+        status = process_source(source)
+    except Exception as e:
+        # A failed run is resumed by the next poll
+        print(f"Error polling newsletter source '{source.name}': {str(e)}")
+        status = 'failed'
+    calls_today += max(POLL_CALLS, calls_made() - calls_before)
+    # A late newsletter from an earlier day found today does not end today's polling
+    found = status == 'completed' and _latest_arrival_date(source) == today
+    last_found = now if found else state['last_found']
+    found_today = last_found is not None and last_found.astimezone(CENTRAL).date() == today
+    empty_polls = 0 if found or in_window(window, now) else (state['empty_polls'] or 0) + 1
+    next_poll = plan_next_poll(window, now, found_today, calls_today, empty_polls)
+    state.update(
+        next_poll=next_poll,
+        calls_today=calls_today,
+        calls_date=today,
+        empty_polls=empty_polls,
+        last_found=last_found,
+        # A new arrival refines the window on the next tick
+        learned_at=None if status == 'completed' else state['learned_at']
+    )
+    print(f"[{source.name}] Poll status {status}; next poll at {next_poll.isoformat()}")
+    return status
+
+
+@anvil.server.background_task
+def ingestion_tick():
+    """
+    Scheduled every few minutes; polls the sources whose schedule is due.
+    """
+    now = datetime.now(CENTRAL)
+    statuses = {}
+    for source in get_sources():
+        status = poll_source_if_due(source, now)
+        if status is not None:
+            statuses[source.name] = status
+    # One write for the tick's pre-check counters and other metrics
+    flush_metrics()
+    return statuses
+
+
+@anvil.server.callable
+def get_ingestion_schedule():
+    """
+    Returns each source's learned arrival window and polling state.
+
+    Returns:
+        dict: {source: {'window', 'next_poll', 'calls_today', 'last_found'}}
+    """
+    return {
+        row['source']: {
+            'window': row['window'],
+            'next_poll': row['next_poll'],
+            'calls_today': row['calls_today'],
+            'last_found': row['last_found']
+        }
+        for row in app_tables.ingestionschedule.search()
+    }
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+issue_diff.py
+What changed since the previous issue of a source.
+
+For every issue a snapshot is stored in the levelsnapshots table: its levels
+as a price-sorted list of {price, label, major, type} and a SHA-256 hash per
+parsed section. Diffing an issue against the previous one then needs only
+the previous snapshot, not the previous newsletter:
+  - levels are compared with a sorted merge that treats prices within
+    LEVEL_TOLERANCE points as the same level, giving the added, dropped,
+    upgraded (tagged major) and downgraded levels;
+  - sections are compared by hash, and only the changed ones are text-diffed,
+    against the previous issue's parsed_sections text.
+The diff is stored on the issue's parsed_sections row (level_diff), where the
+summary email and the AllLines view read it with the rest of the row.
+"""
+
+import difflib
+import hashlib
+from datetime import datetime
+
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from level_analytics import invalidate_level_analytics
+from metrics import CountingTables
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+# Prices closer than this are the same level (e.g., "5700" and "5700-05")
+LEVEL_TOLERANCE = 3
+
+# parsed_sections column -> parse_email key of the sections that are hashed and diffed
+SECTION_FIELDS = {
+    'market_summary': "MarketSummary",
+    'trading_plan': "TradingPlan",
+    'plan_summary': "PlanSummary",
+    'key_levels': "KeyLevels",
+}
+
+# Changed lines kept per section
+MAX_DIFF_LINES = 40
+
+
+def level_snapshot(parsed_data):
+    """
+    Builds the level set of an issue from its parse result: the Trading Plan
+    supports and resistances, plus the Key Levels Detail levels that do not
+    match one of them.
+
+    Returns:
+        list: {'price', 'label', 'major', 'type'} dicts sorted by price
+    """
+    levels = []
+    trading_plan_levels = parsed_data.get("TradingPlanKeyLevels") or {}
+    for level in trading_plan_levels.get('supports', []) + trading_plan_levels.get('resistances', []):
+        levels.append({
+            'price': float(level.get('price', 0)),
+            'label': level.get('price_with_range') or str(level.get('price')),
+            'major': level.get('severity') == 'Major',
+            'type': level.get('type')
+        })
+    for detail in parsed_data.get("KeyLevelsDetail") or []:
+        price = float(detail.get('price', 0))
+        if all(abs(price - level['price']) > LEVEL_TOLERANCE for level in levels):
+            levels.append({
+                'price': price,
+                'label': detail.get('price_with_range') or str(detail.get('price')),
+                'major': False,
+                'type': 'key_level'
+            })
+    levels.sort(key=lambda level: level['price'])
+    return levels
+
+
+def section_hashes(parsed_data):
+    """Returns {parsed_sections column: SHA-256 hex} for the diffed sections."""
+    return {
+        column: hashlib.sha256((parsed_data.get(key) or '').encode('utf-8')).hexdigest()
+        for column, key in SECTION_FIELDS.items()
+    }
+
+
+def merge_levels(previous, current, tolerance=LEVEL_TOLERANCE):
+    """
+    Compares two price-sorted level lists in one merge pass.
+
+    Returns:
+        dict: 'added', 'dropped', 'upgraded' and 'downgraded' lists of labels
+    """
+    delta = {'added': [], 'dropped': [], 'upgraded': [], 'downgraded': []}
+    i = j = 0
+    while i < len(previous) and j < len(current):
+        before, after = previous[i], current[j]
+        if abs(before['price'] - after['price']) <= tolerance:
+            if after['major'] and not before['major']:
+                delta['upgraded'].append(after['label'])
+            elif before['major'] and not after['major']:
+                delta['downgraded'].append(after['label'])
+            i += 1
+            j += 1
+        elif before['price'] < after['price']:
+            delta['dropped'].append(before['label'])
+            i += 1
+        else:
+            delta['added'].append(after['label'])
+            j += 1
+    delta['dropped'].extend(level['label'] for level in previous[i:])
+    delta['added'].extend(level['label'] for level in current[j:])
+    return delta
+
+
+def diff_text(before, after):
+    """Returns the added ('+ ...') and removed ('- ...') lines between two texts."""
+    lines = [
+        line for line in difflib.unified_diff((before or '').splitlines(), (after or '').splitlines(), n=0, lineterm='')
+        if line[:1] in '+-' and not line.startswith(('+++', '---'))
+    ]
+    return [f"{line[0]} {line[1:]}" for line in lines[:MAX_DIFF_LINES]]
+
+
+def _previous_snapshot(source_name, newsletter_id):
+    rows = app_tables.levelsnapshots.search(
+        tables.order_by("newsletter_id", ascending=False),
+        source=source_name,
+        newsletter_id=q.less_than(newsletter_id)
+    )
+    for row in rows:
+        return row
+    return None
+
+
+def store_snapshot(source_name, newsletter_id, levels, hashes):
+    """Adds or replaces an issue's snapshot (and drops the level analytics cached over its date)."""
+    invalidate_level_analytics(source_name, newsletter_id)
+    row = app_tables.levelsnapshots.get(newsletter_id=newsletter_id)
+    if row is not None:
+        row.update(source=source_name, levels=levels, section_hashes=hashes)
+    else:
+        app_tables.levelsnapshots.add_row(
+            newsletter_id=newsletter_id,
+            source=source_name,
+            levels=levels,
+            section_hashes=hashes,
+            created=datetime.now()
+        )
+
+
+def compute_issue_diff(source_name, newsletter_id, parsed_data):
+    """
+    Snapshots an issue and diffs it against the source's previous issue.
+
+    Args:
+        source_name (str): Newsletter source name
+        newsletter_id (str): The issue
+        parsed_data (dict): parse_email result for the issue
+
+    Returns:
+        dict: 'previous_id' (None for a source's first issue), the merge_levels
+              lists, and 'changed_sections' ({column: diff lines})
+    """
+    levels = level_snapshot(parsed_data)
+    hashes = section_hashes(parsed_data)
+    store_snapshot(source_name, newsletter_id, levels, hashes)
+
+    previous = _previous_snapshot(source_name, newsletter_id)
+    if previous is None:
+        return {'previous_id': None, 'added': [], 'dropped': [], 'upgraded': [], 'downgraded': [], 'changed_sections': {}}
+
+    diff = merge_levels(previous['levels'] or [], levels)
+    diff['previous_id'] = previous['newsletter_id']
+    previous_hashes = previous['section_hashes'] or {}
+    changed = [column for column in SECTION_FIELDS if previous_hashes.get(column) != hashes[column]]
+    diff['changed_sections'] = {}
+    if changed:
+        previous_sections = app_tables.parsed_sections.get(newsletter_id=previous['newsletter_id'])
+        for column in changed:
+            before = previous_sections[column] if previous_sections else ''
+            diff['changed_sections'][column] = diff_text(before, parsed_data.get(SECTION_FIELDS[column]))
+    return diff
+
+
+def store_issue_diff(newsletter_id, diff):
+    """Stores a diff on the issue's parsed_sections row."""
+    row = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
+    if row is not None:
+        row['level_diff'] = diff
+
+
+def forget_snapshot(newsletter_id):
+    """Deletes an issue's snapshot (e.g., when the newsletter is deleted)."""
+    row = app_tables.levelsnapshots.get(newsletter_id=newsletter_id)
+    if row is not None:
+        invalidate_level_analytics(row['source'], newsletter_id)
+        row.delete()
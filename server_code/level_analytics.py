@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+level_analytics.py
+Historical level-frequency analytics over the levelsnapshots history.
+
+The levels of every issue in a date range are loaded once into flat NumPy
+arrays (one entry per level: issue index, price, major flag), and everything
+else is computed in vectorized passes over them:
+  - a frequency histogram of BIN_WIDTH-point price bins: in how many issues
+    each bin appears and in how many it is tagged major;
+  - recurrence streaks: the longest and the current run of consecutive issues
+    in which each bin appears;
+  - vdline proximity: the distance from each level to the nearest vdline
+    (binary search over the sorted vdline prices), summarized per bin and
+    overall, split by major and other levels.
+
+Ten years of daily issues with dozens of levels each is ~100k array entries,
+which NumPy handles in milliseconds; reading the snapshot rows is what costs.
+Results are therefore cached in the levelanalytics table per (source, date
+range, bin width). Storing or deleting a snapshot deletes the cached ranges
+that contain its date, and adding vdlines clears the cache; entries from
+another ANALYTICS_VERSION are misses.
+
+NumPy is optional for the rest of the app: without it, the analytics
+callables raise and nothing else is affected. Snapshots of issues received
+before the levelsnapshots table existed are backfilled by reparse_all.
+"""
+
+from datetime import datetime
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from email_parser import load_vdlines
+from sources import DEFAULT_SOURCE_NAME
+from metrics import CountingTables, timed
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+# Bump whenever the shape or meaning of the results changes, so cached results are redone
+ANALYTICS_VERSION = 1
+
+DEFAULT_BIN_WIDTH = 5
+
+# Same match distance as find_nearest_vdline
+VDLINE_DISTANCE = 3
+
+# Upper edges of the distance histogram buckets (the last bucket is open)
+DISTANCE_EDGES = (1, 2, 3, 5, 10, 25)
+
+# Date range bounds used when a caller leaves one open
+OPEN_START = '00000000'
+OPEN_END = '99991231'
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("Level analytics need the numpy package")
+
+
+def _date_key(value, default):
+    """Normalizes a date, datetime, 'YYYY-MM-DD' or 'YYYYMMDD' to 'YYYYMMDD'."""
+    if value is None or value == '':
+        return default
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y%m%d')
+    digits = str(value).replace('-', '')
+    if len(digits) != 8 or not digits.isdigit():
+        raise ValueError(f"Expected a date or YYYYMMDD, got {value!r}")
+    return digits
+
+
+def _id_range(start_date, end_date):
+    """Data Tables condition for newsletter_ids dated start_date..end_date (inclusive)."""
+    # "20250211-spx" sorts after "20250211", so the upper bound is the next date string
+    return q.between(start_date, str(int(end_date) + 1), min_inclusive=True, max_inclusive=False)
+
+
+@timed('analytics.load')
+def load_level_history(source_name, start_date=OPEN_START, end_date=OPEN_END):
+    """
+    Loads the levels of a source's issues in a date range.
+
+    Args:
+        source_name (str): Newsletter source name
+        start_date (str): First date, YYYYMMDD
+        end_date (str): Last date, YYYYMMDD
+
+    Returns:
+        tuple: (newsletter_ids in date order, issue index per level (int32),
+                price per level (float64), major flag per level (bool))
+    """
+    _require_numpy()
+    rows = app_tables.levelsnapshots.search(
+        q.fetch_only("newsletter_id", "levels"),
+        tables.order_by("newsletter_id"),
+        source=source_name,
+        newsletter_id=_id_range(start_date, end_date)
+    )
+    newsletter_ids = []
+    issues, prices, majors = [], [], []
+    for index, row in enumerate(rows):
+        newsletter_ids.append(row['newsletter_id'])
+        for level in row['levels'] or []:
+            issues.append(index)
+            prices.append(level['price'])
+            majors.append(bool(level.get('major')))
+    return (
+        newsletter_ids,
+        np.array(issues, dtype=np.int32),
+        np.array(prices, dtype=np.float64),
+        np.array(majors, dtype=bool)
+    )
+
+
+def _vdline_distances(prices, vdline_prices):
+    """Distance from each price to the nearest vdline (NaN when there are no vdlines)."""
+    if not len(vdline_prices):
+        return np.full(prices.shape, np.nan)
+    vdline_prices = np.sort(np.asarray(vdline_prices, dtype=np.float64))
+    position = np.searchsorted(vdline_prices, prices)
+    below = vdline_prices[np.clip(position - 1, 0, len(vdline_prices) - 1)]
+    above = vdline_prices[np.clip(position, 0, len(vdline_prices) - 1)]
+    return np.minimum(np.abs(prices - below), np.abs(prices - above))
+
+
+def _rate(numerator, denominator):
+    return float(numerator) / float(denominator) if denominator else None
+
+
+def _proximity_summary(distances, majors):
+    """Overall vdline proximity statistics of the levels."""
+    if not len(distances) or np.isnan(distances).all():
+        return None
+    near = distances <= VDLINE_DISTANCE
+    counts, _ = np.histogram(distances, bins=(0,) + DISTANCE_EDGES + (np.inf,))
+    labels = [f"<{edge}" for edge in DISTANCE_EDGES] + [f">={DISTANCE_EDGES[-1]}"]
+    return {
+        'max_distance': VDLINE_DISTANCE,
+        'near_rate': _rate(near.sum(), len(near)),
+        'major_near_rate': _rate(near[majors].sum(), majors.sum()),
+        'other_near_rate': _rate(near[~majors].sum(), (~majors).sum()),
+        'median_distance': float(np.median(distances)),
+        'distance_histogram': dict(zip(labels, (int(count) for count in counts)))
+    }
+
+
+@timed('analytics.compute')
+def compute_level_analytics(newsletter_ids, issues, prices, majors, vdline_prices, bin_width=DEFAULT_BIN_WIDTH):
+    """
+    Computes the frequency, streak and vdline statistics of a level history.
+
+    Args:
+        newsletter_ids (list): Issues in date order (from load_level_history)
+        issues, prices, majors (ndarray): Per-level arrays (from load_level_history)
+        vdline_prices (list): vdline prices
+        bin_width (float): Width of a price bin in points
+
+    Returns:
+        dict: 'issues', 'levels', 'bin_width', 'first_id', 'last_id',
+              'vdline_proximity' (overall stats, None without vdlines) and 'bins',
+              one dict per price bin that ever appeared, most frequent first:
+              'price' (bin start), 'issues', 'frequency', 'major', 'major_rate',
+              'longest_streak', 'current_streak', 'last_seen',
+              'vdline_distance' (mean) and 'near_vdline_rate'
+    """
+    _require_numpy()
+    issue_count = len(newsletter_ids)
+    result = {
+        'issues': issue_count,
+        'levels': int(len(prices)),
+        'bin_width': bin_width,
+        'first_id': newsletter_ids[0] if newsletter_ids else None,
+        'last_id': newsletter_ids[-1] if newsletter_ids else None,
+        'vdline_proximity': None,
+        'bins': []
+    }
+    if not len(prices):
+        return result
+
+    bins = np.floor(prices / bin_width).astype(np.int64)
+    first_bin = bins.min()
+    offsets = bins - first_bin
+    bin_count = int(offsets.max()) + 1
+
+    # One appearance per (issue, bin); a bin is major in an issue if any of its levels is
+    pairs, inverse = np.unique(issues.astype(np.int64) * bin_count + offsets, return_inverse=True)
+    pair_major = np.bincount(inverse.ravel(), weights=majors, minlength=len(pairs)) > 0
+    pair_issue = pairs // bin_count
+    pair_bin = pairs % bin_count
+    appearances = np.bincount(pair_bin, minlength=bin_count)
+    major_appearances = np.bincount(pair_bin, weights=pair_major, minlength=bin_count)
+
+    # Runs of consecutive issues per bin, over the appearances sorted by (bin, issue)
+    order = np.lexsort((pair_issue, pair_bin))
+    run_bin = pair_bin[order]
+    run_issue = pair_issue[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (run_bin[1:] != run_bin[:-1]) | (run_issue[1:] != run_issue[:-1] + 1)
+    run_lengths = np.bincount(np.cumsum(starts) - 1)
+    start_index = np.flatnonzero(starts)
+    end_issue = run_issue[np.append(start_index[1:] - 1, len(order) - 1)]
+    longest = np.zeros(bin_count, dtype=np.int64)
+    np.maximum.at(longest, run_bin[starts], run_lengths)
+    current = np.zeros(bin_count, dtype=np.int64)
+    ongoing = end_issue == issue_count - 1
+    current[run_bin[starts][ongoing]] = run_lengths[ongoing]
+    last_seen = np.full(bin_count, -1, dtype=np.int64)
+    np.maximum.at(last_seen, run_bin[starts], end_issue)
+
+    # vdline proximity per level, averaged per bin over all its levels
+    distances = _vdline_distances(prices, vdline_prices)
+    result['vdline_proximity'] = _proximity_summary(distances, majors)
+    level_counts = np.bincount(offsets, minlength=bin_count)
+    if result['vdline_proximity'] is not None:
+        mean_distance = np.bincount(offsets, weights=distances, minlength=bin_count) / np.maximum(level_counts, 1)
+        near_rate = np.bincount(offsets, weights=distances <= VDLINE_DISTANCE, minlength=bin_count) / np.maximum(level_counts, 1)
+
+    seen = np.flatnonzero(appearances)
+    seen = seen[np.lexsort((seen, -appearances[seen]))]
+    result['bins'] = [
+        {
+            'price': float((first_bin + offset) * bin_width),
+            'issues': int(appearances[offset]),
+            'frequency': float(appearances[offset]) / issue_count,
+            'major': int(major_appearances[offset]),
+            'major_rate': float(major_appearances[offset]) / float(appearances[offset]),
+            'longest_streak': int(longest[offset]),
+            'current_streak': int(current[offset]),
+            'last_seen': newsletter_ids[last_seen[offset]],
+            'vdline_distance': float(mean_distance[offset]) if result['vdline_proximity'] else None,
+            'near_vdline_rate': float(near_rate[offset]) if result['vdline_proximity'] else None
+        }
+        for offset in seen
+    ]
+    return result
+
+
+def _cache_key(source_name, start_date, end_date, bin_width):
+    return f"{source_name}:{start_date}:{end_date}:{bin_width}"
+
+
+def _cached(key):
+    row = app_tables.levelanalytics.get(cache_key=key)
+    if row is not None and row['analytics_version'] == ANALYTICS_VERSION:
+        return row['result']
+    return None
+
+
+def _store(key, source_name, start_date, end_date, bin_width, result):
+    row = app_tables.levelanalytics.get(cache_key=key)
+    values = dict(
+        source=source_name,
+        start_date=start_date,
+        end_date=end_date,
+        bin_width=bin_width,
+        analytics_version=ANALYTICS_VERSION,
+        result=result,
+        created=datetime.now()
+    )
+    if row is None:
+        app_tables.levelanalytics.add_row(cache_key=key, **values)
+    else:
+        row.update(**values)
+
+
+@anvil.server.callable
+def get_level_analytics(source=None, start_date=None, end_date=None, bin_width=DEFAULT_BIN_WIDTH, refresh=False):
+    """
+    Returns the level analytics of a source over a date range, from the
+    cache when this range was computed before.
+
+    Args:
+        source (str, optional): Newsletter source name (default source when omitted)
+        start_date (date or str, optional): First date; all history when omitted
+        end_date (date or str, optional): Last date; up to the latest issue when omitted
+        bin_width (float): Width of a price bin in points
+        refresh (bool): Recompute even when a cached result exists
+
+    Returns:
+        dict: compute_level_analytics result, plus 'source', 'start_date' and 'end_date'
+    """
+    _require_numpy()
+    source_name = source or DEFAULT_SOURCE_NAME
+    start_date = _date_key(start_date, OPEN_START)
+    end_date = _date_key(end_date, OPEN_END)
+    key = _cache_key(source_name, start_date, end_date, bin_width)
+    if not refresh:
+        result = _cached(key)
+        if result is not None:
+            return result
+
+    newsletter_ids, issues, prices, majors = load_level_history(source_name, start_date, end_date)
+    vdline_prices = [vdline['price'] for vdline in load_vdlines()]
+    result = compute_level_analytics(newsletter_ids, issues, prices, majors, vdline_prices, bin_width)
+    result.update(source=source_name, start_date=start_date, end_date=end_date)
+    _store(key, source_name, start_date, end_date, bin_width, result)
+    return result
+
+
+@anvil.server.background_task
+def compute_level_analytics_task(source=None, start_date=None, end_date=None, bin_width=DEFAULT_BIN_WIDTH):
+    """Computes and caches a range's analytics (for ranges too long to load within a server call)."""
+    result = get_level_analytics(source, start_date, end_date, bin_width, refresh=True)
+    anvil.server.task_state['issues'] = result['issues']
+    return result
+
+
+@anvil.server.callable
+def launch_level_analytics(source=None, start_date=None, end_date=None, bin_width=DEFAULT_BIN_WIDTH):
+    """Starts compute_level_analytics_task as a background task and returns the task."""
+    return anvil.server.launch_background_task(
+        'compute_level_analytics_task', source, start_date, end_date, bin_width
+    )
+
+
+def invalidate_level_analytics(source_name=None, newsletter_id=None):
+    """
+    Deletes cached results that a changed snapshot or vdline set makes stale.
+
+    Args:
+        source_name (str, optional): Only this source's results
+        newsletter_id (str, optional): Only the ranges containing this issue's date;
+                                       every range when omitted (e.g., vdlines changed)
+
+    Returns:
+        int: Number of cached results deleted
+    """
+    conditions = {}
+    if source_name:
+        conditions['source'] = source_name
+    if newsletter_id:
+        date = newsletter_id[:8]
+        conditions['start_date'] = q.less_than_or_equal_to(date)
+        conditions['end_date'] = q.greater_than_or_equal_to(date)
+    deleted = 0
+    for row in app_tables.levelanalytics.search(**conditions):
+        row.delete()
+        deleted += 1
+    return deleted
@@ -7,11 +7,14 @@ parses its contents, and then stores both raw and parsed data into Anvil Data Ta
 """
 
 import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import anvil.server
 import anvil.tables as tables
 from anvil.tables import app_tables
-from gmail_client import get_latest_newsletter
+from gmail_client import get_gmail_service, get_latest_newsletter, get_latest_message_id, get_message_date
 from email_parser import (
     clean_newsletter,
     parse_email,
@@ -21,92 +24,416 @@ from db_access import (
     insert_newsletter,
     insert_parsed_sections,
     delete_most_recent_records as db_delete_most_recent,
-    extract_and_store_key_levels
+    extract_and_store_key_levels,
+    newsletter_content_hash,
+    update_revised_sections,
+    replace_newsletter_bodies,
+    latest_newsletter_id
 )
-from market_calendar import update_upcoming_events
-from send_summary import send_summary_email
+from market_calendar import store_upcoming_events, get_upcoming_event_days, get_events_label
+from send_summary import send_summary_email, get_structured_summary, render_parsed_summary
+from pipeline import Stage, SkipRun, run_pipeline
+from sources import get_sources, get_source
+from message_ledger import is_processed, record_processed, count_precheck, latest_internal_date
+from metrics import increment, flush as flush_metrics
+from profiling import RunProfiler, store_profile
+from clean_cache import cached_clean
+from body_store import get_bodies, content_hash
+from search_index import index_newsletter
+from near_duplicates import fingerprint as compute_fingerprint, classify, store_fingerprint
+from summary_artifacts import invalidate_artifact
+from issue_diff import compute_issue_diff, store_issue_diff
+import worker_dispatch
+
+
+def fetch_stage(source, message_id):
+    """Retrieves the latest newsletter email for a source from Gmail."""
+    newsletter = get_latest_newsletter(source.query, message_id)
+    if not newsletter:
+        raise SkipRun("No newsletter email found.")
+    print(f"Newsletter retrieved with subject: {newsletter.get('subject')}")
+    return {'newsletter': newsletter}
+
+
+def identify_stage(source, newsletter):
+    """Derives the newsletter_id and stops if this exact email was already processed."""
+    # Convert the ISO format date to the source's YYYYMMDD[-namespace] ID
+    received_date = datetime.fromisoformat(newsletter.get("received_date"))
+    newsletter_id = source.newsletter_id(received_date)
+    print(f"Generated newsletter_id: {newsletter_id}")
+
+    # Skip if the stored newsletter has the same raw body; a different body
+    # under the same ID is a correction, handled by the classify stage
+    if newsletter_content_hash(newsletter_id) == content_hash(newsletter.get("raw_body")):
+        record_processed(source.name, newsletter.get("message_id"), newsletter.get("internal_date"), newsletter_id)
+        raise SkipRun(f"Newsletter '{newsletter_id}' already processed.")
+    return {'newsletter_id': newsletter_id}
+
+
+def clean_stage(source, newsletter):
+    """Cleans the raw newsletter content with the source's cleaning profile
+    (on the Uplink worker when one is connected)."""
+    cleaned_body = worker_dispatch.clean(newsletter.get("raw_body"), source.cleaning_profile)
+    print(f"Cleaned body length: {len(cleaned_body)}")
+    return {'cleaned_body': cleaned_body}
+
+
+# parsed_sections columns that feed the keylevelsraw table
+KEY_LEVEL_COLUMNS = ('key_levels', 'key_levels_raw', 'trading_plan')
+
+
+def revise_newsletter(source, newsletter_id, newsletter, cleaned_body, fingerprint, received_date):
+    """
+    Applies a corrected resend to a stored newsletter: stores the new bodies
+    and rewrites only the parsed sections that changed. The summary is
+    re-rendered on its next read but not re-sent.
+    
+    Returns:
+        list: Names of the changed parsed_sections columns
+    """
+    parsed_data = worker_dispatch.parse(cleaned_body)
+    replace_newsletter_bodies(newsletter_id, newsletter.get("raw_body"), cleaned_body)
+    changed = update_revised_sections(newsletter_id, parsed_data)
+    if changed:
+        store_issue_diff(newsletter_id, compute_issue_diff(source.name, newsletter_id, parsed_data))
+        invalidate_artifact(newsletter_id)
+        # keylevelsraw only holds the source's current levels
+        if set(changed) & set(KEY_LEVEL_COLUMNS) and latest_newsletter_id(source.name) == newsletter_id:
+            extract_and_store_key_levels(
+                newsletter_id,
+                parsed_data.get("TradingPlanKeyLevels"),
+                parsed_data.get("KeyLevelsDetail", []),
+                source=source.key_levels_source
+            )
+    index_newsletter(newsletter_id, cleaned_body, parsed_data)
+    store_fingerprint(source.name, newsletter_id, fingerprint, received_date)
+    return changed
+
+
+def classify_stage(source, newsletter, newsletter_id, cleaned_body):
+    """
+    Classifies the email against the source's recent issues (see
+    near_duplicates.py). A duplicate ends the run; a revision updates the
+    issue it corrects and ends the run; a new newsletter carries on.
+    """
+    fingerprint = compute_fingerprint(cleaned_body)
+    received_date = datetime.fromisoformat(newsletter.get("received_date"))
+    kind, match_id, score = classify(source.name, newsletter_id, fingerprint)
+    if kind == 'new' and newsletter_exists(newsletter_id):
+        # Too different to match, but it replaces that day's issue all the same
+        kind, match_id = 'revision', newsletter_id
+    increment(f'dedupe.{kind}')
+    if kind == 'new':
+        return {'fingerprint': fingerprint}
+
+    if kind == 'revision':
+        changed = revise_newsletter(source, match_id, newsletter, cleaned_body, fingerprint, received_date)
+        message = f"Revision of '{match_id}' ({score:.2f} similar), updated: {', '.join(changed) or 'nothing'}"
+    else:
+        message = f"Duplicate of '{match_id}' ({score:.2f} similar)."
+    record_processed(source.name, newsletter.get("message_id"), newsletter.get("internal_date"), match_id)
+    raise SkipRun(message)
+
+
+def parse_stage(cleaned_body):
+    """Parses the cleaned email to extract key sections and a summary."""
+    return {'parsed_data': worker_dispatch.parse(cleaned_body)}
+
+
+def store_newsletter_stage(source, newsletter_id, newsletter, cleaned_body):
+    """Saves the newsletter data with both raw and cleaned content."""
+    if not newsletter_exists(newsletter_id):
+        insert_newsletter(newsletter_id, dict(newsletter, cleaned_body=cleaned_body, source=source.name))
+    return {}
+
+
+def store_sections_stage(newsletter_id, parsed_data):
+    """Saves the parsed sections and summary."""
+    insert_parsed_sections(newsletter_id, parsed_data)
+    return {}
+
+
+def key_levels_stage(source, newsletter_id, parsed_data):
+    """Extracts and stores key levels from both Trading Plan and Key Levels Detail sections."""
+    key_levels_count = extract_and_store_key_levels(
+        newsletter_id,
+        parsed_data.get("TradingPlanKeyLevels"),
+        parsed_data.get("KeyLevelsDetail", []),
+        source=source.key_levels_source
+    )
+    print(f"Extracted and stored {key_levels_count} key levels from the newsletter")
+    increment('levels.parsed', key_levels_count)
+    return {'key_levels_count': key_levels_count}
+
+
+def events_lookup_stage(newsletter_id):
+    """Looks up the upcoming events for the newsletter's window."""
+    return {'event_days': get_upcoming_event_days(newsletter_id)}
+
+
+def events_stage(newsletter_id, event_days):
+    """Stores the upcoming events on the newsletter's parsed sections."""
+    store_upcoming_events(newsletter_id, event_days)
+    return {}
+
+
+def diff_stage(source, newsletter_id, parsed_data):
+    """Diffs the levels and sections against the source's previous issue and stores the result."""
+    level_diff = compute_issue_diff(source.name, newsletter_id, parsed_data)
+    store_issue_diff(newsletter_id, level_diff)
+    return {'level_diff': level_diff}
+
+
+def render_stage(newsletter_id, parsed_data, event_days, level_diff):
+    """Renders and stores the summary email from the in-memory parse result."""
+    return {'summary_hash': render_parsed_summary(newsletter_id, parsed_data, event_days, level_diff)}
+
+
+def send_stage(newsletter_id):
+    """Sends the summary email (at most once per newsletter, see send ledger)."""
+    return {'summary_sent': send_summary_email(newsletter_id)}
+
+
+def index_stage(newsletter_id, cleaned_body, parsed_data):
+    """Updates the full-text search index for the newsletter."""
+    index_newsletter(newsletter_id, cleaned_body, parsed_data)
+    return {}
+
+
+def fingerprint_stage(source, newsletter_id, newsletter, fingerprint):
+    """Adds the newsletter to the near-duplicate index."""
+    store_fingerprint(source.name, newsletter_id, fingerprint, datetime.fromisoformat(newsletter.get("received_date")))
+    return {}
+
+
+def record_message_stage(source, newsletter_id, newsletter):
+    """Adds the Gmail message to the processed-message ledger."""
+    record_processed(source.name, newsletter.get("message_id"), newsletter.get("internal_date"), newsletter_id)
+    return {}
+
+
+def _message_reference(outputs):
+    """Checkpoints the fetched email by its Gmail message ID instead of its body."""
+    return {'message_id': outputs['newsletter'].get('message_id')}
+
+
+def _refetch_newsletter(saved, source, message_id):
+    """Fetches a checkpointed email again by its message ID when a resumed run needs it."""
+    return fetch_stage(source, saved.get('message_id') or message_id)
+
+
+def _recompute(stage_func):
+    """Restore function for a deterministic stage: its outputs are not checkpointed but recomputed."""
+    return lambda saved, **inputs: stage_func(**inputs)
+
+
+def _no_checkpoint(outputs):
+    """Checkpoints nothing for outputs that are recomputed on resume."""
+    return {}
+
+
+# The email, cleaned body and parse result are not checkpointed (the run-state
+# tables would hold copies of every body): a resumed run fetches the email
+# again by message ID and recomputes the rest (the cleaning from the clean cache).
+# After parse, the table writes, the calendar lookup and the render are
+# independent and run concurrently (the render waits only for the diff
+# against the previous issue); everything joins before the send.
+NEWSLETTER_STAGES = [
+    Stage('fetch', fetch_stage, inputs=('source', 'message_id'), outputs=('newsletter',),
+          checkpoint=_message_reference, restore=_refetch_newsletter),
+    Stage('identify', identify_stage, inputs=('source', 'newsletter'), outputs=('newsletter_id',)),
+    Stage('clean', clean_stage, inputs=('source', 'newsletter'), outputs=('cleaned_body',), after=('identify',),
+          checkpoint=_no_checkpoint, restore=_recompute(clean_stage)),
+    Stage('classify', classify_stage, inputs=('source', 'newsletter', 'newsletter_id', 'cleaned_body'), outputs=('fingerprint',)),
+    Stage('parse', parse_stage, inputs=('cleaned_body',), outputs=('parsed_data',), after=('classify',),
+          checkpoint=_no_checkpoint, restore=_recompute(parse_stage)),
+    Stage('store_newsletter', store_newsletter_stage, inputs=('source', 'newsletter_id', 'newsletter', 'cleaned_body'),
+          after=('classify',)),
+    Stage('store_sections', store_sections_stage, inputs=('newsletter_id', 'parsed_data')),
+    Stage('key_levels', key_levels_stage, inputs=('source', 'newsletter_id', 'parsed_data'), outputs=('key_levels_count',)),
+    Stage('events_lookup', events_lookup_stage, inputs=('newsletter_id',), outputs=('event_days',)),
+    Stage('events', events_stage, inputs=('newsletter_id', 'event_days'), after=('store_sections',)),
+    Stage('diff', diff_stage, inputs=('source', 'newsletter_id', 'parsed_data'), outputs=('level_diff',),
+          after=('store_sections', 'key_levels')),
+    Stage('render', render_stage, inputs=('newsletter_id', 'parsed_data', 'event_days', 'level_diff'), outputs=('summary_hash',)),
+    Stage('send', send_stage, inputs=('newsletter_id',),
+          outputs=('summary_sent',),
+          after=('store_newsletter', 'store_sections', 'key_levels', 'events', 'render')),
+    Stage('index', index_stage, inputs=('newsletter_id', 'cleaned_body', 'parsed_data'), after=('store_newsletter',)),
+    Stage('fingerprint', fingerprint_stage, inputs=('source', 'newsletter_id', 'newsletter', 'fingerprint'), after=('store_newsletter',)),
+    Stage('record_message', record_message_stage, inputs=('source', 'newsletter_id', 'newsletter'), after=('send', 'index', 'fingerprint')),
+]
+
+
+# Maximum number of newsletter sources processed at the same time
+MAX_SOURCE_WORKERS = 4
+
+
+def precheck_source(source):
+    """
+    Asks Gmail for the newest message ID only and checks it against the
+    processed-message ledger; an unknown ID is then checked by its
+    internalDate, so a message no newer than the last processed one is not
+    downloaded either.
+    
+    Args:
+        source (NewsletterSource): The source to check
+        
+    Returns:
+        tuple: (has_new_message, message_id). If the pre-check itself fails,
+               (True, None) is returned so the full pipeline still runs.
+    """
+    try:
+        service = get_gmail_service()
+        message_id = get_latest_message_id(source.query, service)
+        if message_id is None:
+            print(f"[{source.name}] Pre-check: no newsletter email found")
+            return False, None
+        if is_processed(source.name, message_id):
+            print(f"[{source.name}] Pre-check: message {message_id} already processed")
+            return False, message_id
+        internal_date = get_message_date(message_id, service)
+    except Exception as e:
+        print(f"[{source.name}] Pre-check failed, running the full pipeline: {str(e)}")
+        return True, None
+    latest = latest_internal_date(source.name)
+    if internal_date is not None and latest is not None and internal_date <= latest:
+        print(f"[{source.name}] Pre-check: message {message_id} is not newer than the last processed one")
+        return False, message_id
+    return True, message_id
+
+
+def process_source(source, profile=False):
+    """
+    Runs (or resumes) the newsletter pipeline for one source.
+    
+    A pre-check first compares the newest Gmail message ID with the
+    processed-message ledger; if nothing new has arrived the run ends there.
+    
+    Args:
+        source (NewsletterSource): The source to process
+        profile (bool): Capture a cProfile/tracemalloc profile of the run
+        
+    Returns:
+        str: The run status ('completed', 'skipped' or 'unchanged')
+    """
+    print(f"=== Processing source '{source.name}' ===")
+    has_new_message, message_id = precheck_source(source)
+    # Counted in memory; flushed by the caller (ingestion_tick, process_newsletter)
+    count_precheck(source.name, early_exit=not has_new_message)
+    if not has_new_message:
+        return 'unchanged'
+    context = {'source': source, 'message_id': message_id}
+    if profile:
+        with RunProfiler(source.pipeline_name) as profiler:
+            result = run_pipeline(source.pipeline_name, NEWSLETTER_STAGES, context=context, profiler=profiler)
+        store_profile(result['run_id'], profiler.result)
+    else:
+        result = run_pipeline(source.pipeline_name, NEWSLETTER_STAGES, context=context)
+    durations = ", ".join(f"{name}={ms:.0f}ms" for name, ms in result['stage_durations'].items())
+    print(f"[{source.name}] Run {result['run_status']} in {result['total_ms']:.0f} ms; stage durations: {durations}")
+    return result['run_status']
 
 
 @anvil.server.background_task
 @anvil.server.callable
-def process_newsletter():
+def process_newsletter(profile=False):
     """
     Primary function that orchestrates the entire newsletter processing workflow.
     Retrieves the latest newsletter, checks for duplicates, processes content,
     and saves data to various tables.
+    
+    Runs as a checkpointed stage pipeline: if a previous run failed part-way
+    (e.g., in the send), this run resumes from the first incomplete stage
+    instead of fetching and parsing again. Independent post-parse stages run
+    concurrently, and every registered newsletter source is processed in
+    parallel on a bounded pool.
+    
+    Args:
+        profile (bool): Store a cProfile/tracemalloc profile of each source's
+                        run (see get_profiles)
+    """
+    print("=== Starting process_newsletter ===")
+    sources = get_sources()
+    statuses = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_SOURCE_WORKERS, len(sources))) as executor:
+        futures = {executor.submit(process_source, source, profile): source.name for source in sources}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                statuses[name] = future.result()
+            except Exception as e:
+                # One failing source must not stop the others; it resumes next run
+                print(f"Error processing newsletter source '{name}': {str(e)}")
+                print(f"Error type: {type(e)}")
+                errors[name] = e
+    print(f"Source results: {statuses}")
+    print("=== process_newsletter completed ===")
+    flush_metrics()
+    if errors:
+        raise next(iter(errors.values()))
+    return statuses
+
+
+@anvil.server.callable
+def process_newsletter_source(source_name, profile=False):
+    """
+    Processes a single registered newsletter source by name.
     """
     try:
-        print("=== Starting process_newsletter ===")
-        # Retrieve the latest newsletter email
-        print("Calling get_latest_newsletter...")
-        newsletter = get_latest_newsletter()
-        if not newsletter:
-            print("No newsletter email found.")
-            return
-        print(f"Newsletter retrieved with subject: {newsletter.get('subject')}")
-
-        # Convert the ISO format date to YYYYMMDD format
-        print("Converting date format...")
-        received_date = datetime.fromisoformat(newsletter.get("received_date"))
-        newsletter_id = received_date.strftime("%Y%m%d")
-        print(f"Generated newsletter_id: {newsletter_id}")
-
-        # Skip if this newsletter has already been processed
-        print("Checking for existing newsletter...")
-        if newsletter_exists(newsletter_id):
-            print(f"Newsletter '{newsletter_id}' already processed. Skipping.")
-            return
-        print("Newsletter is new, proceeding with processing")
-
-        # Clean the newsletter content first
-        print("Cleaning newsletter content...")
-        cleaned_body = clean_newsletter(newsletter.get("raw_body"))
-        print(f"Cleaned body length: {len(cleaned_body)}")
-        print("Newsletter cleaning completed")
-
-        # Parse the cleaned email to extract key sections and a summary
-        print("Parsing email content...")
-        parsed_data = parse_email(cleaned_body)
-        print("Email parsing completed")
-
-        # Save the newsletter data with both raw and cleaned content
-        print("Saving newsletter data...")
-        newsletter["cleaned_body"] = cleaned_body
-        insert_newsletter(newsletter_id, newsletter)
-        print("Newsletter data saved successfully")
-
-        # Save the parsed sections and summary
-        print("Saving parsed sections...")
-        insert_parsed_sections(newsletter_id, parsed_data)
-        print("Parsed sections saved successfully")
-        
-        # Extract and store key levels from both Trading Plan and Key Levels Detail sections
-        print("Extracting and storing key levels...")
-        key_levels_count = extract_and_store_key_levels(
-            newsletter_id, 
-            parsed_data.get("TradingPlanKeyLevels"),
-            parsed_data.get("KeyLevelsDetail", [])
-        )
-        print(f"Extracted and stored {key_levels_count} key levels from the newsletter")
-        
-        # Update upcoming events
-        print("Updating upcoming events...")
-        update_upcoming_events(newsletter_id)
-        print("Upcoming events updated successfully")
+        return process_source(get_source(source_name), profile)
+    finally:
+        flush_metrics()
 
-        # After successfully processing the newsletter
-        print("Sending summary email...")
-        send_summary_email()
-        print("Summary email sent successfully")
 
-        print("Newsletter processed successfully.")
-        print("=== process_newsletter completed ===")
+@anvil.server.callable
+def replay_newsletter(newsletter_id, profile=False):
+    """
+    Re-runs cleaning and parsing on a stored newsletter without writing
+    anything (besides the clean cache), e.g. to time the parser against a
+    real archive entry.
+    
+    Args:
+        newsletter_id (str): The newsletter to replay
+        profile (bool): Capture and store a cProfile/tracemalloc profile;
+                        cleaning then bypasses the clean cache so it is measured
+        
+    Returns:
+        dict: 'cleaned_length', 'key_levels' (number parsed), 'duration_ms'
+              and, when profiling, the stored profile's 'run_id'
+    """
+    row = app_tables.newsletters.get(newsletter_id=newsletter_id)
+    if row is None:
+        raise ValueError(f"Newsletter '{newsletter_id}' not found")
+    raw_body, _ = get_bodies(row)
+    try:
+        cleaning_profile = get_source(row['source']).cleaning_profile if row['source'] else None
+    except ValueError:
+        cleaning_profile = None
 
-    except Exception as e:
-        print(f"Error processing newsletter: {str(e)}")
-        print(f"Error type: {type(e)}")
-        print(f"Error details: {str(e.__dict__)}")
-        raise
+    def replay():
+        if profile:
+            cleaned_body = clean_newsletter(raw_body, cleaning_profile)
+        else:
+            cleaned_body = cached_clean(raw_body, cleaning_profile)
+        return cleaned_body, parse_email(cleaned_body)
+
+    started = time.perf_counter()
+    if profile:
+        run_id = f"replay-{uuid.uuid4().hex}"
+        with RunProfiler(f"replay:{newsletter_id}") as profiler:
+            cleaned_body, parsed_data = profiler.profile_call(replay)
+        store_profile(run_id, profiler.result)
+    else:
+        run_id = None
+        cleaned_body, parsed_data = replay()
+    return {
+        'cleaned_length': len(cleaned_body),
+        'key_levels': len(parsed_data.get("KeyLevelsRawMatches") or []),
+        'duration_ms': (time.perf_counter() - started) * 1000,
+        'run_id': run_id
+    }
 
 
 @anvil.server.callable
@@ -143,6 +470,8 @@ def print_data_to_form():
     
     Returns:
         dict: Dictionary containing summary, timing detail, and upcoming events
+              (both as text and as structured per-day lists), plus the
+              structured parse result for the summary sections
     """
     # Get the most recent summary from parsed_sections table
     latest_sections = app_tables.parsed_sections.search(
@@ -151,15 +480,24 @@ def print_data_to_form():
     
     if latest_sections:
         latest = latest_sections[0]
+        event_days = latest['upcoming_events_days']
+        if event_days is None:
+            event_days = get_upcoming_event_days(latest['newsletter_id'])
         return {
             'summary': latest['summary'],
             'timing_detail': latest['timing_detail'],
-            'upcoming_events': latest['upcoming_events']
+            'upcoming_events': latest['upcoming_events'],
+            'upcoming_event_days': event_days,
+            'events_label': get_events_label(latest['newsletter_id']),
+            'structured_summary': get_structured_summary(latest)
         }
     return {
         'summary': "No summary available",
         'timing_detail': "No timing information available",
-        'upcoming_events': "No upcoming events available"
+        'upcoming_events': "No upcoming events available",
+        'upcoming_event_days': [],
+        'events_label': "Upcoming Events",
+        'structured_summary': None
     }
 
 
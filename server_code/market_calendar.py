@@ -1,85 +1,198 @@
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
+import anvil.server
 import anvil.tables as tables
 from anvil.tables import app_tables
+from trading_calendar import remaining_week_sessions
+from metrics import CountingTables
 
-def get_upcoming_events(newsletter_id):
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+def build_event_digests():
     """
-    Gets upcoming market events based on the newsletter date.
-    Returns formatted string of events for the remainder of the week,
-    or next week if called on Friday.
-    
-    Args:
-        newsletter_id (str): Newsletter ID in YYYYMMDD format
-        
+    Rebuilds the eventdigests table from the marketcalendar table.
+    Each digest row holds the structured per-day event lists for one ISO week,
+    so readers never have to regroup or re-format calendar rows.
+    Call this whenever the calendar data is loaded or changed.
+
     Returns:
-        str: Formatted string of upcoming events
+        int: Number of weekly digests written
     """
-    # Convert newsletter_id to datetime
-    newsletter_date = datetime.strptime(str(newsletter_id), "%Y%m%d")
-    
-    # Determine the date range to look up
-    weekday = newsletter_date.weekday()  # Monday is 0, Sunday is 6
-    
-    # If it's Friday (4), get next week's events
-    if weekday == 4:
-        start_date = newsletter_date + timedelta(days=3)  # Start from Monday
-        end_date = start_date + timedelta(days=4)  # Until Friday
-    else:
-        # For other days, get remaining days of current week
-        start_date = newsletter_date + timedelta(days=1)  # Start from next day
-        days_until_friday = 4 - weekday
-        end_date = newsletter_date + timedelta(days=days_until_friday)
-    
-    # Format dates for query
-    start_date_str = start_date.strftime("%Y-%m-%d")
-    end_date_str = end_date.strftime("%Y-%m-%d")
-    
-    # Query market calendar for events in date range
-    # Get all events and filter in Python
-    events = []
+    # Group events by ISO week and then by date in a single ordered pass
+    weeks = {}
+    current_date = None
+    current_day = None
     for event in app_tables.marketcalendar.search(tables.order_by("date", "time")):
-        if start_date_str <= event['date'] <= end_date_str:
-            events.append(event)
-    
-    # Group events by date
-    event_groups = {}
-    for event in events:
-        event_date = datetime.strptime(event['date'], "%Y-%m-%d")
-        if event_date not in event_groups:
-            event_groups[event_date] = []
-        event_groups[event_date].append({
+        event_date_str = event['date']
+        if event_date_str != current_date:
+            current_date = event_date_str
+            event_date = date.fromisoformat(event_date_str)
+            iso_year, iso_week, _ = event_date.isocalendar()
+            week_key = f"{iso_year}-W{iso_week:02d}"
+            current_day = {
+                'date': event_date_str,
+                # Format the date header once (e.g., "Wednesday (2/12)")
+                'header': f"{event_date.strftime('%A')} ({event_date.month}/{event_date.day})",
+                'events': []
+            }
+            if week_key not in weeks:
+                week_start = event_date - timedelta(days=event_date.weekday())
+                weeks[week_key] = {'week_start': week_start.isoformat(), 'days': []}
+            weeks[week_key]['days'].append(current_day)
+        current_day['events'].append({
             'time': event['time'],
             'event': event['event']
         })
-    
-    # Format the output
+
+    _write_event_digests(weeks)
+    print(f"Built {len(weeks)} weekly event digests")
+    return len(weeks)
+
+
+@tables.in_transaction
+def _write_event_digests(weeks):
+    """Replaces all digest rows with the given weeks in one transaction."""
+    app_tables.eventdigests.delete_all_rows()
+    built_at = datetime.now()
+    for week_key in sorted(weeks):
+        app_tables.eventdigests.add_row(
+            iso_week=week_key,
+            week_start=weeks[week_key]['week_start'],
+            days=weeks[week_key]['days'],
+            built_at=built_at
+        )
+
+
+@anvil.server.callable
+def rebuild_event_digests():
+    """
+    Server callable wrapper so the digests can be rebuilt after manual calendar edits.
+    """
+    return build_event_digests()
+
+
+def get_week_digest(iso_week):
+    """
+    Returns the structured day list for an ISO week key (e.g., "2025-W07").
+
+    Args:
+        iso_week (str): ISO week key in YYYY-Www format
+
+    Returns:
+        list: List of day dicts with date, header and events, or [] if none
+    """
+    row = app_tables.eventdigests.get(iso_week=iso_week)
+    return list(row['days']) if row and row['days'] else []
+
+
+def get_upcoming_event_days(newsletter_id):
+    """
+    Gets upcoming market events based on the newsletter date as structured days,
+    for the remaining trading sessions of the week, or next week's sessions if
+    none remain (e.g., on Friday).
+
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+
+    Returns:
+        list: List of day dicts with date, header and events
+    """
+    newsletter_date = datetime.strptime(str(newsletter_id)[:8], "%Y%m%d").date()
+
+    # Remaining sessions of the newsletter's week, or next week's after the last session
+    sessions, _ = remaining_week_sessions(newsletter_date)
+    if not sessions:
+        return []
+    start_date, end_date = sessions[0], sessions[-1]
+
+    # Build the digests on first use if the calendar was loaded before they existed
+    if not len(app_tables.eventdigests.search()):
+        build_event_digests()
+
+    start_date_str = start_date.isoformat()
+    end_date_str = end_date.isoformat()
+    iso_year, iso_week, _ = start_date.isocalendar()
+    days = get_week_digest(f"{iso_year}-W{iso_week:02d}")
+    return [day for day in days if start_date_str <= day['date'] <= end_date_str]
+
+
+def get_events_label(newsletter_id):
+    """
+    Returns the heading for the upcoming-events window of a newsletter.
+
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+
+    Returns:
+        str: "Next Week's Events" or "This Week's Remaining Events"
+    """
+    newsletter_date = datetime.strptime(str(newsletter_id)[:8], "%Y%m%d").date()
+    _, next_week = remaining_week_sessions(newsletter_date)
+    return "Next Week's Events" if next_week else "This Week's Remaining Events"
+
+
+def format_event_days(days):
+    """
+    Formats structured event days as the plain-text block stored in parsed_sections.
+
+    Args:
+        days (list): List of day dicts with header and events
+
+    Returns:
+        str: Formatted string of upcoming events
+    """
     output_parts = []
-    for date in sorted(event_groups.keys()):
-        # Format the date header (e.g., "Wednesday (2/12)")
-        date_header = f"{date.strftime('%A')} ({date.strftime('%-m/%-d')})"
-        output_parts.append(date_header + "\n")
-        
+    for day in days:
+        output_parts.append(day['header'] + "\n")
+
         # Add each event for this date
-        for event in event_groups[date]:
+        for event in day['events']:
             output_parts.append(f"{event['time']} - {event['event']}")
-        
+
         # Add blank line between dates
         output_parts.append("")
-    
+
     # Join all parts with newlines and strip any extra whitespace
     return "\n".join(output_parts).strip()
 
-def update_upcoming_events(newsletter_id):
+
+def get_upcoming_events(newsletter_id):
     """
-    Updates the upcoming_events field in the parsed_sections table
-    for the given newsletter_id.
-    
+    Gets upcoming market events based on the newsletter date.
+    Returns formatted string of events for the remaining trading sessions
+    of the week, or next week's sessions if none remain.
+
     Args:
         newsletter_id (str): Newsletter ID in YYYYMMDD format
+
+    Returns:
+        str: Formatted string of upcoming events
+    """
+    return format_event_days(get_upcoming_event_days(newsletter_id))
+
+
+def store_upcoming_events(newsletter_id, days):
+    """
+    Writes already-selected event days to the upcoming_events and
+    upcoming_events_days fields of the newsletter's parsed_sections row.
+
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+        days (list): Structured event days from get_upcoming_event_days
     """
-    upcoming_events = get_upcoming_events(newsletter_id)
-    
-    # Update the parsed_sections table
     row = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
     if row:
-        row['upcoming_events'] = upcoming_events 
\ No newline at end of file
+        row['upcoming_events'] = format_event_days(days)
+        row['upcoming_events_days'] = days
+
+
+def update_upcoming_events(newsletter_id):
+    """
+    Updates the upcoming_events and upcoming_events_days fields in the
+    parsed_sections table for the given newsletter_id.
+
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+    """
+    store_upcoming_events(newsletter_id, get_upcoming_event_days(newsletter_id))
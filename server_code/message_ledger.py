@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+message_ledger.py
+Ledger of Gmail messages that have already been processed.
+
+Before a scheduled run builds a pipeline, process_source asks Gmail for the ID
+of the newest matching message only (see gmail_client.get_latest_message_id)
+and looks it up here. Gmail message IDs never change, so a hit means nothing
+new has arrived and the run ends without downloading the email or writing to
+any table. An unknown ID is checked once more by its internalDate (fetched
+alone, see gmail_client.get_message_date): a message no newer than the last
+one processed is not downloaded either. Runs and early exits are counted as
+metrics in memory (precheck.runs.<source>, precheck.early_exit.<source>) and
+written when the caller flushes them; get_precheck_stats sums them.
+"""
+
+from datetime import datetime, timezone
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from metrics import get_metrics_summary, increment
+
+
+def is_processed(source_name, message_id):
+    """
+    Returns True if the message was already processed for the source.
+
+    Args:
+        source_name (str): Newsletter source name
+        message_id (str): Gmail message ID
+    """
+    return app_tables.processedmessages.get(source=source_name, message_id=message_id) is not None
+
+
+def record_processed(source_name, message_id, internal_date=None, newsletter_id=None):
+    """
+    Adds a message to the ledger (no-op if it is already there).
+
+    Args:
+        source_name (str): Newsletter source name
+        message_id (str): Gmail message ID
+        internal_date (int, optional): Gmail internalDate in epoch milliseconds
+        newsletter_id (str, optional): The newsletter the message produced
+    """
+    if not message_id or is_processed(source_name, message_id):
+        return
+    received = (
+        datetime.fromtimestamp(internal_date / 1000, tz=timezone.utc)
+        if internal_date else None
+    )
+    app_tables.processedmessages.add_row(
+        source=source_name,
+        message_id=message_id,
+        internal_date=received,
+        newsletter_id=newsletter_id,
+        processed_at=datetime.now()
+    )
+
+
+def forget_newsletter(newsletter_id):
+    """Removes a newsletter's messages from the ledger so it can be processed again."""
+    for row in app_tables.processedmessages.search(newsletter_id=newsletter_id):
+        row.delete()
+
+
+def latest_internal_date(source_name):
+    """
+    Returns the Gmail internalDate of the newest message processed for a source.
+
+    Returns:
+        int: Epoch milliseconds, or None if no processed message has one
+    """
+    rows = app_tables.processedmessages.search(
+        tables.order_by("internal_date", ascending=False),
+        source=source_name,
+        internal_date=q.not_(None)
+    )
+    for row in rows:
+        return int(row['internal_date'].timestamp() * 1000)
+    return None
+
+
+def count_precheck(source_name, early_exit):
+    """
+    Counts a pre-check in memory (flushed with the other metrics).
+
+    Args:
+        source_name (str): Newsletter source name
+        early_exit (bool): True if the run ended at the pre-check
+    """
+    increment(f'precheck.runs.{source_name}')
+    if early_exit:
+        increment(f'precheck.early_exit.{source_name}')
+
+
+@anvil.server.callable
+def get_precheck_stats(hours=168):
+    """
+    Returns the pre-check counters per source over a rolling window.
+
+    Args:
+        hours (float): Size of the window ending now
+
+    Returns:
+        dict: {source: {'runs': n, 'early_exits': n}}
+    """
+    stats = {}
+    for name, counter in get_metrics_summary(hours)['counters'].items():
+        for prefix, key in (('precheck.runs.', 'runs'), ('precheck.early_exit.', 'early_exits')):
+            if name.startswith(prefix):
+                source_stats = stats.setdefault(name[len(prefix):], {'runs': 0, 'early_exits': 0})
+                source_stats[key] = int(counter['total'])
+    return stats
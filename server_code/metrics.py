@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+metrics.py
+Lightweight pipeline instrumentation.
+
+Timings and counters are collected in a process-wide, thread-safe buffer and
+written to the metrics table in one add_rows call per flush (run_pipeline
+flushes at the end of every run), so recording a metric never costs a Data
+Tables round trip on its own. Counters are summed per name in the buffer, so
+a flush writes one row per counter name however often it was incremented
+(CountingTables increments on every Data Tables call); timings keep one row
+per duration for the percentiles. Rows older than RETENTION_DAYS are deleted
+by purge_old_metrics, scheduled daily. get_metrics_summary aggregates a time
+window into p50/p95 latencies per timer and totals and rates per counter.
+
+Metric names are dotted, e.g. 'stage.parse' (ms), 'tables.calls',
+'gmail.bytes', 'levels.parsed', 'cache.artifact.hit'.
+"""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import anvil.server
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+
+# Metric rows older than this are deleted by purge_old_metrics
+RETENTION_DAYS = 90
+
+_lock = threading.Lock()
+_timings = []
+_counters = {}
+
+
+def record_timing(name, duration_ms):
+    """Records one duration in milliseconds."""
+    with _lock:
+        _timings.append((name, float(duration_ms), datetime.now()))
+
+
+def increment(name, amount=1):
+    """Adds amount to a counter."""
+    if not amount:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0.0) + float(amount)
+
+
+@contextmanager
+def timer(name):
+    """Times the enclosed block and records it under name."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, (time.perf_counter() - started) * 1000)
+
+
+def timed(name, flush_after=False):
+    """
+    Decorator that times every call of a function.
+
+    Args:
+        name (str): Metric name
+        flush_after (bool): Flush the buffer after each call (for server
+                            callables, whose process may not live until the
+                            next pipeline run)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                with timer(name):
+                    return func(*args, **kwargs)
+            finally:
+                if flush_after:
+                    flush()
+        return wrapper
+    return decorator
+
+
+def flush():
+    """
+    Writes the buffered metrics to the metrics table.
+
+    Returns:
+        int: Number of metric rows written
+    """
+    now = datetime.now()
+    with _lock:
+        batch = [dict(kind='timer', name=name, value=value, recorded=recorded) for name, value, recorded in _timings]
+        batch.extend(dict(kind='counter', name=name, value=total, recorded=now) for name, total in _counters.items())
+        _timings.clear()
+        _counters.clear()
+    if not batch:
+        return 0
+    try:
+        app_tables.metrics.add_rows(batch)
+    except Exception as e:
+        # Metrics must never fail a run
+        print(f"Error writing metrics: {str(e)}")
+        return 0
+    return len(batch)
+
+
+@anvil.server.background_task
+def purge_old_metrics(days=RETENTION_DAYS):
+    """
+    Deletes metric rows recorded more than days ago (scheduled daily).
+
+    Returns:
+        int: Number of rows deleted
+    """
+    rows = app_tables.metrics.search(recorded=q.less_than(datetime.now() - timedelta(days=days)))
+    deleted = len(rows)
+    rows.delete_all_rows()
+    return deleted
+
+
+class _CountingTable:
+    """Wraps one app_tables table and counts calls to its methods."""
+
+    def __init__(self, table, name):
+        self._table = table
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._table, attr)
+        if not callable(value):
+            return value
+
+        def counted(*args, **kwargs):
+            increment('tables.calls')
+            increment(f'tables.calls.{self._name}')
+            return value(*args, **kwargs)
+        return counted
+
+
+class CountingTables:
+    """
+    Stand-in for app_tables that counts Data Tables calls per table.
+
+    Usage in a data-access module:
+        app_tables = CountingTables(app_tables)
+    """
+
+    def __init__(self, tables):
+        self._tables = tables
+
+    def __getattr__(self, name):
+        return _CountingTable(getattr(self._tables, name), name)
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of a sorted list."""
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+@anvil.server.callable
+def get_metrics_summary(hours=168):
+    """
+    Aggregates the recorded metrics over a rolling window.
+
+    Args:
+        hours (float): Size of the window ending now
+
+    Returns:
+        dict: {'timers': {name: {'count', 'p50_ms', 'p95_ms', 'max_ms'}},
+               'counters': {name: {'total', 'per_hour'}},
+               'runs_per_day': float, 'hours': hours}
+    """
+    flush()
+    since = datetime.now() - timedelta(hours=hours)
+    timings = {}
+    counters = {}
+    for row in app_tables.metrics.search(recorded=q.greater_than_or_equal_to(since)):
+        if row['kind'] == 'timer':
+            timings.setdefault(row['name'], []).append(row['value'] or 0.0)
+        else:
+            counters[row['name']] = counters.get(row['name'], 0.0) + (row['value'] or 0.0)
+
+    timers = {}
+    for name, values in timings.items():
+        values.sort()
+        timers[name] = {
+            'count': len(values),
+            'p50_ms': _percentile(values, 50),
+            'p95_ms': _percentile(values, 95),
+            'max_ms': values[-1]
+        }
+    runs = timers.get('run.total', {}).get('count', 0)
+    return {
+        'timers': timers,
+        'counters': {name: {'total': total, 'per_hour': total / hours} for name, total in counters.items()},
+        'runs_per_day': runs / (hours / 24),
+        'hours': hours
+    }
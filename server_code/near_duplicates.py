@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+near_duplicates.py
+MinHash fingerprints and an LSH index for spotting resent or corrected newsletters.
+
+A fingerprint is a MinHash signature of NUM_HASHES values over the 5-word
+shingles of a cleaned body; the fraction of equal values estimates the
+Jaccard similarity of two bodies. The signature is cut into NUM_BANDS bands
+of ROWS_PER_BAND values, and each band is hashed to a bucket key in the
+lshbuckets table. Two bodies that share any bucket are candidates, and only
+candidates have their signatures compared, so classifying an email costs one
+bucket query and a few signature reads however large the archive is. Only
+the last RECENT_ISSUES fingerprints of each source are kept.
+
+Corrections usually change a few words, so similarity alone cannot tell a
+correction from a resend; the fingerprint also keeps a SHA-256 digest of the
+cleaned body. Against its best candidate (REVISION_SIMILARITY or above), an
+incoming body is
+  - a 'duplicate' if its cleaned text is identical (a resend),
+  - a 'revision' if it differs and the candidate is the same issue, i.e. has
+    the incoming email's newsletter_id (a correction),
+  - a 'duplicate' if the candidate is another issue but the similarity is
+    DUPLICATE_SIMILARITY or above (a late resend with cosmetic differences), and
+  - 'new' otherwise. Consecutive daily issues share a lot of boilerplate, so
+    similarity to another day's issue never makes a revision.
+"""
+
+import hashlib
+import random
+from datetime import datetime
+
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from search_index import tokenize
+from metrics import CountingTables
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+SHINGLE_SIZE = 5
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+NUM_HASHES = NUM_BANDS * ROWS_PER_BAND
+
+DUPLICATE_SIMILARITY = 0.95
+REVISION_SIMILARITY = 0.5
+RECENT_ISSUES = 30
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Fixed (a, b) pairs for the hash functions h(x) = (a*x + b) mod p; fixed so
+# stored signatures stay comparable across processes
+_rng = random.Random(20250101)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_HASHES)]
+
+
+def _shingle_hashes(cleaned_body):
+    """Returns the 64-bit hashes of the body's word shingles."""
+    tokens = tokenize(cleaned_body)
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = {' '.join(tokens)}
+    else:
+        shingles = {' '.join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    return [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big') for s in shingles]
+
+
+def minhash_signature(cleaned_body):
+    """
+    Computes the MinHash signature of a cleaned body.
+
+    Returns:
+        list: NUM_HASHES 32-bit integers
+    """
+    hashes = _shingle_hashes(cleaned_body)
+    return [
+        min(((a * x + b) % _MERSENNE_PRIME) & _MAX_HASH for x in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def fingerprint(cleaned_body):
+    """
+    Computes the fingerprint of a cleaned body.
+
+    Returns:
+        dict: 'signature' (minhash_signature) and 'digest' (SHA-256 hex of the text)
+    """
+    return {
+        'signature': minhash_signature(cleaned_body),
+        'digest': hashlib.sha256((cleaned_body or '').encode('utf-8')).hexdigest()
+    }
+
+
+def similarity(signature, other):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for x, y in zip(signature, other) if x == y) / NUM_HASHES
+
+
+def bucket_keys(signature):
+    """Returns the LSH bucket key of each band of a signature."""
+    keys = []
+    for band in range(NUM_BANDS):
+        values = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).hexdigest()
+        keys.append(f"{band}:{digest}")
+    return keys
+
+
+def classify(source_name, newsletter_id, fingerprint):
+    """
+    Compares a fingerprint with the source's recent issues.
+
+    Args:
+        source_name (str): Newsletter source name
+        newsletter_id (str): The issue the incoming email would be stored as
+        fingerprint (dict): fingerprint() of the incoming cleaned body
+
+    Returns:
+        tuple: (kind, newsletter_id, similarity), where kind is 'duplicate',
+               'revision' or 'new' (newsletter_id is None for 'new')
+    """
+    signature = fingerprint['signature']
+    candidate_ids = {
+        row['newsletter_id']
+        for row in app_tables.lshbuckets.search(source=source_name, bucket=q.any_of(*bucket_keys(signature)))
+    }
+    best_id, best_score, best_row = None, 0.0, None
+    for candidate_id in candidate_ids:
+        row = app_tables.fingerprints.get(newsletter_id=candidate_id)
+        if row is None:
+            continue
+        score = 1.0 if row['digest'] == fingerprint['digest'] else similarity(signature, row['signature'])
+        if score > best_score:
+            best_id, best_score, best_row = candidate_id, score, row
+    if best_row is None or best_score < REVISION_SIMILARITY:
+        return 'new', None, best_score
+    if best_row['digest'] == fingerprint['digest']:
+        return 'duplicate', best_id, best_score
+    if best_id == newsletter_id:
+        return 'revision', best_id, best_score
+    if best_score >= DUPLICATE_SIMILARITY:
+        return 'duplicate', best_id, best_score
+    return 'new', None, best_score
+
+
+def _delete_fingerprint(newsletter_id):
+    for bucket in app_tables.lshbuckets.search(newsletter_id=newsletter_id):
+        bucket.delete()
+    row = app_tables.fingerprints.get(newsletter_id=newsletter_id)
+    if row is not None:
+        row.delete()
+
+
+@tables.in_transaction
+def store_fingerprint(source_name, newsletter_id, fingerprint, received_date):
+    """
+    Adds (or replaces) a newsletter's fingerprint and buckets, then drops the
+    source's fingerprints beyond the RECENT_ISSUES newest.
+    """
+    _delete_fingerprint(newsletter_id)
+    app_tables.fingerprints.add_row(
+        newsletter_id=newsletter_id,
+        source=source_name,
+        signature=fingerprint['signature'],
+        digest=fingerprint['digest'],
+        received=received_date,
+        created=datetime.now()
+    )
+    app_tables.lshbuckets.add_rows([
+        dict(bucket=key, newsletter_id=newsletter_id, source=source_name)
+        for key in bucket_keys(fingerprint['signature'])
+    ])
+    stored = app_tables.fingerprints.search(
+        q.fetch_only("newsletter_id"),
+        tables.order_by("received", ascending=False),
+        source=source_name
+    )
+    for row in list(stored)[RECENT_ISSUES:]:
+        _delete_fingerprint(row['newsletter_id'])
+
+
+def forget_fingerprint(newsletter_id):
+    """Deletes a newsletter's fingerprint (e.g., when the newsletter is deleted)."""
+    _delete_fingerprint(newsletter_id)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+pipeline.py
+A small checkpointed, dependency-aware stage runner.
+
+A pipeline is an ordered list of Stage objects. Each stage declares the context
+keys it reads (inputs) and the keys it produces (outputs), plus any stages it must
+run after for side effects (after). A stage depends on the stages that produce its
+inputs and on its 'after' stages; stages whose dependencies are satisfied run
+concurrently on a bounded thread pool, so a run takes as long as its longest
+dependency chain rather than the sum of all stages. After a stage finishes,
+its outputs and duration are saved as a row in the stageruns table, and the run
+itself is tracked in the pipelineruns table. A stage with bulky outputs (e.g.,
+an email body) gives a checkpoint function that reduces them to a reference
+and a restore function that rebuilds them from it, so the stageruns table
+never holds copies of the bodies. Stage and run durations are also
+recorded as metrics (see metrics.py) and flushed when the run ends. When a run fails, the next
+invocation resumes it: completed stages are not repeated, their checkpointed
+outputs are loaded back into the context, and execution continues from the
+first incomplete stage. A run still marked 'running' is only resumed once its
+heartbeat (refreshed whenever a stage starts or finishes) is older than
+RUN_LEASE_MINUTES, i.e. its process died; a run that is in progress elsewhere
+(an overlapping scheduler tick or manual run) is left alone.
+"""
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from metrics import record_timing, increment, flush as flush_metrics
+from structured_log import get_logger
+
+log = get_logger('pipeline')
+
+
+# A failing run is resumed at most this many times before it is abandoned
+MAX_RESUME_ATTEMPTS = 3
+
+# A 'running' run whose heartbeat is older than this is presumed dead and resumable
+RUN_LEASE_MINUTES = 15
+
+
+class SkipRun(Exception):
+    """Raised by a stage to end the run early without it counting as a failure."""
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Args:
+        name (str): Unique stage name (used as the checkpoint key)
+        func (callable): Called with the input values as keyword arguments;
+                         returns a dict containing every declared output
+        inputs (tuple): Context keys the stage reads
+        outputs (tuple): Context keys the stage produces
+        after (tuple): Names of stages that must finish first even though
+                       no data flows between them (e.g., a row must exist)
+        checkpoint (callable, optional): Called with the outputs; returns the
+                                         small dict saved in their place
+        restore (callable, optional): Called with that dict and the input values
+                                      as keyword arguments when a resumed run
+                                      needs the outputs; returns them
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), checkpoint=None, restore=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.after = tuple(after)
+        self.checkpoint = checkpoint
+        self.restore = restore
+
+    def run(self, context):
+        missing = [key for key in self.inputs if key not in context]
+        if missing:
+            raise KeyError(f"Stage '{self.name}' is missing inputs: {missing}")
+        result = self.func(**{key: context[key] for key in self.inputs}) or {}
+        missing = [key for key in self.outputs if key not in result]
+        if missing:
+            raise KeyError(f"Stage '{self.name}' did not produce outputs: {missing}")
+        return {key: result[key] for key in self.outputs}
+
+
+def _is_stale(run, now):
+    """True if a 'running' run has not shown signs of life within RUN_LEASE_MINUTES."""
+    last_seen = run['heartbeat'] or run['started']
+    return last_seen is None or now - last_seen > timedelta(minutes=RUN_LEASE_MINUTES)
+
+
+@tables.in_transaction
+def _claim_resumable_run(pipeline_name):
+    """
+    Finds the most recent failed (or stale running) run of a pipeline and
+    marks it running again, in one transaction so two invocations cannot
+    both claim it.
+
+    Returns:
+        Row: The claimed run, or None
+    """
+    now = datetime.now()
+    runs = app_tables.pipelineruns.search(
+        tables.order_by("started", ascending=False),
+        pipeline=pipeline_name,
+        status=q.any_of('running', 'failed')
+    )
+    for run in runs:
+        if run['status'] == 'running' and not _is_stale(run, now):
+            continue
+        if (run['attempts'] or 0) < MAX_RESUME_ATTEMPTS:
+            run.update(status='running', attempts=(run['attempts'] or 0) + 1, heartbeat=now)
+            return run
+        run['status'] = 'abandoned'
+    return None
+
+
+def _load_checkpoints(run):
+    """Returns {stage name: outputs} for the completed stages of a run."""
+    return {
+        row['stage']: row['outputs'] or {}
+        for row in app_tables.stageruns.search(run_id=run['run_id'], status='completed')
+    }
+
+
+def _restore_checkpoints(stages, checkpoints, context):
+    """
+    Loads the outputs of a resumed run's completed stages into the context.
+    Outputs saved as a reference are only rebuilt when a stage that has yet
+    to run (or another rebuild) needs them.
+    """
+    needed = set()
+    for stage in stages:
+        if stage.name not in checkpoints:
+            needed.update(stage.inputs)
+    for stage in reversed(stages):
+        if stage.name in checkpoints and stage.restore is not None and needed & set(stage.outputs):
+            needed.update(stage.inputs)
+    for stage in stages:
+        if stage.name not in checkpoints:
+            continue
+        saved = checkpoints[stage.name]
+        if stage.restore is None:
+            context.update(saved)
+        elif needed & set(stage.outputs):
+            context.update(stage.restore(saved, **{key: context[key] for key in stage.inputs if key in context}))
+
+
+def _record_stage(run, stage_name, status, outputs, duration_ms, error=None):
+    app_tables.stageruns.add_row(
+        run_id=run['run_id'],
+        pipeline=run['pipeline'],
+        stage=stage_name,
+        status=status,
+        outputs=outputs,
+        duration_ms=duration_ms,
+        error=error,
+        completed=datetime.now()
+    )
+
+
+def stage_dependencies(stages):
+    """
+    Returns {stage name: set of stage names it depends on}.
+
+    Inputs that no stage produces are expected in the initial context.
+
+    Raises:
+        ValueError: If a stage names an 'after' stage that is unknown or declared later
+    """
+    producers = {}
+    dependencies = {}
+    for stage in stages:
+        needed = set(stage.after)
+        for key in stage.inputs:
+            if key in producers:
+                needed.add(producers[key])
+        unknown = needed - set(dependencies)
+        if unknown:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown or later stages: {sorted(unknown)}")
+        dependencies[stage.name] = needed
+        for key in stage.outputs:
+            producers[key] = stage.name
+    return dependencies
+
+
+def _timed_run(stage, inputs, profiler=None):
+    """Runs a stage in a worker thread and returns (outputs, duration_ms, skip or None)."""
+    started = time.perf_counter()
+    try:
+        if profiler is None:
+            outputs = stage.run(inputs)
+        else:
+            outputs = profiler.profile_call(stage.run, inputs)
+        return outputs, (time.perf_counter() - started) * 1000, None
+    except SkipRun as skip:
+        return None, (time.perf_counter() - started) * 1000, skip
+
+
+def run_pipeline(pipeline_name, stages, context=None, resume=True, max_workers=4, profiler=None):
+    """
+    Runs (or resumes) a pipeline.
+
+    Args:
+        pipeline_name (str): Name used to group runs in the run-state tables
+        stages (list): Ordered list of Stage objects
+        context (dict, optional): Initial context values
+        resume (bool): Resume the latest incomplete run instead of starting fresh
+        max_workers (int): Maximum number of stages running at once
+        profiler (RunProfiler, optional): Profiles every stage run (see profiling.py)
+
+    Returns:
+        dict: The final context, plus 'run_id', 'run_status', 'stage_durations'
+              (ms) and 'total_ms' (wall time of this invocation)
+    """
+    dependencies = stage_dependencies(stages)
+    context = dict(context or {})
+    run = _claim_resumable_run(pipeline_name) if resume else None
+    checkpoints = {}
+    if run is not None:
+        checkpoints = _load_checkpoints(run)
+        print(f"Resuming run {run['run_id']} of {pipeline_name} "
+              f"({len(checkpoints)} of {len(stages)} stages already complete)")
+    else:
+        run = app_tables.pipelineruns.add_row(
+            run_id=uuid.uuid4().hex,
+            pipeline=pipeline_name,
+            status='running',
+            attempts=1,
+            newsletter_id=None,
+            current_stage=None,
+            started=datetime.now(),
+            heartbeat=datetime.now(),
+            completed=None
+        )
+
+    try:
+        _restore_checkpoints(stages, checkpoints, context)
+    except Exception:
+        # e.g., the email a checkpoint refers to is gone; counts as a failed attempt
+        run['status'] = 'failed'
+        raise
+    done = set(checkpoints) & set(dependencies)
+
+    stages_by_name = {stage.name: stage for stage in stages}
+    durations = {}
+    running = {}
+    skipped = None
+    failure = None
+    run_started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Start every stage whose dependencies are all complete
+            if skipped is None and failure is None:
+                for stage in stages:
+                    if (stage.name not in done and stage.name not in running.values()
+                            and dependencies[stage.name] <= done):
+                        inputs = {key: context[key] for key in stage.inputs if key in context}
+                        running[executor.submit(_timed_run, stage, inputs, profiler)] = stage.name
+                current_stage = ', '.join(sorted(running.values())) or None
+                if current_stage != run['current_stage']:
+                    run.update(current_stage=current_stage, heartbeat=datetime.now())
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage_name = running.pop(future)
+                try:
+                    outputs, duration_ms, skip = future.result()
+                except Exception as e:
+                    _record_stage(run, stage_name, 'failed', None, None, f"{type(e).__name__}: {e}")
+                    # Also prints the buffered lower-level records leading up to the failure
+                    log.error("stage failed", pipeline=pipeline_name, stage=stage_name, error=f"{type(e).__name__}: {e}")
+                    failure = failure or e
+                    continue
+
+                durations[stage_name] = duration_ms
+                record_timing(f'stage.{stage_name}', duration_ms)
+                if skip is not None:
+                    _record_stage(run, stage_name, 'skipped', None, duration_ms, str(skip))
+                    print(f"Run skipped at stage '{stage_name}': {skip}")
+                    skipped = skip
+                    continue
+
+                context.update(outputs)
+                done.add(stage_name)
+                stage = stages_by_name[stage_name]
+                saved = stage.checkpoint(outputs) if stage.checkpoint is not None else outputs
+                _record_stage(run, stage_name, 'completed', saved, duration_ms)
+                if context.get('newsletter_id') and not run['newsletter_id']:
+                    run['newsletter_id'] = context['newsletter_id']
+                print(f"Stage '{stage_name}' completed in {duration_ms:.0f} ms")
+
+    total_ms = (time.perf_counter() - run_started) * 1000
+    if failure is not None:
+        run['status'] = 'failed'
+        increment('runs.failed')
+        flush_metrics()
+        raise failure
+    if skipped is not None:
+        run.update(status='skipped', current_stage=None, completed=datetime.now())
+        increment('runs.skipped')
+        flush_metrics()
+        return dict(context, run_id=run['run_id'], run_status='skipped', stage_durations=durations, total_ms=total_ms)
+
+    run.update(status='completed', current_stage=None, completed=datetime.now())
+    record_timing('run.total', total_ms)
+    increment('runs.completed')
+    flush_metrics()
+    return dict(context, run_id=run['run_id'], run_status='completed', stage_durations=durations, total_ms=total_ms)
+
+
+@anvil.server.callable
+def get_stage_durations(pipeline_name='process_newsletter', limit=200):
+    """
+    Summarizes recent per-stage durations so the dominant stage is visible.
+
+    Args:
+        pipeline_name (str): Pipeline to summarize
+        limit (int): Number of most recent completed stage rows to include
+
+    Returns:
+        dict: {stage: {'runs': n, 'avg_ms': x, 'max_ms': y}}
+    """
+    summary = {}
+    rows = app_tables.stageruns.search(
+        tables.order_by("completed", ascending=False),
+        pipeline=pipeline_name,
+        status='completed'
+    )
+    for index, row in enumerate(rows):
+        if index >= limit:
+            break
+        stats = summary.setdefault(row['stage'], {'runs': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        duration = row['duration_ms'] or 0.0
+        stats['runs'] += 1
+        stats['total_ms'] += duration
+        stats['max_ms'] = max(stats['max_ms'], duration)
+    return {
+        stage: {'runs': s['runs'], 'avg_ms': s['total_ms'] / s['runs'], 'max_ms': s['max_ms']}
+        for stage, s in summary.items()
+    }
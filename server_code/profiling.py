@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+profiling.py
+On-demand cProfile/tracemalloc capture for a single run.
+
+A RunProfiler is only created when a caller asks for profiling (e.g.,
+process_newsletter(profile=True)); otherwise no profiling code runs at all.
+cProfile only sees the thread it is enabled in, so each profiled call (a
+pipeline stage running on a worker thread) gets its own cProfile.Profile, and
+the results are merged when the run ends. tracemalloc is process-wide, so
+concurrent captures (e.g., one per source when process_newsletter runs
+sources in parallel) share it: it is started by the first capture to begin
+and stopped when the last one ends, and their peaks and allocation sites
+include each other's. The top functions by cumulative time and the top
+allocation sites are stored in the profileartifacts table under the run_id.
+"""
+
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import anvil.server
+import anvil.tables as tables
+from anvil.tables import app_tables
+
+
+DEFAULT_TOP_N = 25
+
+# Captures currently using tracemalloc, and whether one of them started it
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def _acquire_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _release_tracemalloc():
+    """Takes a snapshot and the peak, then stops tracemalloc if this was the last capture that needed it."""
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+    return snapshot, peak
+
+
+class RunProfiler:
+    """
+    Collects CPU and allocation profiles for one run.
+
+    Args:
+        label (str): What is being profiled (e.g., the pipeline name)
+        top_n (int): Number of functions and allocation sites to keep
+    """
+
+    def __init__(self, label, top_n=DEFAULT_TOP_N):
+        self.label = label
+        self.top_n = top_n
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._started = None
+        self.result = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        _acquire_tracemalloc()
+        return self
+
+    def profile_call(self, func, *args, **kwargs):
+        """Calls func under its own cProfile.Profile and keeps the profile."""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._profiles.append(profile)
+
+    def __exit__(self, exc_type, exc, tb):
+        snapshot, peak = _release_tracemalloc()
+        self.result = {
+            'label': self.label,
+            'duration_ms': (time.perf_counter() - self._started) * 1000,
+            'peak_kb': peak / 1024,
+            'top_functions': self._top_functions(),
+            'top_allocations': self._top_allocations(snapshot)
+        }
+        return False
+
+    def _top_functions(self):
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return []
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        rows = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                'function': f"{filename}:{line}({name})",
+                'calls': ncalls,
+                'tottime_ms': tottime * 1000,
+                'cumtime_ms': cumtime * 1000
+            })
+        rows.sort(key=lambda row: row['cumtime_ms'], reverse=True)
+        return rows[:self.top_n]
+
+    def _top_allocations(self, snapshot):
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        return [
+            {'site': str(stat.traceback[0]), 'size_kb': stat.size / 1024, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:self.top_n]
+        ]
+
+
+def store_profile(run_id, result):
+    """
+    Stores a RunProfiler result as an artifact of a run.
+
+    Args:
+        run_id (str): The pipeline run (or replay) ID
+        result (dict): RunProfiler.result
+    """
+    app_tables.profileartifacts.add_row(
+        run_id=run_id,
+        label=result['label'],
+        duration_ms=result['duration_ms'],
+        peak_kb=result['peak_kb'],
+        top_functions=result['top_functions'],
+        top_allocations=result['top_allocations'],
+        created=datetime.now()
+    )
+
+
+@anvil.server.callable
+def get_profiles(limit=10):
+    """
+    Returns the most recent stored profiles, newest first.
+
+    Returns:
+        list: Dicts with run_id, label, created, duration_ms, peak_kb,
+              top_functions and top_allocations
+    """
+    rows = app_tables.profileartifacts.search(tables.order_by("created", ascending=False))
+    profiles = []
+    for row in rows:
+        if len(profiles) >= limit:
+            break
+        profiles.append({
+            'run_id': row['run_id'],
+            'label': row['label'],
+            'created': row['created'],
+            'duration_ms': row['duration_ms'],
+            'peak_kb': row['peak_kb'],
+            'top_functions': row['top_functions'],
+            'top_allocations': row['top_allocations']
+        })
+    return profiles
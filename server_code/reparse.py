@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+reparse.py
+Re-parses stored newsletters after a parser change.
+
+Every parsed_sections row is stamped with the PARSER_VERSION that produced it.
+reparse_all streams the newsletters metadata, skips rows already at the
+current version (so an unchanged parser costs one pass over two tables and
+no parsing or body fetches), and sends the rest in batches through worker_dispatch, which
+spreads a batch across the Uplink worker's process pool (or parses
+in-process when no worker is connected). Each batch is written in a single
+transaction, its cached summary renderings are invalidated, its search
+postings are rebuilt and its level snapshot is replaced (which backfills the
+level history for issues received before snapshots were kept; stored diffs
+are left as they were).
+
+keylevelsraw only holds the current levels of each source, so key levels
+are re-extracted for the latest newsletter of each source only.
+"""
+
+import time
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+import worker_dispatch
+from body_store import get_bodies
+from db_access import update_reparsed_sections, extract_and_store_key_levels
+from email_parser import PARSER_VERSION, load_vdlines
+from issue_diff import level_snapshot, section_hashes, store_snapshot
+from search_index import index_newsletter
+from sources import DEFAULT_SOURCE_NAME, get_sources
+from summary_artifacts import invalidate_artifact
+from structured_log import get_logger
+
+
+DEFAULT_BATCH_SIZE = 20
+
+log = get_logger('reparse')
+
+
+def _stored_versions():
+    """Returns {newsletter_id: parser_version} for all parsed_sections rows."""
+    return {row['newsletter_id']: row['parser_version'] for row in app_tables.parsed_sections.search()}
+
+
+def _source_name(row):
+    """The source of a newsletters row (rows from before sources existed have none)."""
+    return row['source'] or DEFAULT_SOURCE_NAME
+
+
+def _batch_item(row, sources, reclean):
+    """The clean_and_parse_batch item for a newsletters row, or None if it has no body."""
+    raw_body, cleaned_body = get_bodies(row)
+    if cleaned_body and not reclean:
+        return {'cleaned_body': cleaned_body}
+    if not raw_body:
+        return None
+    source = sources.get(_source_name(row))
+    return {'raw_body': raw_body, 'profile': source.cleaning_profile if source else None}
+
+
+def _process_batch(batch, sources, vdlines, reclean):
+    """Parses and stores one batch; returns {newsletter_id: parsed_data}."""
+    pairs = [(row, _batch_item(row, sources, reclean)) for row in batch]
+    pairs = [(row, item) for row, item in pairs if item is not None]
+    if not pairs:
+        return {}
+    results = worker_dispatch.clean_and_parse_batch([item for _, item in pairs], vdlines)
+    writes = []
+    for (row, item), (cleaned_body, parsed_data) in zip(pairs, results):
+        writes.append((row['newsletter_id'], cleaned_body if 'raw_body' in item else None, parsed_data))
+    update_reparsed_sections(writes)
+    for (row, _), (newsletter_id, _, parsed_data), (cleaned_body, _) in zip(pairs, writes, results):
+        invalidate_artifact(newsletter_id)
+        index_newsletter(newsletter_id, cleaned_body, parsed_data)
+        store_snapshot(_source_name(row), newsletter_id, level_snapshot(parsed_data), section_hashes(parsed_data))
+    return {newsletter_id: parsed_data for newsletter_id, _, parsed_data in writes}
+
+
+@anvil.server.background_task
+def reparse_all(force=False, reclean=False, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Re-parses every stored newsletter whose parsed sections are stale.
+
+    Args:
+        force (bool): Re-parse even rows already at the current parser version
+        reclean (bool): Re-clean raw_body instead of using the stored cleaned_body
+        batch_size (int): Newsletters per worker call and per transaction
+
+    Returns:
+        dict: 'scanned', 'reparsed', 'skipped', 'parser_version' and 'duration_ms'
+    """
+    started = time.perf_counter()
+    versions = _stored_versions()
+    sources = {source.name: source for source in get_sources()}
+    vdlines = load_vdlines()
+    scanned = reparsed = 0
+    sources_by_id = {}
+    latest_by_source = {}
+    reparsed_latest = {}
+    batch = []
+
+    def flush_batch():
+        nonlocal reparsed
+        parsed_by_id = _process_batch(batch, sources, vdlines, reclean)
+        reparsed += len(parsed_by_id)
+        for newsletter_id, parsed_data in parsed_by_id.items():
+            if latest_by_source.get(sources_by_id[newsletter_id]) == newsletter_id:
+                reparsed_latest[newsletter_id] = parsed_data
+        batch.clear()
+        anvil.server.task_state['progress'] = {'scanned': scanned, 'reparsed': reparsed}
+
+    for row in app_tables.newsletters.search(q.fetch_only("newsletter_id", "source"), tables.order_by("newsletter_id")):
+        scanned += 1
+        newsletter_id = row['newsletter_id']
+        sources_by_id[newsletter_id] = _source_name(row)
+        latest_by_source[_source_name(row)] = newsletter_id
+        if not force and versions.get(newsletter_id) == PARSER_VERSION:
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush_batch()
+    if batch:
+        flush_batch()
+
+    # Refresh the current key levels of each source whose latest newsletter changed
+    for source_name, newsletter_id in latest_by_source.items():
+        parsed_data = reparsed_latest.get(newsletter_id)
+        if parsed_data is not None:
+            source = sources.get(source_name)
+            extract_and_store_key_levels(
+                newsletter_id,
+                parsed_data.get("TradingPlanKeyLevels"),
+                parsed_data.get("KeyLevelsDetail", []),
+                source=source.key_levels_source if source else source_name
+            )
+
+    result = {
+        'scanned': scanned,
+        'reparsed': reparsed,
+        'skipped': scanned - reparsed,
+        'parser_version': PARSER_VERSION,
+        'duration_ms': (time.perf_counter() - started) * 1000
+    }
+    log.info("reparse_all finished", **result)
+    return result
+
+
+@anvil.server.callable
+def launch_reparse_all(force=False, reclean=False):
+    """Starts reparse_all as a background task and returns the task."""
+    return anvil.server.launch_background_task('reparse_all', force, reclean)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+search_index.py
+Full-text inverted index over the newsletter archive.
+
+Each cleaned body is split at its <SECTION> markers, and each section is
+tokenized (lowercase words and numbers such as '5700' or '5712.5'). The
+generated plan summary is indexed too, under the 'Summary' section. Common
+stopwords are not indexed, but positions still count them, so phrase
+matching stays exact.
+
+The searchindex table holds one row per (token, year) whose postings map
+newsletter_id -> {section: [token positions]}, so looking a term up reads
+one row per year of archive however many issues contain it. The searchdocs
+table records which tokens each newsletter was indexed under, so its
+postings can be replaced or removed without scanning the index. A
+newsletter's postings are written in one transaction with batched row
+updates: one read of its token rows, one batched update and one add_rows.
+
+A term query is one indexed search per term; a phrase query intersects the
+postings of its terms and checks their positions are consecutive. The
+pipeline's index stage re-indexes a newsletter whenever it is stored, and
+reparse_all re-indexes what it reparses; build_search_index backfills the
+archive (rebuild=True also clears rows written in an older layout).
+"""
+
+import re
+import time
+
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+
+from body_store import get_bodies
+from metrics import CountingTables, record_timing
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+(?:\.[0-9]+)?')
+SECTION_PATTERN = re.compile(r'<SECTION>(.*?)</SECTION>')
+QUERY_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'if', 'in', 'into',
+    'is', 'it', 'its', 'of', 'on', 'or', 'so', 'that', 'the', 'their', 'then', 'there', 'these',
+    'this', 'to', 'was', 'we', 'were', 'will', 'with', 'you', 'your'
+))
+
+# Text before the first <SECTION> marker
+PREAMBLE_SECTION = 'Preamble'
+SUMMARY_SECTION = 'Summary'
+
+DEFAULT_LIMIT = 50
+
+
+def tokenize(text):
+    """Returns the lowercase tokens of a text, stopwords included."""
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def split_sections(cleaned_body):
+    """
+    Splits a cleaned body at its <SECTION> markers.
+
+    Returns:
+        list: (section name, text) pairs in document order
+    """
+    sections = []
+    name = PREAMBLE_SECTION
+    position = 0
+    for match in SECTION_PATTERN.finditer(cleaned_body or ''):
+        sections.append((name, cleaned_body[position:match.start()]))
+        name = match.group(1).strip().rstrip(':')
+        position = match.end()
+    sections.append((name, (cleaned_body or '')[position:]))
+    return [(name, text) for name, text in sections if text.strip()]
+
+
+def build_postings(cleaned_body, parsed_data=None):
+    """
+    Builds the postings of one newsletter.
+
+    Returns:
+        dict: {token: {section: [positions]}}
+    """
+    sections = split_sections(cleaned_body)
+    if parsed_data and parsed_data.get("PlanSummary"):
+        sections.append((SUMMARY_SECTION, parsed_data["PlanSummary"]))
+    postings = {}
+    for section, text in sections:
+        for position, token in enumerate(tokenize(text)):
+            if token not in STOPWORDS:
+                postings.setdefault(token, {}).setdefault(section, []).append(position)
+    return postings
+
+
+def _year(newsletter_id):
+    """The postings partition of a newsletter (newsletter_id[:4] is its year)."""
+    return newsletter_id[:4]
+
+
+def _replace_postings(newsletter_id, postings):
+    """Replaces a newsletter's postings ({} removes them); must run in a transaction."""
+    year = _year(newsletter_id)
+    document = app_tables.searchdocs.get(newsletter_id=newsletter_id)
+    tokens = set(postings) | set((document['tokens'] or []) if document else [])
+    rows = {}
+    if tokens:
+        rows = {row['token']: row for row in app_tables.searchindex.search(token=q.any_of(*tokens), year=year)}
+
+    emptied = []
+    with tables.batch_update:
+        for token, row in rows.items():
+            entries = dict(row['postings'] or {})
+            entries.pop(newsletter_id, None)
+            if token in postings:
+                entries[newsletter_id] = postings[token]
+            if entries:
+                row['postings'] = entries
+            else:
+                emptied.append(row)
+    if emptied:
+        with tables.batch_delete:
+            for row in emptied:
+                row.delete()
+    added = [
+        dict(token=token, year=year, postings={newsletter_id: sections})
+        for token, sections in postings.items() if token not in rows
+    ]
+    if added:
+        app_tables.searchindex.add_rows(added)
+
+    if not postings:
+        if document is not None:
+            document.delete()
+    elif document is None:
+        app_tables.searchdocs.add_row(newsletter_id=newsletter_id, year=year, tokens=sorted(postings))
+    else:
+        document['tokens'] = sorted(postings)
+
+
+@tables.in_transaction
+def remove_newsletter(newsletter_id):
+    """Deletes a newsletter's postings."""
+    _replace_postings(newsletter_id, {})
+
+
+def is_indexed(newsletter_id):
+    """True if a newsletter has any postings."""
+    return app_tables.searchdocs.get(newsletter_id=newsletter_id) is not None
+
+
+@tables.in_transaction
+def _store_postings(newsletter_id, postings):
+    _replace_postings(newsletter_id, postings)
+
+
+def index_newsletter(newsletter_id, cleaned_body, parsed_data=None):
+    """
+    Replaces a newsletter's postings.
+
+    Args:
+        newsletter_id (str): Newsletter ID
+        cleaned_body (str): The cleaned body
+        parsed_data (dict, optional): parse_email result (for the plan summary)
+
+    Returns:
+        int: Number of distinct tokens indexed
+    """
+    postings = build_postings(cleaned_body, parsed_data)
+    _store_postings(newsletter_id, postings)
+    return len(postings)
+
+
+def parse_query(query):
+    """
+    Splits a query into terms and "quoted phrases".
+
+    Returns:
+        list: One list of tokens per term or phrase (stopwords kept, as None)
+    """
+    clauses = []
+    for phrase, word in QUERY_PATTERN.findall(query or ''):
+        tokens = [None if token in STOPWORDS else token for token in tokenize(phrase or word)]
+        if any(tokens):
+            clauses.append(tokens)
+    return clauses
+
+
+def _postings_for(token):
+    """Returns {newsletter_id: {section: set(positions)}} for a token."""
+    return {
+        newsletter_id: {section: set(positions) for section, positions in sections.items()}
+        for row in app_tables.searchindex.search(token=token)
+        for newsletter_id, sections in (row['postings'] or {}).items()
+    }
+
+
+def _match_clause(tokens, cache):
+    """
+    Finds where one term or phrase occurs.
+
+    Returns:
+        dict: {newsletter_id: {section: number of matches}}
+    """
+    offsets = [(offset, token) for offset, token in enumerate(tokens) if token]
+    for _, token in offsets:
+        if token not in cache:
+            cache[token] = _postings_for(token)
+    candidates = set(cache[offsets[0][1]])
+    for _, token in offsets[1:]:
+        candidates &= set(cache[token])
+
+    matches = {}
+    for newsletter_id in candidates:
+        first_offset, first_token = offsets[0]
+        for section, positions in cache[first_token][newsletter_id].items():
+            count = 0
+            for position in positions:
+                start = position - first_offset
+                if all(start + offset in cache[token][newsletter_id].get(section, ()) for offset, token in offsets[1:]):
+                    count += 1
+            if count:
+                matches.setdefault(newsletter_id, {})[section] = count
+    return matches
+
+
+@anvil.server.callable
+def search_newsletters(query, limit=DEFAULT_LIMIT):
+    """
+    Searches the archive. Every term and "quoted phrase" must occur in the
+    same newsletter (a phrase within one section).
+
+    Args:
+        query (str): e.g. 'FOMC "5700 (major)"'
+        limit (int): Maximum number of newsletters returned
+
+    Returns:
+        list: Newest first, dicts with 'newsletter_id', 'sections'
+              ({section: matches}) and 'matches' (total)
+    """
+    started = time.perf_counter()
+    clauses = parse_query(query)
+    if not clauses:
+        return []
+    cache = {}
+    combined = None
+    for tokens in clauses:
+        matches = _match_clause(tokens, cache)
+        if combined is None:
+            combined = matches
+        else:
+            combined = {
+                newsletter_id: {
+                    section: combined[newsletter_id].get(section, 0) + matches[newsletter_id].get(section, 0)
+                    for section in set(combined[newsletter_id]) | set(matches[newsletter_id])
+                }
+                for newsletter_id in set(combined) & set(matches)
+            }
+        if not combined:
+            break
+
+    results = [
+        {'newsletter_id': newsletter_id, 'sections': sections, 'matches': sum(sections.values())}
+        for newsletter_id, sections in combined.items()
+    ]
+    results.sort(key=lambda result: result['newsletter_id'], reverse=True)
+    record_timing('search.query', (time.perf_counter() - started) * 1000)
+    return results[:limit]
+
+
+@anvil.server.background_task
+def build_search_index(rebuild=False):
+    """
+    Indexes every stored newsletter that has no postings yet (or all of them).
+
+    Args:
+        rebuild (bool): Clear the index and re-index every newsletter
+
+    Returns:
+        int: Number of newsletters indexed
+    """
+    if rebuild:
+        app_tables.searchindex.delete_all_rows()
+        app_tables.searchdocs.delete_all_rows()
+    indexed = 0
+    for newsletter in app_tables.newsletters.search(q.fetch_only("newsletter_id"), tables.order_by("newsletter_id")):
+        newsletter_id = newsletter['newsletter_id']
+        if is_indexed(newsletter_id):
+            continue
+        _, cleaned_body = get_bodies(newsletter)
+        sections = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
+        plan_summary = sections['plan_summary'] if sections else None
+        index_newsletter(newsletter_id, cleaned_body, {"PlanSummary": plan_summary})
+        indexed += 1
+        anvil.server.task_state['indexed'] = indexed
+    print(f"Indexed {indexed} newsletters for search")
+    return indexed
+
+
+@anvil.server.callable
+def launch_search_index_build(rebuild=False):
+    """Starts build_search_index as a background task and returns the task."""
+    return anvil.server.launch_background_task('build_search_index', rebuild)
@@ -3,6 +3,11 @@
 send_summary.py
 Handles sending newsletter summaries and upcoming market events via email
 using Gmail integration in Anvil.
+
+The subscriber fan-out transport is chosen by the optional email_transport
+secret: 'gmail' (the default, Anvil's Gmail integration) or 'smtp', which
+reads smtp_host, smtp_port (default 587), smtp_sender, smtp_username,
+smtp_password and smtp_use_tls (default 'true') from secrets too.
 """
 
 import anvil.google.mail
@@ -11,466 +16,277 @@ import anvil.server
 import requests
 from anvil.tables import app_tables
 import anvil.tables as tables
+from market_calendar import get_upcoming_event_days
+from email_parser import parse_email
+from body_store import get_bodies
+from delivery_queue import deliver_summary, get_active_subscribers, AnvilMailTransport, SmtpTransport, DeliveryFailed
+from summary_artifacts import (
+    get_artifact,
+    store_artifact,
+    claim_send,
+    complete_send,
+    fail_send,
+    content_hash
+)
+from email_template import build_summary_model, render_summary_email
+from metrics import CountingTables, increment
 
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
 
-# HTML template as a string constant
-EMAIL_TEMPLATE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <style>
-        /* Reset styles */
-        body {
-            margin: 0;
-            padding: 0;
-            font-family: Arial, sans-serif;
-            line-height: 1.6;
-            color: #333333;
-            background-color: #f5f5f5;
-        }
-        
-        /* Container */
-        .email-container {
-            max-width: 600px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: #ffffff;
-        }
-        
-        /* Header */
-        .header {
-            background-color: #2c3e50;
-            color: #ffffff;
-            padding: 20px;
-            text-align: center;
-            border-radius: 5px 5px 0 0;
-        }
-        
-        .header h1 {
-            margin: 0;
-            font-size: 24px;
-        }
-        
-        /* Content sections */
-        .content-section {
-            padding: 20px;
-            margin: 15px 0;
-            background-color: #ffffff;
-            border: 1px solid #e0e0e0;
-            border-radius: 5px;
-        }
-        
-        .section-title {
-            color: #2c3e50;
-            font-size: 18px;
-            margin-top: 0;
-            padding-bottom: 10px;
-            border-bottom: 2px solid #f0f0f0;
-        }
-        
-        /* Events section */
-        .events-section {
-            background-color: #f8f9fa;
-            text-align: center;
-        }
-        
-        /* Footer */
-        .footer {
-            margin-top: 20px;
-            padding: 15px;
-            text-align: center;
-            font-size: 12px;
-            color: #666666;
-            border-top: 1px solid #e0e0e0;
-        }
-        
-        /* Key Levels styling */
-        .key-levels {
-            font-family: monospace;
-            white-space: pre-wrap;
-            background-color: #f8f9fa;
-            padding: 10px;
-            border-radius: 4px;
-            margin-top: 10px;
-        }
-        
-        .key-levels-raw {
-            font-size: 1.1em;
-            font-weight: bold;
-            display: block;
-            padding: 12px;
-            background-color: #f1f1f1;
-            border-left: 4px solid #2c3e50;
-            line-height: 1.8;
-        }
-        
-        .key-levels-detail {
-            margin-top: 15px;
-            padding: 12px;
-            border-left: 4px solid #4e6d8c;
-            background-color: #f9f9f9;
-            font-family: Arial, sans-serif;
-            font-size: 14px;
-        }
-        
-        .events-list {
-            margin: 0;
-            padding-left: 0;
-            list-style-type: none;
-        }
-        
-        .event-day {
-            font-size: 1.2em;
-            font-weight: bold;
-            margin-top: 15px;
-            margin-bottom: 10px;
-            color: #2c3e50;
-        }
-        
-        .event-item {
-            margin-bottom: 5px;
-        }
-        
-        .section-subtitle {
-            font-weight: bold;
-            color: #4e6d8c;
-            margin-top: 15px;
-            margin-bottom: 5px;
-            border-bottom: 1px solid #e0e0e0;
-            padding-bottom: 3px;
-        }
-        
-        .trading-plan {
-            font-family: Arial, sans-serif;
-            font-size: 14px;
-        }
-    </style>
-</head>
-<body>
-    <div class="email-container">
-        <div class="header">
-            <h1>Market Newsletter Summary</h1>
-        </div>
-        
-        <div class="content-section">
-            <h2 class="section-title">Market Timing</h2>
-            <p>{{ timing_detail }}</p>
-        </div>
-        
-        <div class="content-section events-section">
-            <h2 class="section-title">Upcoming Market Events</h2>
-            <div>{{ upcoming_events }}</div>
-        </div>
-        
-        <div class="content-section">
-            <h2 class="section-title">Key Levels</h2>
-            <div class="section-subtitle">Key Prices</div>
-            <div class="key-levels-raw">{{ key_levels_raw }}</div>
-            <div class="section-subtitle">Key Levels Detail</div>
-            <div class="key-levels-detail">{{ key_levels }}</div>
-        </div>
-        
-        <div class="content-section">
-            <h2 class="section-title">Market Summary</h2>
-            <div>{{ summary }}</div>
-        </div>
-        
-        <div class="footer">
-            <p>This is an automated summary from your Market Newsletter Aggregator</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
 
+def _optional_secret(name):
+    """Returns a secret's value, or None if the app does not define it."""
+    try:
+        return anvil.secrets.get_secret(name)
+    except anvil.secrets.SecretError:
+        return None
 
-def format_email_content(summary_data):
-    """
-    Formats the email content using the HTML template.
+
+def get_transport():
     """
-    # Format key levels raw as separate lines
-    raw_levels = summary_data.get('key_levels_raw', 'No key levels available')
-    if raw_levels != 'No key levels available':
-        levels_html = ''
-        for level in raw_levels.split('\n'):
-            if level.strip():
-                levels_html += f'{level}<br>'
-        key_levels_raw_html = levels_html
-    else:
-        key_levels_raw_html = raw_levels
+    Builds the delivery transport selected by the email_transport secret.
     
-    # Format upcoming events as a list with days highlighted
-    upcoming_events = summary_data.get('upcoming_events', 'No upcoming events available')
-    if upcoming_events != 'No upcoming events available':
-        events_lines = upcoming_events.strip().split('\n')
-        events_html = '<ul class="events-list">'
-        
-        current_day = None
-        for line in events_lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Check if this is a day header (contains day and date in parentheses)
-            if '(' in line and ')' in line and any(day in line for day in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']):
-                if current_day:  # Add spacing between days
-                    events_html += '<li style="height: 10px;"></li>'
-                current_day = line
-                events_html += f'<li class="event-day">{line}</li>'
-            else:
-                events_html += f'<li class="event-item">{line}</li>'
-        
-        events_html += '</ul>'
-    else:
-        events_html = '<p>No upcoming events available</p>'
-    
-    # Format key levels details with better spacing
-    key_levels_detail = summary_data.get('key_levels', 'No key levels details available')
-    if key_levels_detail != 'No key levels details available':
-        # Process each line to add proper spacing and formatting
-        lines = key_levels_detail.split('\n')
-        formatted_details = []
-        for line in lines:
-            line = line.strip()
-            if ':' in line and not line.startswith('KEY LEVELS DETAIL'):
-                level_parts = line.split(':', 1)
-                if len(level_parts) == 2:
-                    formatted_details.append(f'<strong>{level_parts[0].strip()}:</strong> {level_parts[1].strip()}')
-            elif line and not line.startswith('KEY LEVELS DETAIL') and not line.startswith('KEY LEVELS RAW'):
-                formatted_details.append(line)
-        
-        key_levels_detail_html = '<p>' + '</p><p>'.join(formatted_details) + '</p>'
-    else:
-        key_levels_detail_html = '<p>No key levels details available</p>'
-    
-    # Format trading plan with proper styling
-    summary = summary_data.get('summary', 'No summary available')
-    if summary != 'No summary available':
-        # Split into sections
-        parts = summary.split('TRADING PLAN')
-        market_summary_html = parts[0].strip()
-        
-        if len(parts) > 1:
-            trading_plan_html = f"""
-            <div class="section-subtitle">Trading Plan</div>
-            <div class="trading-plan">{parts[1].strip()}</div>
-            """
-            full_summary_html = f"""
-            <div>{market_summary_html}</div>
-            {trading_plan_html}
-            """
-        else:
-            full_summary_html = f"<div>{market_summary_html}</div>"
-    else:
-        full_summary_html = "<p>No summary available</p>"
-    
-    # Replace template variables
-    html_content = EMAIL_TEMPLATE.replace('{{ summary }}', full_summary_html)\
-                                .replace('{{ timing_detail }}', summary_data.get('timing_detail', 'No timing information available'))\
-                                .replace('{{ upcoming_events }}', events_html)\
-                                .replace('{{ key_levels_raw }}', key_levels_raw_html)\
-                                .replace('{{ key_levels }}', key_levels_detail_html)
-    
-    # Plain text version
-    text_content = f"""
-    Market Newsletter Summary
+    Returns:
+        AnvilMailTransport or SmtpTransport
+    """
+    transport = (_optional_secret('email_transport') or 'gmail').strip().lower()
+    if transport == 'gmail':
+        return AnvilMailTransport()
+    if transport != 'smtp':
+        raise ValueError(f"Unknown email_transport: {transport}")
+    host = _optional_secret('smtp_host')
+    if not host:
+        raise ValueError("email_transport is 'smtp' but the smtp_host secret is not set")
+    return SmtpTransport(
+        host,
+        port=int(_optional_secret('smtp_port') or 587),
+        sender=_optional_secret('smtp_sender'),
+        username=_optional_secret('smtp_username'),
+        password=_optional_secret('smtp_password'),
+        use_tls=(_optional_secret('smtp_use_tls') or 'true').strip().lower() != 'false'
+    )
 
-    Market Timing:
-    {summary_data.get('timing_detail', 'No timing information available')}
 
-    Upcoming Market Events:
-    {summary_data.get('upcoming_events', 'No upcoming events available')}
+def format_email_content(summary_data):
+    """
+    Formats the email content using the pre-compiled HTML template.
+    
+    Args:
+        summary_data (dict): Structured summary data from get_latest_summary
+    
+    Returns:
+        tuple: (html_content, text_content) rendered from the same structured data
+    """
+    return render_summary_email(summary_data)
 
-    Key Levels:
-    {summary_data.get('key_levels_raw', 'No key levels available')}
 
-    Key Levels Detail:
-    {summary_data.get('key_levels', 'No key levels details available')}
+def get_structured_summary(row):
+    """
+    Returns the structured parse result stored on a parsed_sections row.
+    Rows written before the column existed are re-parsed once from the stored
+    cleaned body and backfilled, so later reads never touch the text again.
+    """
+    structured = row['structured_summary']
+    if structured is None:
+        newsletter = app_tables.newsletters.get(newsletter_id=row['newsletter_id'])
+        cleaned_body = get_bodies(newsletter)[1] if newsletter else None
+        if not cleaned_body:
+            return None
+        structured = parse_email(cleaned_body)["Structured"]
+        row['structured_summary'] = structured
+    return structured
 
-    Market Summary:
-    {summary_data.get('summary', 'No summary available')}
 
-    --
-    This is an automated summary from your Market Newsletter Aggregator
+def get_summary(newsletter_id=None):
+    """
+    Retrieves a summary from the parsed_sections table as structured data ready
+    for rendering. Uses the most recent newsletter if no newsletter_id is given.
     """
+    if newsletter_id is None:
+        latest_sections = app_tables.parsed_sections.search(
+            tables.order_by("newsletter_id", ascending=False)
+        )
+        if not latest_sections:
+            return None
+        latest = latest_sections[0]
+    else:
+        latest = app_tables.parsed_sections.get(newsletter_id=newsletter_id)
+        if latest is None:
+            return None
     
-    return html_content, text_content
+    # Upcoming events come straight from the structured weekly digest
+    event_days = latest['upcoming_events_days']
+    if event_days is None:
+        event_days = get_upcoming_event_days(latest['newsletter_id'])
+    
+    summary_data = build_summary_model(
+        get_structured_summary(latest),
+        latest['timing_detail'],
+        event_days,
+        latest['level_diff']
+    )
+    summary_data['newsletter_id'] = latest['newsletter_id']
+    return summary_data
 
 
 def get_latest_summary():
     """
-    Retrieves the most recent summary from the parsed_sections table.
+    Retrieves the most recent summary from the parsed_sections table
+    as structured data ready for rendering.
     """
+    return get_summary()
+
+
+def get_latest_newsletter_id():
+    """Returns the newsletter_id of the most recent parsed_sections row, or None."""
     latest_sections = app_tables.parsed_sections.search(
         tables.order_by("newsletter_id", ascending=False)
     )
+    return latest_sections[0]['newsletter_id'] if latest_sections else None
+
+
+def get_rendered_summary(newsletter_id):
+    """
+    Returns the rendered (html, text) summary for a newsletter, rendering and
+    storing the artifact only the first time.
     
-    if not latest_sections:
-        return None
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
         
-    latest = latest_sections[0]
+    Returns:
+        tuple: (html_content, text_content), or None if there is no summary
+    """
+    artifact = get_artifact(newsletter_id)
+    if artifact is not None:
+        increment('cache.artifact.hit')
+        return artifact
+    increment('cache.artifact.miss')
     
-    # Format key levels if they exist
-    key_levels_raw = latest['key_levels_raw'] if latest['key_levels_raw'] else ''
-    key_levels = latest['key_levels'] if latest['key_levels'] else ''
+    summary_data = get_summary(newsletter_id)
+    if not summary_data:
+        return None
+    html_content, text_content = format_email_content(summary_data)
+    store_artifact(newsletter_id, html_content, text_content)
+    return html_content, text_content
+
+
+def render_parsed_summary(newsletter_id, parsed_data, event_days, level_diff=None):
+    """
+    Renders and stores the summary artifact straight from an in-memory parse
+    result, so the pipeline can render while the parsed sections are still
+    being written.
     
-    # Format raw levels (numbers) on separate lines
-    if key_levels_raw:
-        # Process raw key levels to keep price and vdline info together
-        formatted_lines = []
-        
-        # Split by whitespace but preserve bracketed text together
-        import re
-        tokens = []
-        current_raw = key_levels_raw
-        
-        # Extract prices with their associated vdline info
-        bracket_pattern = re.compile(r'(\d+)(\s+\[\w+\s+at\s+\d+\])?')
-        matches = bracket_pattern.findall(current_raw)
-        
-        for price, vdline_info in matches:
-            if vdline_info:
-                formatted_lines.append(f"{price}{vdline_info}")
-            else:
-                formatted_lines.append(price)
-        
-        formatted_raw = '\n'.join(formatted_lines)
-    else:
-        formatted_raw = 'No key levels available'
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+        parsed_data (dict): Output of parse_email
+        event_days (list): Structured upcoming event days
+        level_diff (dict, optional): Changes since the previous issue (see issue_diff.py)
+        
+    Returns:
+        str: The content hash of the stored artifact
+    """
+    summary_data = build_summary_model(
+        parsed_data.get("Structured"),
+        parsed_data.get("timing_detail"),
+        event_days,
+        level_diff
+    )
+    html_content, text_content = format_email_content(summary_data)
+    return store_artifact(newsletter_id, html_content, text_content)
+
+
+@anvil.server.callable
+def preview_summary(newsletter_id=None):
+    """
+    Returns the stored HTML rendering of a newsletter's summary for preview.
+    Uses the most recent newsletter if no newsletter_id is given.
+    """
+    newsletter_id = newsletter_id or get_latest_newsletter_id()
+    rendered = get_rendered_summary(newsletter_id) if newsletter_id else None
+    return rendered[0] if rendered else None
+
+
+@anvil.server.callable
+def send_summary_email(newsletter_id=None):
+    """
+    Sends a newsletter summary and upcoming events via email.
+    Uses the most recent newsletter if no newsletter_id is given.
     
-    # Format detailed levels
-    if key_levels:
-        # Remove the section headers from the content
-        content = key_levels.replace('KEY LEVELS DETAIL', '').replace('KEY LEVELS RAW', '')
-        
-        # Clean up consecutive newlines and whitespace
-        import re
-        content = re.sub(r'\n+', '\n', content.strip())
-        
-        # Split by new lines, preserving price:description format
-        lines = content.split('\n')
-        formatted_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            if line:
-                formatted_lines.append(line)
-        
-        formatted_levels = '\n'.join(formatted_lines)
-    else:
-        formatted_levels = 'No key levels details available'
+    Each newsletter is sent at most once: the send ledger must be claimed first,
+    so re-runs and overlapping scheduled runs return without sending. Clients
+    can call this, so it never re-sends; see resend_summary_email.
+    """
+    return send_summary(newsletter_id)
+
+
+def resend_summary_email(newsletter_id):
+    """
+    Deliberately sends a newsletter's summary again, to every recipient.
+    Not callable from clients; run it from the server (e.g., the Server Console).
+    """
+    return send_summary(newsletter_id, force=True)
+
+
+def send_summary(newsletter_id=None, force=False):
+    """
+    Sends a newsletter summary once (see send_summary_email).
     
-    # Format upcoming events with proper line breaks and highlighting days
-    upcoming_events = latest['upcoming_events'] if latest['upcoming_events'] else ''
-    if upcoming_events:
-        # Process the events to format them better by day
-        import re
-        
-        # Find day headers (e.g., "Tuesday (3/11)")
-        day_pattern = re.compile(r'([A-Za-z]+)\s*\((\d+/\d+)\)')
-        
-        # Reorganize events by day
-        days_and_events = {}
-        current_day = None
-        
-        for line in upcoming_events.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Check if this is a day header
-            day_match = day_pattern.search(line)
-            if day_match:
-                day_name = day_match.group(1)
-                day_date = day_match.group(2)
-                current_day = f"{day_name} ({day_date})"
-                days_and_events[current_day] = []
-            elif current_day and " - " in line:
-                days_and_events[current_day].append(line)
-        
-        # Format the reorganized events
-        formatted_events_lines = []
-        for day, events in days_and_events.items():
-            formatted_events_lines.append(day)
-            formatted_events_lines.extend(events)
-            # Add an empty line between days for spacing
-            if day != list(days_and_events.keys())[-1]:  # Not the last day
-                formatted_events_lines.append("")
-        
-        formatted_events = '\n'.join(formatted_events_lines)
-    else:
-        formatted_events = 'No upcoming events available'
+    When the subscribers table has active rows the summary is fanned out through
+    the delivery queue; otherwise it falls back to a single Gmail send to the
+    recipient addresses in Anvil secrets.
     
-    # Format the summary to remove duplicate section headers and key levels information
-    summary_text = latest['summary'] if latest['summary'] else ''
-    if summary_text:
-        # Find the real market summary section
-        import re
-        
-        # Remove all KEY LEVELS sections
-        lines = summary_text.split('\n')
-        clean_lines = []
-        
-        # Skip state
-        skip_mode = False
-        
-        for line in lines:
-            # If we see KEY LEVELS, start skipping
-            if 'KEY LEVELS' in line:
-                skip_mode = True
-                continue
-                
-            # If we see "This week was" or "MARKET SUMMARY", we've reached the actual summary
-            if line.strip().startswith('This week was') or line.strip() == 'MARKET SUMMARY':
-                skip_mode = False
-            
-            # Skip lines with price:description pattern (likely key level details)
-            if re.match(r'^\d+:', line.strip()):
-                continue
-                
-            # Skip lines that are just digits or digits with brackets (key levels)
-            if re.match(r'^\d+(\s+\[\w+\s+at\s+\d+\])?$', line.strip()):
-                continue
-                
-            if not skip_mode:
-                # Remove section header
-                line = line.replace('MARKET SUMMARY', '')
-                if line.strip():
-                    clean_lines.append(line.strip())
-        
-        # Include everything from the beginning to the end, including TRADING PLAN
-        summary_text = '\n'.join(clean_lines)
-        summary_text = summary_text.strip()
+    Args:
+        newsletter_id (str, optional): Newsletter to send; the most recent if omitted
+        force (bool): Send even if it was already sent, including to subscribers
+                      whose delivery is marked 'sent'
     
-    return {
-        'summary': summary_text,
-        'timing_detail': latest['timing_detail'],
-        'upcoming_events': formatted_events,
-        'key_levels_raw': formatted_raw,
-        'key_levels': formatted_levels
-    }
+    Returns:
+        bool: True if the summary was sent
 
-
-@anvil.server.callable
-def send_summary_email():
-    """
-    Sends the latest newsletter summary and upcoming events via email.
-    Uses Gmail integration and retrieves recipient addresses from Anvil secrets.
+    Raises:
+        DeliveryFailed: Some subscribers could not be sent to; the send ledger
+                        is marked failed so a re-run retries just those
     """
+    newsletter_id = newsletter_id or get_latest_newsletter_id()
+    if not newsletter_id:
+        print("No summary data available to send")
+        return False
+    
+    if not claim_send(newsletter_id, force=force):
+        print(f"Summary for newsletter {newsletter_id} was already sent. Skipping.")
+        return False
+    
     try:
-        # Get the latest summary data
-        summary_data = get_latest_summary()
-        if not summary_data:
+        # Get the stored rendering, rendering it once if needed
+        rendered = get_rendered_summary(newsletter_id)
+        if not rendered:
             print("No summary data available to send")
+            fail_send(newsletter_id, "No summary data available")
             return False
-            
+        html_content, text_content = rendered
+        
+        # Fan out per recipient when there is a subscriber list
+        subscribers = get_active_subscribers()
+        if subscribers:
+            result = deliver_summary(
+                newsletter_id,
+                html_content,
+                text_content,
+                recipients=subscribers,
+                transport=get_transport(),
+                force=force
+            )
+            if result['failed']:
+                # Fail the caller's run too, so it is resumed and the failed recipients retried
+                raise DeliveryFailed(f"{result['failed']} of {len(subscribers)} recipients failed")
+            complete_send(newsletter_id, content_hash(html_content, text_content))
+            return True
+        
         # Get email addresses from secrets
         to_address = anvil.secrets.get_secret('recipient_email')
         bcc_addresses = anvil.secrets.get_secret('recipient_bcc')
         
-        # Format the email content
-        html_content, text_content = format_email_content(summary_data)
-        
         # Send the email
         anvil.google.mail.send(
             to=to_address,
@@ -479,10 +295,12 @@ def send_summary_email():
             html=html_content,
             text=text_content
         )
+        complete_send(newsletter_id, content_hash(html_content, text_content))
         
         print("Summary email sent successfully")
         return True
         
     except Exception as e:
+        fail_send(newsletter_id, e)
         print(f"Error sending summary email: {str(e)}")
-        raise 
\ No newline at end of file
+        raise
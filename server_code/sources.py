@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+sources.py
+Registry of newsletter sources.
+
+Each row of the newslettersources table describes one sender: the Gmail query
+used to find its emails, the cleaning profile applied to them and the namespace
+appended to its newsletter_ids, so two newsletters received on the same day get
+different IDs. The default source, built from the newsletter_sender_email
+secret, is always included and keeps the original YYYYMMDD IDs; a row named
+DEFAULT_SOURCE_NAME overrides it (or, if inactive, turns it off).
+"""
+
+import anvil.secrets
+from anvil.tables import app_tables
+
+
+DEFAULT_SOURCE_NAME = 'default'
+DEFAULT_PIPELINE_NAME = 'process_newsletter'
+
+
+class NewsletterSource:
+    """
+    One newsletter sender and how to process its emails.
+
+    Args:
+        name (str): Unique source name
+        sender_email (str): Address the newsletter is sent from
+        query (str, optional): Gmail search query; defaults to recent mail from the sender
+        cleaning_profile (str, optional): Cleaning profile for this sender's format;
+                                          detected from each email when omitted
+        id_namespace (str): Suffix for newsletter_ids; '' keeps plain YYYYMMDD IDs
+    """
+
+    def __init__(self, name, sender_email, query=None, cleaning_profile=None, id_namespace=''):
+        self.name = name
+        self.sender_email = sender_email
+        self.query = query or f"from:{sender_email} newer_than:2d"
+        self.cleaning_profile = cleaning_profile or None
+        self.id_namespace = id_namespace or ''
+
+    @property
+    def is_default(self):
+        return not self.id_namespace
+
+    @property
+    def pipeline_name(self):
+        """Run-state name, kept as 'process_newsletter' for the default source."""
+        return DEFAULT_PIPELINE_NAME if self.is_default else f"{DEFAULT_PIPELINE_NAME}:{self.name}"
+
+    @property
+    def key_levels_source(self):
+        """Value stored in keylevelsraw.source (None for the default source)."""
+        return None if self.is_default else self.name
+
+    def newsletter_id(self, received_date):
+        """
+        Builds the newsletter_id for an email from this source.
+        The date always comes first so newsletter_id[:8] is the YYYYMMDD date.
+
+        Args:
+            received_date (datetime): When the email was received
+
+        Returns:
+            str: e.g. "20250211" for the default source, "20250211-spx" otherwise
+        """
+        date_part = received_date.strftime("%Y%m%d")
+        return f"{date_part}-{self.id_namespace}" if self.id_namespace else date_part
+
+
+def default_source():
+    """Builds the single source configured through Anvil secrets."""
+    return NewsletterSource(
+        name=DEFAULT_SOURCE_NAME,
+        sender_email=anvil.secrets.get_secret('newsletter_sender_email')
+    )
+
+
+def get_sources():
+    """
+    Returns the active newsletter sources.
+
+    Returns:
+        list: NewsletterSource objects: the default source (unless a row
+              overrides it) followed by the active registered sources
+    """
+    rows = list(app_tables.newslettersources.search())
+    sources = [
+        NewsletterSource(
+            name=row['name'],
+            sender_email=row['sender_email'],
+            query=row['query'],
+            cleaning_profile=row['cleaning_profile'],
+            id_namespace=row['id_namespace']
+        )
+        for row in rows if row['active']
+    ]
+    if not any(row['name'] == DEFAULT_SOURCE_NAME for row in rows):
+        try:
+            sources.insert(0, default_source())
+        except anvil.secrets.SecretError:
+            # Only registered sources are configured
+            if not sources:
+                raise
+    return sources
+
+
+def get_source(name):
+    """
+    Returns the active source with the given name.
+
+    Raises:
+        ValueError: If there is no such source
+    """
+    for source in get_sources():
+        if source.name == name:
+            return source
+    raise ValueError(f"Unknown newsletter source: {name}")
+
+
+def register_source(name, sender_email, id_namespace, query=None, cleaning_profile=None):
+    """
+    Adds or updates a newsletter source.
+    Not callable from clients; run it from the server (e.g., the Server Console).
+
+    Args:
+        name (str): Unique source name
+        sender_email (str): Address the newsletter is sent from
+        id_namespace (str): Suffix for this source's newsletter_ids (must be unique);
+                            '' only for DEFAULT_SOURCE_NAME, which keeps plain YYYYMMDD IDs
+        query (str, optional): Gmail search query override
+        cleaning_profile (str, optional): Cleaning profile name (auto-detected when omitted)
+
+    Raises:
+        ValueError: If the namespace is empty for another source, set for the
+                    default source, or used by another source
+    """
+    id_namespace = (id_namespace or '').strip()
+    if name == DEFAULT_SOURCE_NAME and id_namespace:
+        raise ValueError(f"Source '{DEFAULT_SOURCE_NAME}' keeps plain YYYYMMDD IDs; its ID namespace must be empty")
+    if name != DEFAULT_SOURCE_NAME and not id_namespace:
+        raise ValueError(f"Source '{name}' needs an ID namespace, or its newsletter_ids would clash with the default source's")
+    clash = app_tables.newslettersources.get(id_namespace=id_namespace)
+    if clash is not None and clash['name'] != name:
+        raise ValueError(f"ID namespace '{id_namespace}' is already used by source '{clash['name']}'")
+
+    values = dict(
+        sender_email=sender_email,
+        query=query,
+        cleaning_profile=cleaning_profile,
+        id_namespace=id_namespace,
+        active=True
+    )
+    row = app_tables.newslettersources.get(name=name)
+    if row:
+        row.update(**values)
+    else:
+        app_tables.newslettersources.add_row(name=name, **values)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+summary_artifacts.py
+Stores the rendered summary email once per newsletter_id and records sends.
+
+The summaryartifacts table keeps the rendered HTML and text with a SHA-256
+content hash, so re-sends and previews read one row instead of re-querying and
+re-rendering. The sendledger table holds one row per newsletter_id; a send must
+claim that row inside a transaction first, which makes a second send of the
+same newsletter (a manual re-run, or two overlapping scheduled runs) a no-op.
+"""
+
+import hashlib
+from datetime import datetime, timedelta
+
+import anvil.tables as tables
+from anvil.tables import app_tables
+
+from metrics import CountingTables
+
+# Count Data Tables calls made through this module (see metrics.py)
+app_tables = CountingTables(app_tables)
+
+
+# A 'sending' claim older than this is treated as abandoned by a crashed run
+STALE_CLAIM_MINUTES = 30
+
+
+def content_hash(html_content, text_content):
+    """Returns the SHA-256 hex digest of a rendered summary."""
+    digest = hashlib.sha256()
+    digest.update(html_content.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(text_content.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_artifact(newsletter_id):
+    """
+    Returns the stored rendering for a newsletter.
+
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+
+    Returns:
+        tuple: (html_content, text_content), or None if nothing is stored
+    """
+    row = app_tables.summaryartifacts.get(newsletter_id=newsletter_id)
+    if row is None:
+        return None
+    return row['html'], row['text']
+
+
+def store_artifact(newsletter_id, html_content, text_content):
+    """
+    Stores (or replaces) the rendering for a newsletter.
+
+    Returns:
+        str: The content hash of the stored artifact
+    """
+    digest = content_hash(html_content, text_content)
+    row = app_tables.summaryartifacts.get(newsletter_id=newsletter_id)
+    if row is not None:
+        if row['content_hash'] != digest:
+            row.update(content_hash=digest, html=html_content, text=text_content, created=datetime.now())
+        return digest
+    app_tables.summaryartifacts.add_row(
+        newsletter_id=newsletter_id,
+        content_hash=digest,
+        html=html_content,
+        text=text_content,
+        created=datetime.now()
+    )
+    return digest
+
+
+def invalidate_artifact(newsletter_id):
+    """
+    Deletes the stored rendering so the next read re-renders it
+    (e.g., after the newsletter's parsed sections were rebuilt).
+    """
+    row = app_tables.summaryartifacts.get(newsletter_id=newsletter_id)
+    if row is not None:
+        row.delete()
+
+
+@tables.in_transaction
+def claim_send(newsletter_id, force=False):
+    """
+    Claims the right to send a newsletter's summary.
+
+    Runs in a transaction, so of two overlapping runs only one can claim.
+    A claim succeeds when there is no ledger row, when the previous attempt
+    failed, when a previous 'sending' claim has gone stale, or when force is set.
+
+    Args:
+        newsletter_id (str): Newsletter ID in YYYYMMDD format
+        force (bool): Claim even if the summary was already sent
+
+    Returns:
+        bool: True if the caller should send
+    """
+    now = datetime.now()
+    row = app_tables.sendledger.get(newsletter_id=newsletter_id)
+    if row is None:
+        app_tables.sendledger.add_row(
+            newsletter_id=newsletter_id,
+            status='sending',
+            claimed_at=now,
+            completed_at=None,
+            send_count=0,
+            last_error=None
+        )
+        return True
+
+    stale = row['claimed_at'] is None or now - row['claimed_at'] > timedelta(minutes=STALE_CLAIM_MINUTES)
+    if force or row['status'] == 'failed' or (row['status'] == 'sending' and stale):
+        row.update(status='sending', claimed_at=now, last_error=None)
+        return True
+    return False
+
+
+def complete_send(newsletter_id, content_digest):
+    """Marks a claimed send as finished."""
+    row = app_tables.sendledger.get(newsletter_id=newsletter_id)
+    if row is not None:
+        row.update(
+            status='sent',
+            completed_at=datetime.now(),
+            content_hash=content_digest,
+            send_count=(row['send_count'] or 0) + 1
+        )
+
+
+def fail_send(newsletter_id, error):
+    """Marks a claimed send as failed so a later run may retry it."""
+    row = app_tables.sendledger.get(newsletter_id=newsletter_id)
+    if row is not None:
+        row.update(status='failed', completed_at=datetime.now(), last_error=str(error))
+
+
+def get_send_status(newsletter_id):
+    """
+    Returns the ledger status for a newsletter ('sending', 'sent', 'failed'),
+    or None if no send was ever attempted.
+    """
+    row = app_tables.sendledger.get(newsletter_id=newsletter_id)
+    return row['status'] if row else None
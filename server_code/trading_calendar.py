@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+trading_calendar.py
+Precomputed NYSE trading-session calendar.
+
+Sessions, exchange holidays and early closes are generated once per process for a
+window of years around today and kept in sorted arrays, so every question the app
+asks ("next session after t", "sessions in this week", "is the market open") is a
+bisect over those arrays instead of fresh weekday arithmetic and timezone setup.
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time, timedelta
+
+import pytz
+
+
+EASTERN = pytz.timezone('America/New_York')
+CENTRAL = pytz.timezone('America/Chicago')
+
+REGULAR_OPEN = time(9, 30)
+REGULAR_CLOSE = time(16, 0)
+EARLY_CLOSE = time(13, 0)
+
+# Years before and after the current year covered by the precomputed arrays
+YEARS_BEFORE = 2
+YEARS_AFTER = 5
+
+_calendar = None
+
+
+def _nth_weekday(year, month, weekday, n):
+    """Returns the nth (1-based) given weekday of a month, or the last one if n == -1."""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    last = next_month - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year):
+    """Returns Easter Sunday for a year (anonymous Gregorian algorithm)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _observed(day):
+    """Shifts a fixed-date holiday off the weekend the way NYSE observes it."""
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def exchange_holidays(year):
+    """
+    Returns the full-day NYSE holidays for a year.
+
+    Args:
+        year (int): Calendar year
+
+    Returns:
+        dict: Mapping of date to holiday name
+    """
+    holidays = {
+        _nth_weekday(year, 1, 0, 3): "Martin Luther King Jr. Day",
+        _nth_weekday(year, 2, 0, 3): "Presidents' Day",
+        _easter(year) - timedelta(days=2): "Good Friday",
+        _nth_weekday(year, 5, 0, -1): "Memorial Day",
+        _observed(date(year, 7, 4)): "Independence Day",
+        _nth_weekday(year, 9, 0, 1): "Labor Day",
+        _nth_weekday(year, 11, 3, 4): "Thanksgiving Day",
+        _observed(date(year, 12, 25)): "Christmas Day",
+    }
+    # New Year's Day is not moved back into the previous year when it falls on a Saturday
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        holidays[_observed(new_year)] = "New Year's Day"
+    if year >= 2022:
+        holidays[_observed(date(year, 6, 19))] = "Juneteenth"
+    return holidays
+
+
+def early_closes(year, holidays):
+    """
+    Returns the 1:00 PM ET early-close days for a year.
+
+    Args:
+        year (int): Calendar year
+        holidays (dict): Full-day holidays for the same year
+
+    Returns:
+        set: Dates with an early close
+    """
+    candidates = {
+        date(year, 7, 3),
+        _nth_weekday(year, 11, 3, 4) + timedelta(days=1),
+        date(year, 12, 24),
+    }
+    return {day for day in candidates if day.weekday() < 5 and day not in holidays}
+
+
+class TradingCalendar:
+    """
+    Sorted session arrays for a range of years.
+
+    Sessions are stored as parallel lists: session dates as ordinals, and the
+    open/close instants as UTC timestamps, all in ascending order.
+    """
+
+    def __init__(self, first_year, last_year):
+        self.first_year = first_year
+        self.last_year = last_year
+        self.holidays = {}
+        self.early_closes = set()
+        self.session_ordinals = []
+        self.open_timestamps = []
+        self.close_timestamps = []
+
+        for year in range(first_year, last_year + 1):
+            year_holidays = exchange_holidays(year)
+            year_early = early_closes(year, year_holidays)
+            self.holidays.update(year_holidays)
+            self.early_closes.update(year_early)
+
+            day = date(year, 1, 1)
+            while day.year == year:
+                if day.weekday() < 5 and day not in year_holidays:
+                    close_time = EARLY_CLOSE if day in year_early else REGULAR_CLOSE
+                    self.session_ordinals.append(day.toordinal())
+                    self.open_timestamps.append(
+                        EASTERN.localize(datetime.combine(day, REGULAR_OPEN)).timestamp())
+                    self.close_timestamps.append(
+                        EASTERN.localize(datetime.combine(day, close_time)).timestamp())
+                day += timedelta(days=1)
+
+    def is_session(self, day):
+        """Returns True if the market has a session on the given date."""
+        ordinal = day.toordinal()
+        index = bisect_left(self.session_ordinals, ordinal)
+        return index < len(self.session_ordinals) and self.session_ordinals[index] == ordinal
+
+    def next_session_after(self, moment):
+        """
+        Returns the first session on a date after the given instant's date, so a
+        call made before today's open still names the next trading day.
+
+        Args:
+            moment (datetime): Timezone-aware instant; its date is taken in its own timezone
+
+        Returns:
+            date: Session date
+
+        Raises:
+            ValueError: If the next session lies beyond the precomputed range
+        """
+        return self.next_session_after_date(moment.date())
+
+    def next_session_after_date(self, day):
+        """
+        Returns the first session date strictly after the given date.
+
+        Raises:
+            ValueError: If the next session lies beyond the precomputed range
+        """
+        index = bisect_right(self.session_ordinals, day.toordinal())
+        if index >= len(self.session_ordinals):
+            raise ValueError(f"{day} is beyond the trading calendar ({self.first_year}-{self.last_year})")
+        return date.fromordinal(self.session_ordinals[index])
+
+    def sessions_in_week(self, day):
+        """
+        Returns the session dates in the Monday-Sunday week containing day.
+
+        Args:
+            day (date): Any date in the week
+
+        Returns:
+            list: Session dates in ascending order
+        """
+        monday = day.toordinal() - day.weekday()
+        start = bisect_left(self.session_ordinals, monday)
+        end = bisect_left(self.session_ordinals, monday + 7)
+        return [date.fromordinal(o) for o in self.session_ordinals[start:end]]
+
+    def remaining_week_sessions(self, day):
+        """
+        Returns the sessions after day in the same week, or the following week's
+        sessions if none remain (e.g., after the Friday session or at the weekend).
+
+        Args:
+            day (date): Reference date
+
+        Returns:
+            tuple: (list of session dates, True if they belong to the following week)
+        """
+        ordinal = day.toordinal()
+        week_end = ordinal - day.weekday() + 7
+        start = bisect_right(self.session_ordinals, ordinal)
+        end = bisect_left(self.session_ordinals, week_end)
+        if start < end:
+            return [date.fromordinal(o) for o in self.session_ordinals[start:end]], False
+        end = bisect_left(self.session_ordinals, week_end + 7)
+        return [date.fromordinal(o) for o in self.session_ordinals[start:end]], True
+
+    def is_market_open(self, moment):
+        """
+        Returns True if the given instant falls inside a regular session.
+
+        Args:
+            moment (datetime): Timezone-aware instant
+        """
+        timestamp = moment.timestamp()
+        index = bisect_right(self.open_timestamps, timestamp) - 1
+        return index >= 0 and timestamp < self.close_timestamps[index]
+
+
+def get_trading_calendar():
+    """
+    Returns the process-wide trading calendar, building it on first use.
+    """
+    global _calendar
+    if _calendar is None:
+        this_year = date.today().year
+        _calendar = TradingCalendar(this_year - YEARS_BEFORE, this_year + YEARS_AFTER)
+    return _calendar
+
+
+def next_session_after(moment):
+    """
+    Returns the first session on a date after the given instant's date.
+
+    Instants outside the process-wide calendar's range are answered from a
+    calendar built just for their year and the next.
+    """
+    calendar = get_trading_calendar()
+    if not calendar.first_year <= moment.year < calendar.last_year:
+        calendar = TradingCalendar(moment.year, moment.year + 1)
+    return calendar.next_session_after(moment)
+
+
+def sessions_in_week(day):
+    """Returns the session dates in the week containing day."""
+    return get_trading_calendar().sessions_in_week(day)
+
+
+def remaining_week_sessions(day):
+    """Returns the remaining sessions of day's week, or next week's if none remain."""
+    return get_trading_calendar().remaining_week_sessions(day)
+
+
+def is_market_open(moment):
+    """Returns True if the market is in a regular session at the given instant."""
+    return get_trading_calendar().is_market_open(moment)
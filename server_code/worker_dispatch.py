@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+worker_dispatch.py
+Sends CPU-heavy cleaning and parsing to the Uplink worker when it is connected.
+
+The worker (uplink_worker/worker.py, run on our own machine) registers the
+worker_* server functions and runs them on a local ProcessPoolExecutor. Each
+function here calls the worker and falls back to running in-process when no
+worker is connected (anvil.server.NoServerFunctionError) or it times out.
+After a failed call the worker is not tried again for WORKER_RETRY_SECONDS,
+so a missing worker costs one failed call per minute, not one per level.
+
+Cleaning goes through clean_cache first, so a body that was cleaned before
+is never sent to the worker (or cleaned in-process) again.
+"""
+
+import threading
+import time
+
+import anvil.server
+
+import clean_cache
+from email_parser import clean_newsletter, parse_email, load_vdlines, match_levels_to_vdlines
+from metrics import increment
+from structured_log import get_logger
+
+
+WORKER_RETRY_SECONDS = 60
+
+log = get_logger('worker_dispatch')
+
+_lock = threading.Lock()
+_worker_down_until = 0.0
+
+
+def _call_worker(function_name, *args):
+    """
+    Calls a worker function.
+
+    Returns:
+        tuple: (True, result) from the worker, or (False, None) if it is unavailable
+    """
+    global _worker_down_until
+    if time.monotonic() < _worker_down_until:
+        return False, None
+    try:
+        result = anvil.server.call(function_name, *args)
+    except (anvil.server.NoServerFunctionError, anvil.server.TimeoutError) as e:
+        with _lock:
+            _worker_down_until = time.monotonic() + WORKER_RETRY_SECONDS
+        log.info("worker unavailable, running in-process", function=function_name, error=str(e))
+        increment('worker.fallback')
+        return False, None
+    increment('worker.calls')
+    return True, result
+
+
+def worker_available():
+    """True if the Uplink worker answers a ping."""
+    available, _ = _call_worker('worker_ping')
+    return available
+
+
+def _clean_uncached(raw_body, profile=None):
+    ok, result = _call_worker('worker_clean_newsletter', raw_body, profile)
+    return result if ok else clean_newsletter(raw_body, profile)
+
+
+def clean(raw_body, profile=None):
+    """clean_newsletter from the cache, else on the worker, or in-process."""
+    return clean_cache.cached_clean(raw_body, profile, _clean_uncached)
+
+
+def parse(cleaned_body, vdlines=None):
+    """parse_email on the worker, or in-process."""
+    if vdlines is None:
+        vdlines = load_vdlines()
+    ok, result = _call_worker('worker_parse_email', cleaned_body, vdlines)
+    return result if ok else parse_email(cleaned_body, vdlines)
+
+
+def match_levels(levels, vdlines=None, max_distance=3):
+    """match_levels_to_vdlines on the worker, or in-process."""
+    if vdlines is None:
+        vdlines = load_vdlines()
+    ok, result = _call_worker('worker_match_levels', levels, vdlines, max_distance)
+    return result if ok else match_levels_to_vdlines(levels, vdlines, max_distance)
+
+
+def clean_and_parse_batch(items, vdlines=None):
+    """
+    Cleans (if needed) and parses many newsletters, spread across the
+    worker's processes when it is connected.
+
+    Args:
+        items (list): Dicts with 'cleaned_body', or 'raw_body' and optional 'profile'
+        vdlines (list, optional): Preloaded vdlines (see load_vdlines)
+
+    Returns:
+        list: (cleaned_body, parsed_data) tuples in the order of items
+    """
+    if vdlines is None:
+        vdlines = load_vdlines()
+
+    # Serve cleanings from the cache; only misses are cleaned (and then cached)
+    keys = {}
+    items = list(items)
+    for index, item in enumerate(items):
+        if not item.get('cleaned_body') and item.get('raw_body'):
+            key = clean_cache.cache_key(item['raw_body'], item.get('profile'))
+            cleaned_body = clean_cache.lookup(key)
+            if cleaned_body is None:
+                keys[index] = key
+            else:
+                items[index] = {'cleaned_body': cleaned_body}
+
+    ok, result = _call_worker('worker_clean_and_parse_batch', items, vdlines)
+    if ok:
+        results = [tuple(pair) for pair in result]
+    else:
+        results = []
+        for item in items:
+            cleaned_body = item.get('cleaned_body') or clean_newsletter(item.get('raw_body'), item.get('profile'))
+            results.append((cleaned_body, parse_email(cleaned_body, vdlines)))
+    for index, key in keys.items():
+        clean_cache.store(key, results[index][0])
+    return results
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+conftest.py
+Runs the server modules locally without Anvil.
+
+The Anvil runtime modules (anvil, anvil.server, anvil.tables,
+anvil.tables.query, anvil.secrets, anvil.media, anvil.google.mail) are
+replaced by a small in-memory stand-in before any server module is imported:
+app_tables creates tables on first use, and search() understands keyword
+matches, the query operators, order_by and fetch_only. Secrets are read from
+secrets.values. Every test starts with empty tables and no secrets.
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server_code'))
+
+
+class _Condition:
+    def __init__(self, test):
+        self.test = test
+
+
+class _FetchOnly:
+    def __init__(self, *columns, **linked):
+        self.columns = columns
+
+
+def _matches(value, condition):
+    if isinstance(condition, _Condition):
+        return condition.test(value)
+    return value == condition
+
+
+def _ordered(test):
+    return lambda value: value is not None and test(value)
+
+
+query = types.ModuleType('anvil.tables.query')
+query.fetch_only = _FetchOnly
+query.less_than = lambda bound: _Condition(_ordered(lambda value: value < bound))
+query.less_than_or_equal_to = lambda bound: _Condition(_ordered(lambda value: value <= bound))
+query.greater_than = lambda bound: _Condition(_ordered(lambda value: value > bound))
+query.greater_than_or_equal_to = lambda bound: _Condition(_ordered(lambda value: value >= bound))
+query.between = lambda low, high, min_inclusive=True, max_inclusive=False: _Condition(_ordered(
+    lambda value: (value >= low if min_inclusive else value > low) and (value <= high if max_inclusive else value < high)
+))
+query.any_of = lambda *options: _Condition(lambda value: any(_matches(value, option) for option in options))
+query.none_of = lambda *options: _Condition(lambda value: not any(_matches(value, option) for option in options))
+query.not_ = query.none_of
+
+
+class order_by:
+    def __init__(self, *columns, ascending=True):
+        self.columns = columns
+        self.ascending = ascending
+
+
+class Row(dict):
+    """A Data Tables row: missing columns read as None."""
+
+    def __init__(self, table, values):
+        super().__init__(values)
+        self._table = table
+
+    def __getitem__(self, column):
+        return self.get(column)
+
+    def update(self, **values):
+        super().update(values)
+
+    def delete(self):
+        self._table.rows.remove(self)
+
+    def get_id(self):
+        return str(id(self))
+
+
+class SearchIterator(list):
+    def delete_all_rows(self):
+        for row in list(self):
+            row.delete()
+
+
+class Table:
+    def __init__(self, name):
+        self.name = name
+        self.rows = []
+
+    def add_row(self, **values):
+        row = Row(self, values)
+        self.rows.append(row)
+        return row
+
+    def add_rows(self, rows):
+        return [self.add_row(**values) for values in rows]
+
+    def search(self, *args, **conditions):
+        rows = [row for row in self.rows if all(_matches(row.get(c), v) for c, v in conditions.items())]
+        for arg in reversed(args):
+            if isinstance(arg, order_by):
+                for column in reversed(arg.columns):
+                    rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=not arg.ascending)
+        return SearchIterator(rows)
+
+    def get(self, **conditions):
+        rows = self.search(**conditions)
+        if len(rows) > 1:
+            raise RuntimeError(f"More than one row in {self.name} matched {conditions}")
+        return rows[0] if rows else None
+
+    def delete_all_rows(self):
+        self.rows.clear()
+
+
+class AppTables:
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        table = Table(name)
+        setattr(self, name, table)
+        return table
+
+    def reset(self):
+        self.__dict__.clear()
+
+
+class Transaction:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# anvil.tables.batch_update / batch_delete are used as `with tables.batch_update:`
+batch_update = Transaction()
+batch_delete = Transaction()
+
+
+def in_transaction(func=None, **options):
+    return func if func is not None else (lambda inner: inner)
+
+
+def _passthrough_decorator(func=None, *args, **kwargs):
+    return func if callable(func) else (lambda inner: inner)
+
+
+class NoServerFunctionError(Exception):
+    pass
+
+
+class BlobMedia:
+    def __init__(self, content_type, content, name=None):
+        self.content_type = content_type
+        self.name = name
+        self._content = bytes(content)
+
+    def get_bytes(self):
+        return self._content
+
+    @property
+    def length(self):
+        return len(self._content)
+
+
+app_tables = AppTables()
+
+tables_module = types.ModuleType('anvil.tables')
+tables_module.app_tables = app_tables
+tables_module.order_by = order_by
+tables_module.Transaction = Transaction
+tables_module.in_transaction = in_transaction
+tables_module.batch_update = batch_update
+tables_module.batch_delete = batch_delete
+tables_module.TransactionConflict = type('TransactionConflict', (Exception,), {})
+tables_module.query = query
+
+server = types.ModuleType('anvil.server')
+server.callable = _passthrough_decorator
+server.background_task = _passthrough_decorator
+server.portable_class = _passthrough_decorator
+server.task_state = {}
+server.launch_background_task = lambda name, *args, **kwargs: None
+server.NoServerFunctionError = NoServerFunctionError
+server.TimeoutError = type('TimeoutError', (Exception,), {})
+
+
+def _no_server_function(name, *args, **kwargs):
+    raise NoServerFunctionError(f"No server function matching \"{name}\" has been registered")
+
+
+server.call = _no_server_function
+
+secrets = types.ModuleType('anvil.secrets')
+secrets.SecretError = type('SecretError', (Exception,), {})
+secrets.values = {}
+
+
+def _get_secret(name):
+    if name not in secrets.values:
+        raise secrets.SecretError(f"No secret called '{name}'")
+    return secrets.values[name]
+
+
+secrets.get_secret = _get_secret
+
+media = types.ModuleType('anvil.media')
+
+google = types.ModuleType('anvil.google')
+google_mail = types.ModuleType('anvil.google.mail')
+google_mail.sent = []
+google_mail.send = lambda **message: google_mail.sent.append(message)
+google.mail = google_mail
+
+anvil = types.ModuleType('anvil')
+anvil.BlobMedia = BlobMedia
+anvil.Media = BlobMedia
+anvil.server = server
+anvil.tables = tables_module
+anvil.secrets = secrets
+anvil.media = media
+anvil.google = google
+
+sys.modules.update({
+    'anvil': anvil,
+    'anvil.server': server,
+    'anvil.tables': tables_module,
+    'anvil.tables.query': query,
+    'anvil.secrets': secrets,
+    'anvil.media': media,
+    'anvil.google': google,
+    'anvil.google.mail': google_mail,
+})
+
+
+@pytest.fixture(autouse=True)
+def empty_tables():
+    """Gives every test empty tables."""
+    app_tables.reset()
+    google_mail.sent.clear()
+    secrets.values.clear()
+    yield app_tables
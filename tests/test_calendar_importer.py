@@ -0,0 +1,60 @@
+import pytest
+
+from anvil.tables import app_tables
+
+from calendar_importer import import_calendar_lines, iter_ics_events, normalize_calendar_rows, normalize_time
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('8:30', '08:30'),
+    ('08:30:00', '08:30'),
+    ('8:30 AM', '08:30'),
+    ('1:45 p.m.', '13:45'),
+    ('2PM', '14:00'),
+    ('1330', '13:30'),
+    ('All Day', ''),
+    ('', ''),
+    ('soon', None),
+])
+def test_normalize_time(raw, expected):
+    assert normalize_time(raw) == expected
+
+
+def test_normalized_times_sort_chronologically():
+    times = [normalize_time(raw) for raw in ('10:00', '1:30 PM', '8:30')]
+    assert sorted(times) == ['08:30', '10:00', '13:30']
+
+
+def test_ics_times_are_converted_and_padded():
+    lines = [
+        'BEGIN:VCALENDAR',
+        'BEGIN:VEVENT',
+        'DTSTART:20250212T133000Z',
+        'SUMMARY:CPI',
+        'END:VEVENT',
+        'BEGIN:VEVENT',
+        'DTSTART;TZID=America/New_York:20250212T100000',
+        'SUMMARY:Crude Inventories',
+        'END:VEVENT',
+        'END:VCALENDAR',
+    ]
+    assert list(iter_ics_events(lines)) == [
+        ('2025-02-12', '07:30', 'CPI'),
+        ('2025-02-12', '09:00', 'Crude Inventories'),
+    ]
+
+
+def test_reimport_matches_unnormalized_rows_without_rewriting_them():
+    app_tables.marketcalendar.add_row(date='2025-02-12', time='8:30', event='CPI  m/m')
+    result = import_calendar_lines(['Date,Time,Event', '2025-02-12,8:30 AM,CPI m/m', '2025-02-12,10:00,Fed Speech'], 'csv')
+    assert result == {'rows_added': 1, 'duplicates_skipped': 1, 'rows_invalid': 0}
+    assert app_tables.marketcalendar.get(event='CPI  m/m')['time'] == '8:30'
+
+
+def test_normalization_migration_pads_times_and_merges_duplicates():
+    app_tables.marketcalendar.add_row(date='2025-02-12', time='8:30', event='CPI  m/m')
+    app_tables.marketcalendar.add_row(date='2025-02-12', time='08:30', event='CPI m/m')
+    app_tables.marketcalendar.add_row(date='2025-02-12', time='', event='Holiday')
+    assert normalize_calendar_rows() == {'rows_updated': 1, 'duplicates_deleted': 1}
+    rows = sorted((row['time'], row['event']) for row in app_tables.marketcalendar.search())
+    assert rows == [('', 'Holiday'), ('08:30', 'CPI m/m')]
@@ -0,0 +1,60 @@
+import pytest
+
+from anvil.tables import app_tables
+
+import clean_cache
+
+BODY = "Supports: 5700, 5680 (major). Resistances: 5725, 5740 (major)."
+
+
+@pytest.fixture(autouse=True)
+def cold_memory():
+    clean_cache.clear_memory()
+
+
+def counting_cleaner(calls):
+    def clean(raw_body, profile):
+        calls.append(raw_body)
+        return raw_body.upper()
+    return clean
+
+
+def test_second_clean_is_served_from_memory():
+    calls = []
+    first = clean_cache.cached_clean(BODY, clean=counting_cleaner(calls))
+    second = clean_cache.cached_clean(BODY, clean=counting_cleaner(calls))
+    assert first == second == BODY.upper()
+    assert len(calls) == 1
+
+
+def test_new_process_is_served_from_the_table_compressed():
+    calls = []
+    clean_cache.cached_clean(BODY, clean=counting_cleaner(calls))
+    clean_cache.clear_memory()
+    assert clean_cache.cached_clean(BODY, clean=counting_cleaner(calls)) == BODY.upper()
+    assert len(calls) == 1
+    (row,) = app_tables.cleancache.search()
+    assert row['cleaned_data'].get_bytes() != BODY.upper().encode('utf-8')
+
+
+def test_version_bump_recleans_and_overwrites_only_the_stale_row(monkeypatch):
+    calls = []
+    clean_cache.cached_clean(BODY, clean=counting_cleaner(calls))
+    clean_cache.cached_clean("Another body", clean=counting_cleaner(calls))
+    clean_cache.clear_memory()
+    monkeypatch.setattr(clean_cache, 'CLEANER_VERSION', clean_cache.CLEANER_VERSION + 1)
+    clean_cache.cached_clean(BODY, clean=counting_cleaner(calls))
+    assert len(calls) == 3
+    versions = sorted(row['cleaner_version'] for row in app_tables.cleancache.search())
+    assert versions == [clean_cache.CLEANER_VERSION - 1, clean_cache.CLEANER_VERSION]
+    assert clean_cache.purge_stale_clean_cache() == 1
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    monkeypatch.setattr(clean_cache, 'MEMORY_ENTRIES', 2)
+    for key in ('a', 'b'):
+        clean_cache._remember(key, key)
+    clean_cache.lookup('a')
+    clean_cache._remember('c', 'c')
+    assert clean_cache.lookup('b') is None
+    assert (clean_cache.lookup('a'), clean_cache.lookup('c')) == ('a', 'c')
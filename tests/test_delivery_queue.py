@@ -0,0 +1,34 @@
+from anvil.tables import app_tables
+
+from delivery_queue import deliver_summary
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, to_address, subject, html_content, text_content):
+        self.sent.append(to_address)
+
+
+RECIPIENTS = ['a@example.com', 'b@example.com']
+
+
+def deliver(transport, **kwargs):
+    return deliver_summary('20250211', '<p>hi</p>', 'hi', recipients=RECIPIENTS, transport=transport,
+                           rate_per_second=0, backoff_seconds=0, **kwargs)
+
+
+def test_redelivery_skips_recipients_already_sent():
+    transport = RecordingTransport()
+    assert deliver(transport) == {'sent': 2, 'failed': 0, 'skipped': 0}
+    assert deliver(transport) == {'sent': 0, 'failed': 0, 'skipped': 2}
+    assert sorted(transport.sent) == RECIPIENTS
+
+
+def test_forced_delivery_sends_to_everyone_again():
+    transport = RecordingTransport()
+    deliver(transport)
+    assert deliver(transport, force=True) == {'sent': 2, 'failed': 0, 'skipped': 0}
+    assert sorted(transport.sent) == sorted(RECIPIENTS * 2)
+    assert {row['status'] for row in app_tables.deliveries.search()} == {'sent'}
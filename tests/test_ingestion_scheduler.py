@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from anvil import secrets
+from anvil.tables import app_tables
+
+import ingestion_scheduler
+from ingestion_scheduler import (
+    BACKOFF_START_MINUTES, DEFAULT_WINDOW, FETCH_CALLS, MAX_CALLS_PER_DAY, in_window_interval, plan_next_poll, poll_source_if_due
+)
+from sources import default_source
+from trading_calendar import CENTRAL
+
+MONDAY = CENTRAL.localize(datetime(2025, 2, 10))
+
+
+class FakeGmail:
+    """process_source stand-in: one list call per poll, plus the fetch calls once the newsletter has arrived."""
+
+    def __init__(self, arrival):
+        self.arrival = arrival
+        self.calls = 0
+        self.polls = []
+        self.processed = False
+
+    def process_source(self, source):
+        now = self.polls[-1] if self.polls else None
+        self.calls += 1
+        if self.processed or now < self.arrival:
+            return 'unchanged'
+        self.calls += FETCH_CALLS
+        self.processed = True
+        app_tables.newsletters.add_row(
+            newsletter_id=self.arrival.strftime('%Y%m%d'), source=source.name, received_date=self.arrival.isoformat()
+        )
+        return 'completed'
+
+
+@pytest.fixture
+def run_day(monkeypatch):
+    def run(arrival, hours=24):
+        gmail = FakeGmail(arrival)
+        monkeypatch.setattr(ingestion_scheduler, 'process_source', gmail.process_source)
+        monkeypatch.setattr(ingestion_scheduler, 'calls_made', lambda: gmail.calls)
+        secrets.values['newsletter_sender_email'] = 'plan@example.com'
+        source = default_source()
+        tick = MONDAY
+        while tick < MONDAY + timedelta(hours=hours):
+            gmail.polls.append(tick)
+            if poll_source_if_due(source, tick) is None:
+                gmail.polls.pop()
+            tick += timedelta(minutes=5)
+        return gmail
+    return run
+
+
+def test_newsletter_is_found_within_one_interval_of_arriving(run_day):
+    arrival = MONDAY + timedelta(hours=15, minutes=50)
+    gmail = run_day(arrival)
+    found_at = next(poll for poll in gmail.polls if poll >= arrival)
+    assert found_at - arrival <= timedelta(minutes=in_window_interval(DEFAULT_WINDOW))
+    assert gmail.polls[-1] == found_at, "no polls once the newsletter is processed"
+    assert gmail.calls <= MAX_CALLS_PER_DAY
+
+
+def test_late_newsletter_is_polled_with_backoff_under_the_ceiling(run_day):
+    gmail = run_day(MONDAY + timedelta(days=2))
+    late = [poll for poll in gmail.polls if poll > MONDAY + timedelta(minutes=DEFAULT_WINDOW['end_minute'])]
+    gaps = [later - earlier for earlier, later in zip(late, late[1:])]
+    assert gaps == sorted(gaps)
+    assert gmail.calls <= MAX_CALLS_PER_DAY
+
+
+def test_backoff_doubles_outside_the_window():
+    evening = MONDAY + timedelta(hours=20)
+    first = plan_next_poll(DEFAULT_WINDOW, evening, False, 0, 1)
+    second = plan_next_poll(DEFAULT_WINDOW, evening, False, 0, 2)
+    assert (first - evening, second - evening) == (timedelta(minutes=BACKOFF_START_MINUTES), timedelta(minutes=2 * BACKOFF_START_MINUTES))
+
+
+def test_found_newsletter_waits_for_next_window():
+    friday = MONDAY + timedelta(days=4, hours=16)
+    assert plan_next_poll(DEFAULT_WINDOW, friday, True, 2, 0) == MONDAY + timedelta(days=7, minutes=DEFAULT_WINDOW['start_minute'])
@@ -0,0 +1,51 @@
+from anvil.tables import app_tables
+
+from issue_diff import compute_issue_diff, merge_levels
+
+
+def parsed(supports, details=(), plan="Buy dips"):
+    return {
+        'TradingPlanKeyLevels': {
+            'supports': [
+                {'price': price, 'price_with_range': str(price), 'severity': 'Major' if major else '', 'type': 'support'}
+                for price, major in supports
+            ],
+            'resistances': [],
+        },
+        'KeyLevelsDetail': [{'price': price, 'price_with_range': str(price)} for price in details],
+        'MarketSummary': "Calm", 'TradingPlan': plan, 'PlanSummary': "Up", 'KeyLevels': "Levels",
+    }
+
+
+def store_sections(newsletter_id, parsed_data):
+    app_tables.parsed_sections.add_row(newsletter_id=newsletter_id, trading_plan=parsed_data['TradingPlan'])
+
+
+def test_first_issue_has_nothing_to_compare():
+    diff = compute_issue_diff('default', '20250210', parsed([(5700, False)]))
+    assert diff['previous_id'] is None
+    assert diff['changed_sections'] == {}
+    assert app_tables.levelsnapshots.get(newsletter_id='20250210') is not None
+
+
+def test_diff_against_previous_issue():
+    monday = parsed([(5600, False), (5650, True), (5700, False)], details=[5800])
+    tuesday = parsed([(5601, True), (5700, False), (5720, False)], details=[5651], plan="Buy dips\nSell rips")
+    store_sections('20250210', monday)
+    compute_issue_diff('default', '20250210', monday)
+    diff = compute_issue_diff('default', '20250211', tuesday)
+    assert diff['previous_id'] == '20250210'
+    assert (diff['added'], diff['dropped']) == (['5720'], ['5800'])
+    assert (diff['upgraded'], diff['downgraded']) == (['5601'], ['5651'])
+    assert diff['changed_sections'] == {'trading_plan': ["+ Sell rips"]}
+
+
+def test_previous_issue_is_taken_from_the_same_source():
+    compute_issue_diff('spx', '20250210-spx', parsed([(5700, False)]))
+    assert compute_issue_diff('default', '20250211', parsed([(5700, False)]))['previous_id'] is None
+
+
+def test_merge_treats_nearby_prices_as_one_level():
+    previous = [{'price': 5700.0, 'label': '5700', 'major': False}]
+    current = [{'price': 5703.0, 'label': '5700-05', 'major': False}]
+    assert merge_levels(previous, current) == {'added': [], 'dropped': [], 'upgraded': [], 'downgraded': []}
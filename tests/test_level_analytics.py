@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from anvil.tables import app_tables
+
+from issue_diff import store_snapshot
+from level_analytics import VDLINE_DISTANCE, compute_level_analytics, get_level_analytics, load_level_history
+
+
+def history(levels_per_issue):
+    newsletter_ids = [f"202502{day + 1:02d}" for day in range(len(levels_per_issue))]
+    issues, prices, majors = [], [], []
+    for index, levels in enumerate(levels_per_issue):
+        for price, major in levels:
+            issues.append(index)
+            prices.append(price)
+            majors.append(major)
+    return (
+        newsletter_ids,
+        np.array(issues, dtype=np.int32),
+        np.array(prices, dtype=np.float64),
+        np.array(majors, dtype=bool)
+    )
+
+
+def brute_force(levels_per_issue, vdline_prices, bin_width):
+    """The per-bin statistics, computed one level at a time."""
+    bins = {}
+    for index, levels in enumerate(levels_per_issue):
+        for price, major in levels:
+            stats = bins.setdefault(price // bin_width * bin_width, {'issues': {}, 'distances': []})
+            stats['issues'][index] = stats['issues'].get(index, False) or major
+            stats['distances'].append(min(abs(price - vdline) for vdline in vdline_prices))
+    expected = {}
+    for price, stats in bins.items():
+        seen = sorted(stats['issues'])
+        longest = run = 0
+        for position, index in enumerate(seen):
+            run = run + 1 if position and seen[position - 1] == index - 1 else 1
+            longest = max(longest, run)
+        expected[price] = {
+            'issues': len(seen),
+            'major': sum(stats['issues'].values()),
+            'longest_streak': longest,
+            'current_streak': run if seen[-1] == len(levels_per_issue) - 1 else 0,
+            'last_seen': seen[-1],
+            'vdline_distance': sum(stats['distances']) / len(stats['distances']),
+            'near_vdline_rate': sum(d <= VDLINE_DISTANCE for d in stats['distances']) / len(stats['distances']),
+        }
+    return expected
+
+
+def test_matches_brute_force_on_random_history():
+    generator = random.Random(7)
+    levels_per_issue = [
+        [(float(generator.randrange(5600, 5800)), generator.random() < 0.3) for _ in range(generator.randrange(0, 12))]
+        for _ in range(40)
+    ]
+    vdline_prices = [5610.0, 5655.5, 5702.0, 5790.0]
+    newsletter_ids, issues, prices, majors = history(levels_per_issue)
+    result = compute_level_analytics(newsletter_ids, issues, prices, majors, vdline_prices, bin_width=5)
+
+    expected = brute_force(levels_per_issue, vdline_prices, 5)
+    assert result['levels'] == sum(len(levels) for levels in levels_per_issue)
+    assert {row['price'] for row in result['bins']} == set(expected)
+    for row in result['bins']:
+        want = expected[row['price']]
+        assert (row['issues'], row['major']) == (want['issues'], want['major'])
+        assert (row['longest_streak'], row['current_streak']) == (want['longest_streak'], want['current_streak'])
+        assert row['last_seen'] == newsletter_ids[want['last_seen']]
+        assert row['vdline_distance'] == pytest.approx(want['vdline_distance'])
+        assert row['near_vdline_rate'] == pytest.approx(want['near_vdline_rate'])
+    counts = [row['issues'] for row in result['bins']]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_streaks_and_major_counts():
+    levels_per_issue = [
+        [(5700.0, False)],
+        [(5701.0, True), (5703.0, False)],
+        [],
+        [(5702.0, False)],
+        [(5704.0, True)],
+    ]
+    result = compute_level_analytics(*history(levels_per_issue), vdline_prices=[])
+    (row,) = result['bins']
+    assert (row['issues'], row['major'], row['frequency']) == (4, 2, 0.8)
+    assert (row['longest_streak'], row['current_streak'], row['last_seen']) == (2, 2, '20250205')
+    assert result['vdline_proximity'] is None
+    assert row['vdline_distance'] is None
+
+
+def test_empty_history():
+    result = compute_level_analytics(*history([]), vdline_prices=[5700.0])
+    assert (result['issues'], result['levels'], result['bins']) == (0, 0, [])
+
+
+def test_results_are_cached_until_a_snapshot_in_range_changes():
+    store_snapshot('default', '20250210', [{'price': 5700.0, 'major': True}], {})
+    assert load_level_history('default')[0] == ['20250210']
+    assert get_level_analytics()['issues'] == 1
+    assert len(app_tables.levelanalytics.search()) == 1
+
+    store_snapshot('default', '20250211', [{'price': 5700.0, 'major': False}], {})
+    assert len(app_tables.levelanalytics.search()) == 0
+    assert get_level_analytics()['bins'][0]['current_streak'] == 2
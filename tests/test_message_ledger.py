@@ -0,0 +1,57 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from anvil.tables import app_tables
+
+import main
+import metrics
+from message_ledger import count_precheck, get_precheck_stats, record_processed
+from sources import NewsletterSource
+
+SOURCE = NewsletterSource('default', 'plan@example.com')
+MONDAY_MS = int(datetime(2025, 2, 10, 21, tzinfo=timezone.utc).timestamp() * 1000)
+DAY_MS = 24 * 3600 * 1000
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    """Gmail stand-in whose newest message is gmail['latest'] = (message_id, internalDate)."""
+    state = {'latest': None, 'date_lookups': 0}
+
+    def get_message_date(message_id, service=None):
+        state['date_lookups'] += 1
+        return state['latest'][1]
+
+    monkeypatch.setattr(main, 'get_gmail_service', lambda: None)
+    monkeypatch.setattr(main, 'get_latest_message_id', lambda query, service=None: state['latest'][0])
+    monkeypatch.setattr(main, 'get_message_date', get_message_date)
+    return state
+
+
+def test_processed_message_exits_after_one_list_call(gmail):
+    record_processed('default', 'm1', MONDAY_MS, '20250210')
+    gmail['latest'] = ('m1', MONDAY_MS)
+    assert main.precheck_source(SOURCE) == (False, 'm1')
+    assert gmail['date_lookups'] == 0
+
+
+def test_unknown_message_not_newer_than_the_last_processed_is_not_fetched(gmail):
+    record_processed('default', 'm2', MONDAY_MS, '20250210')
+    gmail['latest'] = ('m1', MONDAY_MS - DAY_MS)
+    assert main.precheck_source(SOURCE) == (False, 'm1')
+
+
+def test_newer_message_runs_the_pipeline(gmail):
+    record_processed('default', 'm1', MONDAY_MS, '20250210')
+    gmail['latest'] = ('m2', MONDAY_MS + DAY_MS)
+    assert main.precheck_source(SOURCE) == (True, 'm2')
+
+
+def test_precheck_counts_stay_in_memory_until_flushed():
+    metrics.flush()
+    app_tables.metrics.delete_all_rows()
+    count_precheck('default', early_exit=True)
+    count_precheck('default', early_exit=False)
+    assert len(app_tables.metrics.search()) == 0
+    assert get_precheck_stats() == {'default': {'runs': 2, 'early_exits': 1}}
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from anvil.tables import app_tables
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def empty_buffer():
+    """Drops metrics buffered by earlier tests."""
+    metrics.flush()
+    app_tables.metrics.delete_all_rows()
+
+
+def test_counters_are_summed_per_name_before_flush():
+    for _ in range(250):
+        metrics.increment('tables.calls')
+    metrics.increment('gmail.bytes', 1200)
+    metrics.record_timing('stage.parse', 12.5)
+    metrics.record_timing('stage.parse', 30.0)
+    assert metrics.flush() == 4
+    counters = {row['name']: row['value'] for row in app_tables.metrics.search(kind='counter')}
+    assert counters == {'tables.calls': 250.0, 'gmail.bytes': 1200.0}
+    assert sorted(row['value'] for row in app_tables.metrics.search(kind='timer')) == [12.5, 30.0]
+    assert metrics.flush() == 0
+
+
+def test_summary_totals_counters_across_flushes():
+    for amount in (3, 4):
+        metrics.increment('levels.parsed', amount)
+        metrics.record_timing('run.total', 100.0 * amount)
+        metrics.flush()
+    summary = metrics.get_metrics_summary(hours=24)
+    assert summary['counters']['levels.parsed']['total'] == 7.0
+    assert summary['timers']['run.total']['count'] == 2
+
+
+def test_purge_deletes_only_rows_past_retention():
+    old = datetime.now() - timedelta(days=metrics.RETENTION_DAYS + 1)
+    app_tables.metrics.add_row(kind='counter', name='tables.calls', value=1.0, recorded=old)
+    app_tables.metrics.add_row(kind='counter', name='tables.calls', value=1.0, recorded=datetime.now())
+    assert metrics.purge_old_metrics() == 1
+    assert len(app_tables.metrics.search()) == 1
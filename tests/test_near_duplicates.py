@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from near_duplicates import classify, fingerprint, store_fingerprint
+
+BOILERPLATE = (
+    "Welcome back to the daily plan. As always, this is not financial advice. "
+    "Supports are levels where buyers tend to step in, resistances where sellers do. "
+    "Trade small, respect your stops, and let the market come to you. "
+    "The levels below are updated every afternoon before the close. "
+) * 8
+
+
+def issue(body):
+    return BOILERPLATE + body
+
+
+MONDAY = issue("Monday plan: supports 5700, 5680 (major), 5650. Resistances 5725, 5740, 5760 (major).")
+TUESDAY = issue("Tuesday plan: supports 5712, 5690, 5671 (major). Resistances 5735, 5752 (major), 5780.")
+
+
+def test_resend_is_duplicate():
+    store_fingerprint('default', '20250210', fingerprint(MONDAY), datetime(2025, 2, 10, 17))
+    kind, match_id, score = classify('default', '20250210', fingerprint(MONDAY))
+    assert (kind, match_id, score) == ('duplicate', '20250210', 1.0)
+
+
+def test_correction_of_same_issue_is_revision():
+    store_fingerprint('default', '20250210', fingerprint(MONDAY), datetime(2025, 2, 10, 17))
+    corrected = MONDAY.replace("5650", "5655")
+    kind, match_id, _ = classify('default', '20250210', fingerprint(corrected))
+    assert (kind, match_id) == ('revision', '20250210')
+
+
+def test_next_daily_issue_sharing_boilerplate_is_new():
+    store_fingerprint('default', '20250210', fingerprint(MONDAY), datetime(2025, 2, 10, 17))
+    kind, match_id, score = classify('default', '20250211', fingerprint(TUESDAY))
+    assert score >= 0.5, "the issues should be similar enough to be candidates"
+    assert (kind, match_id) == ('new', None)
+
+
+def test_other_source_is_not_a_candidate():
+    store_fingerprint('spx', '20250210-spx', fingerprint(MONDAY), datetime(2025, 2, 10, 17))
+    assert classify('default', '20250210', fingerprint(MONDAY))[0] == 'new'
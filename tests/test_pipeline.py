@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from anvil.tables import app_tables
+
+from pipeline import RUN_LEASE_MINUTES, SkipRun, Stage, run_pipeline
+
+
+def make_stages(calls, fail_at=None, skip_at=None):
+    def step(name, value):
+        def func(**inputs):
+            calls.append(name)
+            if name == fail_at:
+                raise RuntimeError(f"{name} broke")
+            if name == skip_at:
+                raise SkipRun(f"nothing new at {name}")
+            return {value: name.upper()}
+        return func
+
+    return [
+        Stage('fetch', step('fetch', 'raw'), outputs=('raw',)),
+        Stage('clean', step('clean', 'cleaned'), inputs=('raw',), outputs=('cleaned',)),
+        Stage('parse', step('parse', 'parsed'), inputs=('cleaned',), outputs=('parsed',)),
+    ]
+
+
+def test_completed_run_produces_every_output():
+    calls = []
+    result = run_pipeline('test', make_stages(calls))
+    assert result['run_status'] == 'completed'
+    assert calls == ['fetch', 'clean', 'parse']
+    assert result['parsed'] == 'PARSE'
+
+
+def test_skip_ends_the_run_without_failing():
+    calls = []
+    result = run_pipeline('test', make_stages(calls, skip_at='clean'))
+    assert result['run_status'] == 'skipped'
+    assert calls == ['fetch', 'clean']
+    assert app_tables.pipelineruns.get(run_id=result['run_id'])['status'] == 'skipped'
+
+
+def test_failed_run_resumes_after_completed_stages():
+    calls = []
+    with pytest.raises(RuntimeError):
+        run_pipeline('test', make_stages(calls, fail_at='parse'))
+    calls.clear()
+    result = run_pipeline('test', make_stages(calls))
+    assert calls == ['parse']
+    assert result['cleaned'] == 'CLEAN'
+    run = app_tables.pipelineruns.get(run_id=result['run_id'])
+    assert (run['status'], run['attempts']) == ('completed', 2)
+
+
+def _running_run(age_minutes):
+    moment = datetime.now() - timedelta(minutes=age_minutes)
+    return app_tables.pipelineruns.add_row(
+        run_id='inflight', pipeline='test', status='running', attempts=1, newsletter_id=None,
+        current_stage='clean', started=moment, heartbeat=moment, completed=None
+    )
+
+
+def test_run_in_progress_elsewhere_is_not_resumed():
+    _running_run(age_minutes=1)
+    calls = []
+    result = run_pipeline('test', make_stages(calls))
+    assert result['run_id'] != 'inflight'
+    assert calls == ['fetch', 'clean', 'parse']
+    assert app_tables.pipelineruns.get(run_id='inflight')['status'] == 'running'
+
+
+def test_stale_running_run_is_resumed():
+    _running_run(age_minutes=RUN_LEASE_MINUTES + 1)
+    app_tables.stageruns.add_row(run_id='inflight', pipeline='test', stage='fetch', status='completed', outputs={'raw': 'RAW'})
+    calls = []
+    result = run_pipeline('test', make_stages(calls))
+    assert result['run_id'] == 'inflight'
+    assert calls == ['clean', 'parse']
+
+
+def test_exhausted_run_is_abandoned():
+    calls = []
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            run_pipeline('test', make_stages(calls, fail_at='clean'))
+    first_run = app_tables.pipelineruns.search()[0]
+    calls.clear()
+    result = run_pipeline('test', make_stages(calls))
+    assert result['run_id'] != first_run['run_id']
+    assert first_run['status'] == 'abandoned'
+    assert calls == ['fetch', 'clean', 'parse']
+
+
+
+def bulky_stages(calls, fail_at=None):
+    """fetch produces a large body checkpointed as a reference; use and send follow it."""
+    def step(name, result):
+        def func(**inputs):
+            calls.append(name)
+            if name == fail_at:
+                raise RuntimeError(f"{name} broke")
+            return result
+        return func
+
+    def refetch(saved):
+        calls.append(f"refetch {saved['ref']}")
+        return {'body': 'B' * 10000}
+
+    return [
+        Stage('fetch', step('fetch', {'body': 'B' * 10000}), outputs=('body',),
+              checkpoint=lambda outputs: {'ref': 'm1'}, restore=refetch),
+        Stage('use', step('use', {'length': 10000}), inputs=('body',), outputs=('length',)),
+        Stage('send', step('send', {}), inputs=('length',)),
+    ]
+
+
+def test_bulky_outputs_are_checkpointed_as_a_reference():
+    calls = []
+    with pytest.raises(RuntimeError):
+        run_pipeline('test', bulky_stages(calls, fail_at='send'))
+    assert app_tables.stageruns.get(stage='fetch')['outputs'] == {'ref': 'm1'}
+    calls.clear()
+    assert run_pipeline('test', bulky_stages(calls))['run_status'] == 'completed'
+    assert calls == ['send'], "nothing left to run needs the body, so it is not restored"
+
+
+def test_bulky_outputs_are_restored_when_a_remaining_stage_needs_them():
+    calls = []
+    with pytest.raises(RuntimeError):
+        run_pipeline('test', bulky_stages(calls, fail_at='use'))
+    calls.clear()
+    assert run_pipeline('test', bulky_stages(calls))['length'] == 10000
+    assert calls == ['refetch m1', 'use', 'send']
@@ -0,0 +1,37 @@
+from anvil.tables import app_tables
+
+from search_index import index_newsletter, is_indexed, remove_newsletter, search_newsletters
+
+MONDAY = "<SECTION>Trading Plan:</SECTION>Buy the dip at 5700 (major). FOMC on Wednesday."
+TUESDAY = "<SECTION>Trading Plan:</SECTION>Sell the rip at 5750. FOMC tomorrow, 5700 (major) holds."
+NEXT_YEAR = "<SECTION>Trading Plan:</SECTION>FOMC again; 5700 (major) is far below."
+
+
+def ids(query):
+    return [result['newsletter_id'] for result in search_newsletters(query)]
+
+
+def test_terms_and_phrases_across_years():
+    index_newsletter('20241230', MONDAY)
+    index_newsletter('20241231', TUESDAY)
+    index_newsletter('20250102', NEXT_YEAR)
+    assert ids('fomc') == ['20250102', '20241231', '20241230']
+    assert ids('"5700 (major)" dip') == ['20241230']
+    assert ids('"major 5700"') == []
+    # One row per token and year, not per newsletter
+    assert len(app_tables.searchindex.search(token='fomc')) == 2
+
+
+def test_reindex_replaces_and_remove_deletes_postings():
+    index_newsletter('20241230', MONDAY)
+    index_newsletter('20241231', TUESDAY)
+    index_newsletter('20241230', "<SECTION>Trading Plan:</SECTION>Corrected: buy at 5690.")
+    assert ids('dip') == []
+    assert ids('5690') == ['20241230']
+    assert ids('fomc') == ['20241231']
+
+    remove_newsletter('20241231')
+    assert not is_indexed('20241231')
+    assert ids('fomc') == []
+    assert not app_tables.searchindex.search(token='fomc')
+    assert is_indexed('20241230')
@@ -0,0 +1,78 @@
+import pytest
+
+import anvil.secrets
+from anvil.tables import app_tables
+
+import delivery_queue
+import send_summary
+from delivery_queue import AnvilMailTransport, SmtpTransport
+from main import record_message_stage, send_stage
+from pipeline import Stage, run_pipeline
+from send_summary import get_transport
+from sources import DEFAULT_SOURCE_NAME, NewsletterSource
+from summary_artifacts import get_send_status, store_artifact
+
+
+def test_gmail_is_the_default_transport():
+    assert isinstance(get_transport(), AnvilMailTransport)
+
+
+def test_smtp_transport_is_built_from_secrets():
+    anvil.secrets.values.update(
+        email_transport='SMTP', smtp_host='mail.example.com', smtp_port='2525',
+        smtp_username='bot@example.com', smtp_password='pw', smtp_use_tls='false'
+    )
+    transport = get_transport()
+    assert isinstance(transport, SmtpTransport)
+    assert (transport.host, transport.port, transport.sender, transport.use_tls) == \
+        ('mail.example.com', 2525, 'bot@example.com', False)
+
+
+def test_smtp_without_host_is_an_error():
+    anvil.secrets.values['email_transport'] = 'smtp'
+    with pytest.raises(ValueError):
+        get_transport()
+
+
+class FlakyTransport:
+    """Fails every send to the given addresses until healed."""
+
+    def __init__(self, failing):
+        self.failing = set(failing)
+        self.sent = []
+
+    def send(self, to_address, subject, html_content, text_content):
+        if to_address in self.failing:
+            raise ConnectionError("mailbox unavailable")
+        self.sent.append(to_address)
+
+
+def test_partial_delivery_fails_the_run_and_resume_retries_only_failed(monkeypatch):
+    for email in ('a@example.com', 'b@example.com'):
+        app_tables.subscribers.add_row(email=email, active=True)
+    store_artifact('20250211', '<p>plan</p>', 'plan')
+    transport = FlakyTransport(['b@example.com'])
+    monkeypatch.setattr(send_summary, 'get_transport', lambda: transport)
+    monkeypatch.setattr(send_summary, 'deliver_summary', lambda *args, **kwargs: delivery_queue.deliver_summary(
+        *args, backoff_seconds=0, rate_per_second=0, **kwargs))
+    stages = [
+        Stage('send', send_stage, inputs=('newsletter_id',), outputs=('summary_sent',)),
+        Stage('record_message', record_message_stage, inputs=('source', 'newsletter_id', 'newsletter'), after=('send',)),
+    ]
+    context = {
+        'source': NewsletterSource(DEFAULT_SOURCE_NAME, 'plan@example.com'),
+        'newsletter_id': '20250211',
+        'newsletter': {'message_id': 'm1', 'internal_date': None},
+    }
+
+    with pytest.raises(send_summary.DeliveryFailed):
+        run_pipeline('test', stages, context=context)
+    assert get_send_status('20250211') == 'failed'
+    assert app_tables.processedmessages.get(message_id='m1') is None
+
+    transport.failing.clear()
+    result = run_pipeline('test', stages, context=context)
+    assert result['run_status'] == 'completed'
+    assert transport.sent == ['a@example.com', 'b@example.com']
+    assert get_send_status('20250211') == 'sent'
+    assert app_tables.processedmessages.get(message_id='m1') is not None
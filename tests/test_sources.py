@@ -0,0 +1,37 @@
+import pytest
+
+import anvil.secrets
+from anvil.tables import app_tables
+
+from sources import DEFAULT_SOURCE_NAME, get_sources, register_source
+
+
+@pytest.fixture(autouse=True)
+def sender_secret():
+    anvil.secrets.values['newsletter_sender_email'] = 'plan@example.com'
+
+
+def test_default_source_stays_when_another_is_registered():
+    register_source('spx', 'spx@example.com', 'spx')
+    assert [source.name for source in get_sources()] == [DEFAULT_SOURCE_NAME, 'spx']
+    assert get_sources()[0].is_default
+
+
+def test_inactive_default_row_turns_the_default_source_off():
+    register_source('spx', 'spx@example.com', 'spx')
+    register_source(DEFAULT_SOURCE_NAME, 'plan@example.com', '')
+    app_tables.newslettersources.get(name=DEFAULT_SOURCE_NAME)['active'] = False
+    assert [source.name for source in get_sources()] == ['spx']
+
+
+@pytest.mark.parametrize('name, namespace', [('spx', ''), ('spx', '  '), (DEFAULT_SOURCE_NAME, 'spx')])
+def test_namespace_must_match_whether_the_source_is_the_default(name, namespace):
+    with pytest.raises(ValueError):
+        register_source(name, 'spx@example.com', namespace)
+    assert len(app_tables.newslettersources.search()) == 0
+
+
+def test_namespaces_are_unique():
+    register_source('spx', 'spx@example.com', 'spx')
+    with pytest.raises(ValueError):
+        register_source('es', 'es@example.com', 'spx')
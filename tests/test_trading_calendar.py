@@ -0,0 +1,28 @@
+from datetime import date, datetime
+
+from trading_calendar import CENTRAL, TradingCalendar, next_session_after
+
+import pytest
+
+
+def test_before_the_open_names_the_next_trading_day():
+    # Wednesday 2025-02-12, 06:00 CT, before the 08:30 CT open
+    moment = CENTRAL.localize(datetime(2025, 2, 12, 6, 0))
+    assert next_session_after(moment) == date(2025, 2, 13)
+
+
+def test_friday_evening_skips_the_weekend_and_holidays():
+    # Friday 2025-02-14; Monday 2025-02-17 is Presidents' Day
+    moment = CENTRAL.localize(datetime(2025, 2, 14, 20, 0))
+    assert next_session_after(moment) == date(2025, 2, 18)
+
+
+def test_past_the_end_of_the_table_raises():
+    calendar = TradingCalendar(2025, 2025)
+    with pytest.raises(ValueError):
+        calendar.next_session_after(CENTRAL.localize(datetime(2025, 12, 31, 6, 0)))
+
+
+def test_instants_outside_the_process_calendar_fall_back_to_their_own_year():
+    moment = CENTRAL.localize(datetime(2099, 12, 31, 6, 0))
+    assert next_session_after(moment) == date(2100, 1, 4)
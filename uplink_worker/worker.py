@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+worker.py
+Uplink worker that runs cleaning, parsing and level matching on this machine.
+
+Registers the worker_* server functions used by server_code/worker_dispatch.py
+and runs each call on a local ProcessPoolExecutor, so batch reparses and
+backfills use every core of this machine instead of the Anvil server's
+sandbox. While it is not running, the app does the same work in-process.
+
+Usage:
+    pip install anvil-uplink spacy pytz
+    ANVIL_UPLINK_KEY=<server uplink key> python uplink_worker/worker.py [--workers N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server_code'))
+
+import anvil.server
+
+import cleaning_profiles
+from email_parser import clean_newsletter, parse_email, match_levels_to_vdlines
+
+
+_pool = None
+
+
+def _init_process(profile_configs):
+    """Gives each worker process the cleaning profiles without table access."""
+    cleaning_profiles.load_profiles(profile_configs)
+
+
+def _clean_and_parse(item, vdlines):
+    cleaned_body = item.get('cleaned_body') or clean_newsletter(item.get('raw_body'), item.get('profile'))
+    return cleaned_body, parse_email(cleaned_body, vdlines)
+
+
+@anvil.server.callable
+def worker_ping():
+    return {'processes': _pool._max_workers}
+
+
+@anvil.server.callable
+def worker_clean_newsletter(raw_body, profile=None):
+    return _pool.submit(clean_newsletter, raw_body, profile).result()
+
+
+@anvil.server.callable
+def worker_parse_email(cleaned_body, vdlines):
+    return _pool.submit(parse_email, cleaned_body, vdlines).result()
+
+
+@anvil.server.callable
+def worker_match_levels(levels, vdlines, max_distance=3):
+    return _pool.submit(match_levels_to_vdlines, levels, vdlines, max_distance).result()
+
+
+@anvil.server.callable
+def worker_clean_and_parse_batch(items, vdlines):
+    chunksize = max(1, len(items) // (_pool._max_workers * 4))
+    return [list(pair) for pair in _pool.map(_clean_and_parse, items, [vdlines] * len(items), chunksize=chunksize)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('--key', default=os.environ.get('ANVIL_UPLINK_KEY'), help='server uplink key')
+    args = parser.parse_args()
+    if not args.key:
+        parser.error('an uplink key is required (--key or ANVIL_UPLINK_KEY)')
+
+    global _pool
+    anvil.server.connect(args.key)
+    # Load table-defined cleaning profiles once here; worker processes cannot read tables
+    cleaning_profiles.load_table_profiles()
+    # Spawn rather than fork: this process already runs the Uplink connection threads
+    _pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_process, initargs=(dict(cleaning_profiles.PROFILE_CONFIGS),))
+    print(f"Worker connected with {args.workers} processes")
+    anvil.server.wait_forever()
+
+
+if __name__ == '__main__':
+    main()